@@ -0,0 +1,129 @@
+"""
+Decoding throughput of sales documents: codec options against Python conversion.
+
+Encodes synthetic documents shaped like the sales collection to BSON, then
+times decoding them with the default codec options followed by the previous
+recursive `convert_decimal128_to_float` pass and `_id` to `str` loop, against
+decoding them with the shared codec options of `quality_agent.database`.
+With `--uri` the same comparison runs on an aggregation of a live collection.
+
+    python benchmarks/bson_decoding_benchmark.py --documents 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import bson
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quality_agent.database import codec_options
+
+STORE_LOCATIONS = ["Denver", "Seattle", "London", "Austin", "New York", "San Diego"]
+PURCHASE_METHODS = ["In store", "Online", "Phone"]
+ITEMS = [("notepad", ["office", "writing", "school"]), ("pens", ["writing", "office", "school", "stationary"]),
+         ("backpack", ["school", "travel", "kids"]), ("laptop", ["electronics", "school", "office"]),
+         ("envelopes", ["stationary", "office", "general"]), ("binder", ["school", "general", "organization"])]
+
+
+def convert_decimal128_to_float(record):
+    """The conversion previously applied to every aggregation result."""
+    if isinstance(record, list):
+        return [convert_decimal128_to_float(item) for item in record]
+    elif isinstance(record, dict):
+        return {key: convert_decimal128_to_float(value) for key, value in record.items()}
+    elif isinstance(record, Decimal128):
+        return float(record.to_decimal())
+    return record
+
+
+def python_conversion(documents):
+    records = [convert_decimal128_to_float(document) for document in documents]
+    for record in records:
+        for key in record:
+            if key == "_id":
+                record[key] = str(record[key])
+    return records
+
+
+def make_sale(rng):
+    start = datetime(2013, 1, 1)
+    items = []
+    for name, tags in rng.sample(ITEMS, rng.randint(1, 5)):
+        items.append({
+            "name": name,
+            "tags": tags,
+            "price": Decimal128(f"{rng.uniform(1, 1500):.2f}"),
+            "quantity": rng.randint(1, 10),
+        })
+    return {
+        "_id": ObjectId(),
+        "saleDate": start + timedelta(minutes=rng.randrange(5 * 365 * 24 * 60)),
+        "items": items,
+        "storeLocation": rng.choice(STORE_LOCATIONS),
+        "customer": {"gender": rng.choice("MF"), "age": rng.randint(16, 75),
+                     "email": f"customer{rng.randrange(10 ** 6)}@example.com",
+                     "satisfaction": rng.randint(1, 5)},
+        "couponUsed": rng.random() < 0.2,
+        "purchaseMethod": rng.choice(PURCHASE_METHODS),
+    }
+
+
+def report(name, seconds, count):
+    print(f"{name:<22} {seconds:8.3f} s   {count / seconds:12,.0f} docs/s")
+
+
+def benchmark_offline(count, seed):
+    rng = random.Random(seed)
+    data = b"".join(bson.encode(make_sale(rng)) for _ in range(count))
+    print(f"{count} documents, {len(data) / 1e6:.1f} MB of BSON")
+
+    start = time.perf_counter()
+    baseline = python_conversion(bson.decode_all(data, DEFAULT_CODEC_OPTIONS))
+    report("decode + python pass", time.perf_counter() - start, count)
+
+    start = time.perf_counter()
+    decoded = bson.decode_all(data, codec_options)
+    report("codec options", time.perf_counter() - start, count)
+
+    assert decoded == baseline, "codec options produce different documents"
+
+
+def benchmark_live(uri, database, collection, count):
+    from pymongo import MongoClient
+    from quality_agent.database import get_database
+
+    client = MongoClient(uri)
+    pipeline = [{"$limit": count}]
+
+    start = time.perf_counter()
+    documents = python_conversion(client[database][collection].aggregate(pipeline))
+    report("live + python pass", time.perf_counter() - start, len(documents))
+
+    start = time.perf_counter()
+    documents = list(get_database(client, database)[collection].aggregate(pipeline))
+    report("live codec options", time.perf_counter() - start, len(documents))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--documents", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--uri", help="also aggregate a live collection")
+    parser.add_argument("--database", default="sample_supplies")
+    parser.add_argument("--collection", default="sales")
+    args = parser.parse_args()
+
+    benchmark_offline(args.documents, args.seed)
+    if args.uri:
+        benchmark_live(args.uri, args.database, args.collection, args.documents)
+
+
+if __name__ == "__main__":
+    main()
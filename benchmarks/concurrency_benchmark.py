@@ -0,0 +1,73 @@
+"""
+Concurrency benchmark for the `/query` endpoint.
+
+Sends the same set of questions at increasing concurrency levels against a
+running API server and reports throughput and latency percentiles. With the
+blocking `graph.stream` path throughput stays flat as concurrency grows, with
+the `astream` path it scales with the number of in-flight conversations.
+
+    uvicorn quality_agent.main:app --port 8000
+    python benchmarks/concurrency_benchmark.py --levels 1 5 10 25 --requests 50
+"""
+import argparse
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+DEFAULT_QUESTIONS = [
+    "What are the total sales in Denver?",
+    "How many online purchases were made?",
+    "Show me the average customer satisfaction by store location",
+    "Plot the number of sales per purchase method",
+]
+
+
+def send_query(api_url, question):
+    start = time.perf_counter()
+    response = requests.post(
+        api_url,
+        json={"query": question, "config": {"thread_id": str(uuid.uuid4())}},
+        timeout=300,
+    )
+    return time.perf_counter() - start, response.status_code
+
+
+def run_level(api_url, questions, total_requests, concurrency):
+    workload = [questions[i % len(questions)] for i in range(total_requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda q: send_query(api_url, q), workload))
+    wall_time = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    failures = sum(1 for _, status in results if status != 200)
+    return {
+        "concurrency": concurrency,
+        "wall_time_s": wall_time,
+        "throughput_rps": total_requests / wall_time,
+        "p50_s": statistics.median(latencies),
+        "p95_s": latencies[int(0.95 * (len(latencies) - 1))],
+        "failures": failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", default="http://localhost:8000/query")
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 5, 10, 20])
+    args = parser.parse_args()
+
+    print(f"{'concurrency':>11} {'wall(s)':>8} {'req/s':>7} {'p50(s)':>7} {'p95(s)':>7} {'fail':>5}")
+    for level in args.levels:
+        result = run_level(args.url, DEFAULT_QUESTIONS, args.requests, level)
+        print(f"{result['concurrency']:>11} {result['wall_time_s']:>8.2f} "
+              f"{result['throughput_rps']:>7.2f} {result['p50_s']:>7.2f} "
+              f"{result['p95_s']:>7.2f} {result['failures']:>5}")
+
+
+if __name__ == "__main__":
+    main()
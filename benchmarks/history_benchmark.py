@@ -0,0 +1,96 @@
+"""
+Per-turn prompt size and latency over long conversations, full history against budgeted views.
+
+Simulates conversations of `--turns` question/answer pairs. Every turn sends
+the history of the inspection node to a fake LLM whose latency grows with the
+prompt size (`--ms-per-1k-tokens`), once with the full history and once with
+the view of `HistoryManager`. The summarizer is a fake as well, so the
+numbers show the cost of the history itself and of building the view.
+
+    python benchmarks/history_benchmark.py --turns 50 --conversations 5
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quality_agent.history import HistoryManager, NODE_HISTORY_BUDGETS, count_message_tokens
+
+QUESTIONS = [
+    "How many sales were made in {store} in {year}?",
+    "What was the average customer satisfaction for {method} purchases in {store}?",
+    "Which items sold the most in {store} during {year}?",
+    "Compare the revenue of {store} with the previous year.",
+    "And how many of them used a coupon?",
+]
+STORES = ["Denver", "Seattle", "London", "Austin", "New York", "San Diego"]
+METHODS = ["Online", "In store", "Phone"]
+
+
+def make_turn(rng):
+    question = rng.choice(QUESTIONS).format(
+        store=rng.choice(STORES), year=rng.randint(2013, 2017), method=rng.choice(METHODS))
+    rows = "\n".join(
+        f"| {rng.choice(STORES)} | {rng.randint(10, 900)} | {rng.uniform(1, 5):.2f} |" for _ in range(rng.randint(3, 12)))
+    answer = f"## Answer\n| Store | Sales | Satisfaction |\n|---|---|---|\n{rows}\nThese figures cover the requested period."
+    return HumanMessage(question), AIMessage(answer)
+
+
+def fake_llm_latency(messages, ms_per_1k_tokens):
+    tokens = sum(count_message_tokens(message) for message in messages)
+    time.sleep(0.001 + tokens / 1000 * ms_per_1k_tokens / 1000)
+    return tokens
+
+
+def fake_summarizer(previous_summary, messages):
+    questions = [message.content for message in messages if isinstance(message, HumanMessage)]
+    summary = (previous_summary + " " if previous_summary else "") + "Asked: " + "; ".join(questions)
+    return summary[-1000:]
+
+
+def run(args):
+    turns = {mode: [[] for _ in range(args.turns)] for mode in ("full", "budgeted")}
+    tokens = {mode: [[] for _ in range(args.turns)] for mode in ("full", "budgeted")}
+    manager = HistoryManager(summarizer=fake_summarizer)
+    for conversation in range(args.conversations):
+        rng = random.Random(conversation)
+        messages = []
+        for turn in range(args.turns):
+            question, answer = make_turn(rng)
+            messages.append(question)
+            for mode in ("full", "budgeted"):
+                start = time.perf_counter()
+                history = messages if mode == "full" else manager.get_view(messages, "inspection")
+                tokens[mode][turn].append(fake_llm_latency(history, args.ms_per_1k_tokens))
+                turns[mode][turn].append(time.perf_counter() - start)
+            messages.append(answer)
+            # Summaries are computed in the background between turns
+            manager.wait_for_summaries(timeout=1)
+    return turns, tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--conversations", type=int, default=5)
+    parser.add_argument("--ms-per-1k-tokens", type=float, default=20.0,
+                        help="fake LLM latency added per 1000 prompt tokens")
+    args = parser.parse_args()
+
+    turns, tokens = run(args)
+    print(f"inspection budget: {NODE_HISTORY_BUDGETS['inspection'][0]} tokens")
+    print(f"{'turn':>4} {'full tokens':>12} {'full ms':>9} {'view tokens':>12} {'view ms':>9}")
+    for turn in list(range(0, args.turns, 5)) + [args.turns - 1]:
+        print(f"{turn + 1:>4} "
+              f"{statistics.mean(tokens['full'][turn]):>12.0f} {statistics.mean(turns['full'][turn]) * 1000:>9.2f} "
+              f"{statistics.mean(tokens['budgeted'][turn]):>12.0f} {statistics.mean(turns['budgeted'][turn]) * 1000:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
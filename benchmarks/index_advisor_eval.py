@@ -0,0 +1,87 @@
+"""
+Index recommendations and before/after latency of the index advisor against a local mongod.
+
+Seeds a scratch collection shaped like the sales collection (see
+pipeline_guard_eval.py), drops the indexes a previous run created and runs
+a workload of the pipelines users typically get generated, filtering and
+sorting on `storeLocation`, `purchaseMethod`, `saleDate` and `customer.age`.
+Every execution is recorded by the advisor, which then creates the
+recommended indexes. The workload runs again and the report compares the
+mean latency of each recommended index's pipelines before and after.
+
+    mongod --dbpath /tmp/guard-db --port 27017
+    python benchmarks/index_advisor_eval.py --uri mongodb://localhost:27017 --documents 200000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline_guard_eval import seed
+from quality_agent.index_advisor import IndexAdvisor
+
+WORKLOAD = {
+    "online sales per store in 2015": [
+        {"$match": {"purchaseMethod": "Online",
+                    "saleDate": {"$gte": datetime(2015, 1, 1), "$lt": datetime(2016, 1, 1)}}},
+        {"$group": {"_id": "$storeLocation", "count": {"$sum": 1}}},
+    ],
+    "latest sales in Denver": [
+        {"$match": {"storeLocation": "Denver"}},
+        {"$sort": {"saleDate": -1}},
+        {"$limit": 20},
+    ],
+    "young customers by method": [
+        {"$match": {"customer.age": {"$lt": 25}}},
+        {"$group": {"_id": "$purchaseMethod", "count": {"$sum": 1}}},
+    ],
+    "unfiltered totals": [
+        {"$group": {"_id": "$storeLocation", "count": {"$sum": 1}}},
+    ],
+}
+
+
+def run_workload(collection, advisor, repeat):
+    for _ in range(repeat):
+        for pipeline in WORKLOAD.values():
+            start = time.perf_counter()
+            list(collection.aggregate(pipeline))
+            advisor.record(collection.full_name, pipeline, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="guard_eval")
+    parser.add_argument("--documents", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri, serverSelectionTimeoutMS=5000)
+    collection = client[args.database]["guard_eval_sales"]
+    seed(collection, args.documents)
+    for name in collection.index_information():
+        if name.startswith("advisor_"):
+            collection.drop_index(name)
+
+    advisor = IndexAdvisor(min_occurrences=args.repeat, auto_create=False, client=client)
+    run_workload(collection, advisor, args.repeat)
+    print("created:", ", ".join(advisor.create_recommended(collection.full_name)) or "-")
+    run_workload(collection, advisor, args.repeat)
+
+    report = advisor.report()[collection.full_name]
+    print(f"{'index keys':<48} {'runs':>5} {'before ms':>10} {'after ms':>10}")
+    for index in report["created"] + report["recommended"]:
+        keys = ", ".join(f"{field} {direction}" for field, direction in index["keys"])
+        print(f"{keys:<48} {index['executions']:>5} {index['mean_ms_before'] or 0:>10.2f} "
+              f"{index['mean_ms_after'] or 0:>10.2f}")
+    print("group keys:", report["group_keys"])
+
+
+if __name__ == "__main__":
+    main()
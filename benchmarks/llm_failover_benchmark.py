@@ -0,0 +1,143 @@
+"""
+Latency of the LLM router against a single provider, with fake providers.
+
+Two local fake chat models answer after an injected delay: most requests
+are fast, a fraction hits a slow spell, and the primary provider fails for a
+while. Reports the latency percentiles of the primary alone,
+of the router with failover only, and of the router with hedging.
+
+    python benchmarks/llm_failover_benchmark.py --requests 400
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quality_agent.llm_router import LLMRouter, ProviderHealth
+
+
+class DelayedFakeChatModel(BaseChatModel):
+    """Fake provider answering after a random delay, failing during the `outage` window (seconds after its first call)."""
+    name: str
+    fast_seconds: float
+    slow_seconds: float
+    slow_probability: float
+    outage: tuple = (0, 0)
+    seed: int = 0
+    started: float = 0.0
+    rng: Any = None
+
+    def _llm_type(self):
+        return "delayed-fake"
+
+    def _next_delay(self):
+        if self.rng is None:
+            self.rng = random.Random(self.seed)
+            self.started = time.monotonic()
+        if self.outage[0] <= time.monotonic() - self.started < self.outage[1]:
+            return None
+        if self.rng.random() < self.slow_probability:
+            return self.slow_seconds
+        return self.fast_seconds * self.rng.uniform(0.8, 1.2)
+
+    def _result(self):
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.name))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        delay = self._next_delay()
+        if delay is None:
+            raise ConnectionError(f"{self.name} is unavailable")
+        time.sleep(delay)
+        return self._result()
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        delay = self._next_delay()
+        if delay is None:
+            raise ConnectionError(f"{self.name} is unavailable")
+        await asyncio.sleep(delay)
+        return self._result()
+
+
+def make_providers(args):
+    primary = DelayedFakeChatModel(
+        name="primary", fast_seconds=args.fast, slow_seconds=args.slow,
+        slow_probability=args.slow_probability, outage=(args.outage_start, args.outage_start + args.outage), seed=1)
+    secondary = DelayedFakeChatModel(
+        name="secondary", fast_seconds=args.fast * 1.5, slow_seconds=args.slow,
+        slow_probability=args.slow_probability, seed=2)
+    return {"primary": primary, "secondary": secondary}
+
+
+async def run(model, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    answered_by = {}
+
+    async def call():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                message = await model.ainvoke("question")
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+            answered_by[message.content] = answered_by.get(message.content, 0) + 1
+
+    await asyncio.gather(*(call() for _ in range(requests)))
+    return latencies, errors, answered_by
+
+
+def report(name, latencies, errors, answered_by):
+    latencies = sorted(latencies)
+
+    def percentile(percent):
+        return latencies[min(len(latencies) - 1, int(percent / 100 * len(latencies)))] * 1000
+
+    print(f"{name:<18} p50 {percentile(50):7.1f} ms   p95 {percentile(95):7.1f} ms   "
+          f"p99 {percentile(99):7.1f} ms   mean {statistics.mean(latencies) * 1000:7.1f} ms   "
+          f"errors {errors:3d}   answered by {answered_by}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--fast", type=float, default=0.02, help="typical latency in seconds")
+    parser.add_argument("--slow", type=float, default=0.5, help="latency of a slow spell in seconds")
+    parser.add_argument("--slow-probability", type=float, default=0.08)
+    parser.add_argument("--outage-start", type=float, default=1.0, help="seconds until the primary fails")
+    parser.add_argument("--outage", type=float, default=1.0, help="seconds the primary keeps failing")
+    parser.add_argument("--circuit-reset", type=float, default=1.0, help="seconds before a broken provider is retried")
+    args = parser.parse_args()
+
+    def health(providers):
+        return {name: ProviderHealth(name, reset_seconds=args.circuit_reset) for name in providers}
+
+    scenarios = [
+        ("primary only", lambda providers: providers["primary"]),
+        ("router failover", lambda providers: LLMRouter(providers, health(providers), hedge=False)),
+        ("router hedged", lambda providers: LLMRouter(providers, health(providers), hedge=True)),
+    ]
+    for name, build in scenarios:
+        model = build(make_providers(args))
+        report(name, *await run(model, args.requests, args.concurrency))
+        if isinstance(model, LLMRouter):
+            for provider, stats in model.stats().items():
+                print(f"{'':<18} {provider}: {stats}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+"""
+Cold start time and resident memory of the LLM setup.
+
+Each scenario runs in a fresh interpreter: `eager` imports the six provider
+SDKs and builds the clients of the four `LLMManager()` instances created at
+import before the registry, `registry` resolves the main model through
+`get_llm_manager()` the way the modules now do at import. Dummy API keys are
+set, no request is sent.
+
+    python benchmarks/llm_startup_benchmark.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, resource, time
+start = time.perf_counter()
+{body}
+print(json.dumps({{
+    "seconds": time.perf_counter() - start,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}}))
+"""
+
+EAGER = """
+from langchain_cerebras import ChatCerebras
+from langchain_nvidia_ai_endpoints import ChatNVIDIA
+from langchain_fireworks import ChatFireworks
+from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+from langchain_groq import ChatGroq
+from langchain_google_genai import ChatGoogleGenerativeAI
+for _ in range(4):
+    clients = [ChatGroq(model="llama-3.1-70b-versatile", temperature=0.0, max_retries=2) for _ in range(4)]
+    clients.append(ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0, max_retries=2))
+"""
+
+REGISTRY = """
+from quality_agent.llmManager import get_llm_manager
+llm = get_llm_manager().llm
+"""
+
+DUMMY_KEYS = {
+    "GROQ_API_KEY": "benchmark",
+    "GOOGLE_API_KEY": "benchmark",
+    "NVIDIA_API_KEY": "nvapi-benchmark",
+    "FIREWORKS_API_KEY": "benchmark",
+    "CEREBRAS_API_KEY": "benchmark",
+}
+
+
+def run(body):
+    env = {**os.environ, **DUMMY_KEYS}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(body=body)],
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, body in (("eager", EAGER), ("registry", REGISTRY)):
+        results = [run(body) for _ in range(args.runs)]
+        seconds = statistics.median(result["seconds"] for result in results)
+        rss = statistics.median(result["max_rss_mb"] for result in results)
+        print(f"{name:<10} startup {seconds * 1000:8.1f} ms   max rss {rss:7.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
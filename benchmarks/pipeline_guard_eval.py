@@ -0,0 +1,123 @@
+"""
+Decisions and overhead of the pipeline guard against a local mongod.
+
+Seeds a scratch collection shaped like the sales collection, indexes
+`storeLocation`, and runs the guard on typical generated pipelines: an
+indexed filter, an unfiltered `$unwind` of `items`, an unindexed filter,
+`$lookup` joins on an unindexed and an indexed field and a `$unionWith`.
+Reports the planned stages, the time the explain adds before the
+aggregation and, for each guard action, the decision the guard recorded.
+
+    mongod --dbpath /tmp/guard-db --port 27017
+    python benchmarks/pipeline_guard_eval.py --uri mongodb://localhost:27017 --documents 200000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quality_agent.pipeline_guard import (
+    PipelineGuard, PipelineRejectedError, find_plan_stages, get_explain_command, PIPELINE_GUARD_ACTIONS)
+
+PIPELINES = {
+    "indexed filter": [
+        {"$match": {"storeLocation": "Denver"}},
+        {"$group": {"_id": "$purchaseMethod", "count": {"$sum": 1}}},
+    ],
+    "unfiltered unwind": [
+        {"$unwind": "$items"},
+        {"$group": {"_id": "$items.name", "quantity": {"$sum": "$items.quantity"}}},
+    ],
+    "unindexed filter": [
+        {"$match": {"customer.satisfaction": {"$gte": 4}}},
+        {"$group": {"_id": "$storeLocation", "count": {"$sum": 1}}},
+    ],
+    "lookup": [
+        {"$match": {"storeLocation": "Seattle"}},
+        {"$lookup": {"from": "guard_eval_sales", "localField": "customer.email",
+                     "foreignField": "customer.email", "as": "other_sales"}},
+        {"$project": {"_id": 0, "saleDate": 1, "others": {"$size": "$other_sales"}}},
+    ],
+    "indexed lookup": [
+        {"$match": {"storeLocation": "Seattle"}},
+        {"$lookup": {"from": "guard_eval_sales", "localField": "_id", "foreignField": "_id", "as": "same_sale"}},
+        {"$project": {"_id": 0, "saleDate": 1, "same": {"$size": "$same_sale"}}},
+    ],
+    "union": [
+        {"$match": {"storeLocation": "Seattle"}},
+        {"$unionWith": {"coll": "guard_eval_sales", "pipeline": [{"$match": {"couponUsed": True}}]}},
+        {"$count": "sales"},
+    ],
+}
+
+
+def seed(collection, documents):
+    if collection.estimated_document_count() == documents:
+        return
+    collection.drop()
+    rng = random.Random(0)
+    start = datetime(2013, 1, 1)
+    batch = []
+    for _ in range(documents):
+        batch.append({
+            "saleDate": start + timedelta(minutes=rng.randrange(5 * 365 * 24 * 60)),
+            "storeLocation": rng.choice(["Denver", "Seattle", "London", "Austin", "New York", "San Diego"]),
+            "purchaseMethod": rng.choice(["Online", "In store", "Phone"]),
+            "items": [{"name": rng.choice(["pens", "notepad", "binder", "envelopes"]),
+                       "quantity": rng.randint(1, 10), "price": rng.uniform(1, 50)}
+                      for _ in range(rng.randint(1, 6))],
+            "customer": {"email": f"customer{rng.randrange(documents // 10)}@example.com",
+                         "satisfaction": rng.randint(1, 5), "age": rng.randint(18, 80)},
+            "couponUsed": rng.random() < 0.1,
+        })
+        if len(batch) == 10000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+    collection.create_index([("storeLocation", ASCENDING)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="guard_eval")
+    parser.add_argument("--documents", type=int, default=200000)
+    parser.add_argument("--max-scan-docs", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri, serverSelectionTimeoutMS=5000)
+    collection = client[args.database]["guard_eval_sales"]
+    seed(collection, args.documents)
+
+    print(f"{'pipeline':<18} {'plan':<24} {'explain ms':>10}  " + "  ".join(f"{a:<10}" for a in PIPELINE_GUARD_ACTIONS))
+    for name, pipeline in PIPELINES.items():
+        explain = collection.database.command(get_explain_command(collection, pipeline, 30000))
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            collection.database.command(get_explain_command(collection, pipeline, 30000))
+            timings.append((time.perf_counter() - start) * 1000)
+        decisions = []
+        for action in PIPELINE_GUARD_ACTIONS:
+            guard = PipelineGuard(max_scan_docs=args.max_scan_docs, action=action)
+            try:
+                guard.check(collection, pipeline)
+            except PipelineRejectedError:
+                pass
+            decisions.append(",".join(guard.decisions))
+        plan = ",".join(sorted(set(find_plan_stages(explain))))
+        print(f"{name:<18} {plan[:24]:<24} {statistics.median(timings):>10.2f}  "
+              + "  ".join(f"{decision:<10}" for decision in decisions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark of the generated-pipeline parser.
+
+Times `parse_pipeline` on the few-shot pipelines of the prompts against the
+previous regex + `eval` clean-up. The fuzz run and the allowlist rejections
+are in tests/test_pipeline_parser.py.
+
+    python benchmarks/pipeline_parser_benchmark.py --repeat 2000
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompts.inspectionPrompt import (
+    example_query1_output, example_query2_output, example_query3_output,
+    example_query4_output, sale_example_query_output1, sale_example_query_output2,
+)
+from quality_agent.pipeline_parser import parse_pipeline
+
+SAMPLES = [
+    sale_example_query_output1,
+    sale_example_query_output2,
+    example_query1_output,
+    example_query2_output,
+    example_query3_output,
+    example_query4_output,
+    '```json\n[{"$match": {"saleDate": {"$gte": ISODate("2017-01-01T00:00:00Z"), '
+    '"$lt": ISODate("2018-01-01T00:00:00Z")}, "couponUsed": true}}, '
+    '{"$group": {"_id": "$storeLocation", "total": {"$sum": 1}}}]\n```',
+]
+
+
+def eval_clean_up(text):
+    """The clean-up and `eval` previously used by `get_sales_data`."""
+    def iso_date_replacer(match):
+        return f'datetime.fromisoformat("{match.group(1)[:-1]}")'
+
+    query_modified = re.sub(r'ISODate\("([^"]+)"\)', iso_date_replacer, text)
+    query_modified = query_modified.replace('null', 'None').replace(
+        '```json', '').replace('```', '').replace('\n', '').replace(
+        'true', 'True').replace('false', 'False')
+    return eval(query_modified, {"datetime": datetime})
+
+
+def benchmark(repeat):
+    print(f"{'sample':>6} {'chars':>6} {'parser(us)':>11} {'eval(us)':>9}")
+    for index, sample in enumerate(SAMPLES):
+        parser_time = timeit.timeit(lambda: parse_pipeline(sample), number=repeat) / repeat
+        eval_time = timeit.timeit(lambda: eval_clean_up(sample), number=repeat) / repeat
+        print(f"{index:>6} {len(sample):>6} {parser_time * 1e6:>11.1f} {eval_time * 1e6:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    benchmark(args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Per-call prompt cost: templates rebuilt on every call against the prompt registry.
+
+For each prompt the nodes format per request, times building the template and
+formatting it with the schema and few-shot examples as variables (what every
+node call did before), against formatting the template of
+`prompts.promptRegistry` where they are rendered in once.
+
+    python benchmarks/prompt_formatting_benchmark.py --calls 2000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+from langchain.prompts import PromptTemplate
+from langchain_core.messages import HumanMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompts.inspectionPrompt import sales_mongodb_prompt, sales_schema, sale_query_examples
+from prompts.promptRegistry import get_prompt
+from prompts.routerPrompt import system_router_prompt, members, options
+from prompts.visualizationPrompt import user_query_regenerate_prompt, python_code_generation_prompt
+
+QUESTION = "How many sales were made in Denver through the Online purchase method in 2017?"
+HISTORY = [HumanMessage(QUESTION)]
+CODE_INPUTS = {"column_names": ["storeLocation", "total"], "number_of_rows": 6,
+               "sample_record": {"storeLocation": "Denver", "total": 1520.5}, "user_query": QUESTION}
+
+
+def rebuilt_sales_pipeline():
+    return PromptTemplate(
+        template=sales_mongodb_prompt, input_variables=["user_question"]
+    ).partial(present_date=datetime.now()).format(
+        user_question=QUESTION, collection_schema=sales_schema, **sale_query_examples)
+
+
+def rebuilt_router():
+    return ChatPromptTemplate.from_messages([
+        ("system", system_router_prompt),
+        MessagesPlaceholder(variable_name="question"),
+        ("system", "Given the conversation above, who should act next?"
+                   " Or should we FINISH? Select one of: {options}"),
+    ]).partial(options=str(options), members=", ".join(members)).format_messages(question=HISTORY)
+
+
+def rebuilt_visualization_query():
+    return ChatPromptTemplate.from_messages([
+        ("system", user_query_regenerate_prompt),
+        MessagesPlaceholder(variable_name="message_history_with_input"),
+    ]).format_messages(message_history_with_input=HISTORY, collection_schema=sales_schema)
+
+
+def rebuilt_code_generation():
+    return PromptTemplate(
+        template=python_code_generation_prompt,
+        input_variables=["column_names", "number_of_rows", "sample_record", "collection_schema", "user_query"]
+    ).format(collection_schema=sales_schema, **CODE_INPUTS)
+
+
+CASES = {
+    "sales_pipeline": (rebuilt_sales_pipeline, lambda: get_prompt("sales_pipeline").format(user_question=QUESTION)),
+    "router": (rebuilt_router, lambda: get_prompt("router").format_messages(question=HISTORY)),
+    "visualization_query": (rebuilt_visualization_query,
+                            lambda: get_prompt("visualization_query").format_messages(message_history_with_input=HISTORY)),
+    "code_generation": (rebuilt_code_generation, lambda: get_prompt("code_generation").format(**CODE_INPUTS)),
+}
+
+
+def time_calls(function, calls):
+    function()
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'prompt':<20} {'rebuilt us':>11} {'registry us':>12} {'speedup':>8}")
+    for name, (rebuilt, registry) in CASES.items():
+        rebuilt_us = time_calls(rebuilt, args.calls)
+        registry_us = time_calls(registry, args.calls)
+        print(f"{name:<20} {rebuilt_us:>11.1f} {registry_us:>12.1f} {rebuilt_us / registry_us:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Offline load test of the `/query` flow replayed from a cassette.
+
+Record a cassette once against the live services, by running the server with
+CASSETTE_MODE=record and sending the questions, e.g. with the concurrency
+benchmark:
+
+    CASSETTE_MODE=record uvicorn quality_agent.main:app --port 8000
+    python benchmarks/concurrency_benchmark.py --levels 1 --requests 4
+
+Then replay it in process, with no API keys or MongoDB, at several concurrency
+levels. The recorded latencies are injected unless overridden with
+--llm-latency-ms/--mongo-latency-ms, and --profile writes a cProfile dump of
+the whole run.
+
+    python benchmarks/replay_benchmark.py --cassette cassettes/workflow.jsonl --levels 1 5 10
+"""
+import argparse
+import asyncio
+import cProfile
+import os
+import statistics
+import sys
+import time
+import uuid
+
+DEFAULT_QUESTIONS = [
+    "What are the total sales in Denver?",
+    "How many online purchases were made?",
+    "Show me the average customer satisfaction by store location",
+    "Plot the number of sales per purchase method",
+]
+
+
+async def send_query(client, question):
+    start = time.perf_counter()
+    response = await client.post(
+        "/query", json={"query": question, "config": {"thread_id": str(uuid.uuid4())}}, timeout=300)
+    return time.perf_counter() - start, response.status_code
+
+
+async def run_level(client, questions, total_requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(question):
+        async with semaphore:
+            return await send_query(client, question)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run(questions[i % len(questions)]) for i in range(total_requests)))
+    wall_time = time.perf_counter() - start
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "concurrency": concurrency,
+        "throughput_rps": total_requests / wall_time,
+        "p50_s": statistics.median(latencies),
+        "p95_s": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "failures": sum(1 for _, status in results if status != 200),
+    }
+
+
+async def run(args):
+    import httpx
+    from quality_agent.cassette import cassette
+    from quality_agent.main import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://replay") as client:
+        for concurrency in args.levels:
+            result = await run_level(client, args.questions, args.requests, concurrency)
+            print(f"{result['concurrency']:>11} {result['throughput_rps']:>8.2f} "
+                  f"{result['p50_s']:>7.3f} {result['p95_s']:>7.3f} {result['failures']:>8}")
+    print(f"cassette: {cassette.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cassette", default="cassettes/workflow.jsonl")
+    parser.add_argument("--questions", nargs="+", default=DEFAULT_QUESTIONS)
+    parser.add_argument("--levels", nargs="+", type=int, default=[1, 5, 10])
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--llm-latency-ms", default="", help="fixed LLM latency instead of the recorded one")
+    parser.add_argument("--mongo-latency-ms", default="", help="fixed Mongo latency instead of the recorded one")
+    parser.add_argument("--latency-scale", default="1.0", help="multiplier of the recorded latencies")
+    parser.add_argument("--profile", help="write a cProfile dump of the run to this file")
+    args = parser.parse_args()
+
+    # The cassette is configured at import of the application modules
+    os.environ.update(
+        CASSETTE_MODE="replay",
+        CASSETTE_PATH=args.cassette,
+        CASSETTE_LLM_LATENCY_MS=args.llm_latency_ms,
+        CASSETTE_MONGO_LATENCY_MS=args.mongo_latency_ms,
+        CASSETTE_LATENCY_SCALE=args.latency_scale,
+    )
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    print(f"{'concurrency':>11} {'rps':>8} {'p50 s':>7} {'p95 s':>7} {'failures':>8}")
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(asyncio.run, run(args))
+        profiler.dump_stats(args.profile)
+        print(f"profile written to {args.profile}")
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
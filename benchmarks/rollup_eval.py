@@ -0,0 +1,170 @@
+"""
+Correctness and latency of the sales rollups against a local mongod.
+
+Seeds a scratch `sales` collection (with tags, Decimal128 prices and a few
+incomplete sales), rebuilds the rollups from most of it and records the rest
+through the incremental path. Every pipeline of the suite then runs on the
+raw sales and, rewritten, on its rollup collection: the results must be
+equal (floats to a relative 1e-9). Finally the incrementally maintained
+rollups are compared to a full rebuild. Exits with 1 on any difference.
+
+    mongod --dbpath /tmp/rollup-db --port 27017
+    python benchmarks/rollup_eval.py --uri mongodb://localhost:27017 --documents 200000
+"""
+import argparse
+import math
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson.decimal128 import Decimal128
+
+SUITE = {
+    "sales per store per month": [
+        {"$group": {"_id": {"store": "$storeLocation", "month": {"$dateToString": {"format": "%Y-%m", "date": "$saleDate"}}},
+                    "count": {"$sum": 1}}},
+        {"$sort": {"_id.store": 1, "_id.month": 1}},
+    ],
+    "revenue by purchase method": [
+        {"$unwind": "$items"},
+        {"$group": {"_id": "$purchaseMethod", "revenue": {"$sum": {"$multiply": ["$items.price", "$items.quantity"]}}}},
+    ],
+    "online sales in 2015 per store": [
+        {"$match": {"purchaseMethod": "Online", "saleDate": {"$gte": datetime(2015, 1, 1), "$lt": datetime(2016, 1, 1)}}},
+        {"$group": {"_id": "$storeLocation", "count": {"$sum": 1}, "age": {"$avg": "$customer.age"}}},
+    ],
+    "satisfaction per year in Denver": [
+        {"$match": {"storeLocation": {"$in": ["Denver", "Austin"]}}},
+        {"$group": {"_id": {"$year": "$saleDate"}, "satisfaction": {"$avg": "$customer.satisfaction"}}},
+        {"$sort": {"_id": 1}},
+    ],
+    "quantity per tag": [
+        {"$unwind": "$items"},
+        {"$unwind": "$items.tags"},
+        {"$group": {"_id": "$items.tags", "quantity": {"$sum": "$items.quantity"},
+                    "price": {"$avg": "$items.price"}, "items": {"$count": {}}}},
+    ],
+    "school items per store": [
+        {"$unwind": "$items"},
+        {"$unwind": "$items.tags"},
+        {"$match": {"items.tags": "school"}},
+        {"$group": {"_id": "$storeLocation", "revenue": {"$sum": {"$multiply": ["$items.quantity", "$items.price"]}}}},
+    ],
+    "sales in London": [
+        {"$match": {"storeLocation": "London"}},
+        {"$count": "sales"},
+    ],
+}
+
+
+def get_sale(rng, start):
+    tags = ["office", "school", "stationary", "general", "electronics", "travel", "kids"]
+    sale = {
+        "saleDate": start + timedelta(seconds=rng.randrange(5 * 365 * 24 * 3600)),
+        "storeLocation": rng.choice(["Denver", "Seattle", "London", "Austin", "New York", "San Diego"]),
+        "purchaseMethod": rng.choice(["Online", "In store", "Phone"]),
+        "items": [{"name": rng.choice(["pens", "notepad", "binder", "envelopes"]),
+                   "tags": rng.sample(tags, rng.randint(0, 3)),
+                   "quantity": rng.randint(1, 10), "price": Decimal128(f"{rng.uniform(1, 50):.2f}")}
+                  for _ in range(rng.randint(0, 5))],
+        "customer": {"age": rng.randint(18, 80), "satisfaction": rng.randint(1, 5)},
+        "couponUsed": rng.random() < 0.1,
+    }
+    # Incomplete sales, as recorded from receipts
+    if rng.random() < 0.02:
+        sale["customer"]["age"] = ""
+    if rng.random() < 0.01:
+        del sale["storeLocation"]
+    return sale
+
+
+def normalize(value):
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [normalize(item) for item in value]
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+
+def equal(left, right):
+    if isinstance(left, dict) and isinstance(right, dict):
+        return left.keys() == right.keys() and all(equal(left[key], right[key]) for key in left)
+    if isinstance(left, list) and isinstance(right, list):
+        return len(left) == len(right) and all(equal(a, b) for a, b in zip(left, right))
+    if isinstance(left, (int, float)) and isinstance(right, (int, float)) and not isinstance(left, bool):
+        return math.isclose(left, right, rel_tol=1e-9, abs_tol=1e-9)
+    return left == right
+
+
+def sort_results(documents):
+    return sorted(documents, key=lambda document: repr(normalize(document.get("_id"))))
+
+
+def time_pipeline(collection, pipeline, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        documents = list(collection.aggregate(pipeline))
+        timings.append((time.perf_counter() - start) * 1000)
+    return documents, statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="rollup_eval")
+    parser.add_argument("--documents", type=int, default=200000)
+    parser.add_argument("--incremental", type=int, default=500, help="sales recorded through the insert path")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ.update(MONGODB_CONNECTION_STRING=args.uri, MONGODB_SALES_DATABASE_NAME=args.database,
+                      ROLLUPS_ENABLED="true", ROLLUP_UPDATE_MODE="insert")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from quality_agent.database import get_sales_db
+    from quality_agent.rollups import rollup_manager, ROLLUP_DAILY_COLLECTION, ROLLUP_TAGS_COLLECTION
+
+    database = get_sales_db()
+    sales = database["sales"]
+    sales.drop()
+    rng = random.Random(0)
+    start = datetime(2013, 1, 1)
+    documents = [get_sale(rng, start) for _ in range(args.documents)]
+    for offset in range(0, args.documents - args.incremental, 10000):
+        sales.insert_many(documents[offset:min(offset + 10000, args.documents - args.incremental)])
+    rollup_manager.rebuild()
+    for sale in documents[args.documents - args.incremental:]:
+        sales.insert_one(sale)
+        rollup_manager.record_sale(sale)
+
+    failures = 0
+    print(f"{'pipeline':<32} {'grain':<6} {'rows':>5} {'raw ms':>9} {'rollup ms':>9}  result")
+    for name, pipeline in SUITE.items():
+        raw, raw_ms = time_pipeline(sales, pipeline, args.repeat)
+        collection, rewritten = rollup_manager.route(database, pipeline)
+        if collection.name == "sales":
+            print(f"{name:<32} {'-':<6} {len(raw):>5} {raw_ms:>9.1f} {'-':>9}  not rewritten")
+            failures += 1
+            continue
+        rolled, rollup_ms = time_pipeline(collection, rewritten, args.repeat)
+        same = equal(sort_results(raw), sort_results(rolled))
+        failures += not same
+        grain = "tag" if collection.name == ROLLUP_TAGS_COLLECTION else "daily"
+        print(f"{name:<32} {grain:<6} {len(raw):>5} {raw_ms:>9.1f} {rollup_ms:>9.1f}  {'equal' if same else 'DIFFERENT'}")
+
+    incremental = {name: sort_results(list(database[name].find())) for name in (ROLLUP_DAILY_COLLECTION, ROLLUP_TAGS_COLLECTION)}
+    rollup_manager.rebuild()
+    for name, documents in incremental.items():
+        same = equal(documents, sort_results(list(database[name].find())))
+        failures += not same
+        print(f"incremental {name} vs rebuild: {'equal' if same else 'DIFFERENT'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
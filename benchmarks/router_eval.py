@@ -0,0 +1,77 @@
+"""
+Routing accuracy and latency of the local classifier and the LLM router.
+
+Evaluates the labelled questions in `router_eval_set.json` with the local
+classifier, reports how many of them take the fast path at the configured
+confidence threshold, and with `--llm` also evaluates the LLM router (needs
+the provider API keys) and the combined local-then-LLM router.
+
+    python benchmarks/router_eval.py --llm
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import HumanMessage
+from quality_agent.route_classifier import route_classifier, ROUTER_CONFIDENCE_THRESHOLD
+
+EVAL_SET_PATH = os.path.join(os.path.dirname(__file__), "router_eval_set.json")
+
+
+def evaluate(name, examples, route):
+    latencies = []
+    correct = 0
+    for example in examples:
+        start = time.perf_counter()
+        predicted = route(example["question"])
+        latencies.append((time.perf_counter() - start) * 1000)
+        correct += predicted == example["route"]
+    print(f"{name:<14} accuracy {correct / len(examples):6.1%}   "
+          f"p50 {statistics.median(latencies):9.3f} ms   max {max(latencies):9.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--llm", action="store_true", help="also evaluate the LLM router")
+    parser.add_argument("--threshold", type=float, default=ROUTER_CONFIDENCE_THRESHOLD)
+    args = parser.parse_args()
+
+    with open(EVAL_SET_PATH, "r", encoding="utf-8") as file:
+        examples = json.load(file)
+
+    predictions = [route_classifier.predict(example["question"]) for example in examples]
+    confident = [
+        (example, route) for example, (route, confidence) in zip(examples, predictions)
+        if confidence >= args.threshold
+    ]
+    fast_path_correct = sum(route == example["route"] for example, route in confident)
+    print(f"{len(examples)} labelled questions, threshold {args.threshold}")
+    print(f"fast path taken for {len(confident)}/{len(examples)} questions, "
+          f"{fast_path_correct}/{len(confident)} of them correct")
+
+    evaluate("local", examples, lambda question: route_classifier.predict(question)[0])
+
+    if args.llm:
+        from prompts.routerPrompt import get_router_prompt
+        from quality_agent.llmManager import get_llm_manager
+
+        router_chain = get_router_prompt() | get_llm_manager().llm_for_router
+
+        def llm_route(question):
+            return router_chain.invoke({"question": [HumanMessage(question)]}).content.strip()
+
+        def hybrid_route(question):
+            route, confidence = route_classifier.predict(question)
+            return route if confidence >= args.threshold else llm_route(question)
+
+        evaluate("llm", examples, llm_route)
+        evaluate("local+llm", examples, hybrid_route)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Latency and token cost of speculating on the route, with fake chat models.
+
+Each request runs the visualization stages router -> rephrase -> sales
+pipeline on local fake chat models that answer after an injected delay. The
+sequential run waits for the router before starting the rephrase, the
+speculative run starts the rephrase (and from it the pipeline) through the
+`SpeculationManager` while the router decides. A share of the requests is
+routed elsewhere by the router, their speculative work is cancelled and its
+tokens are wasted.
+
+    python benchmarks/speculation_benchmark.py --requests 40 --hit-rate 0.8
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quality_agent.speculation import SpeculationManager
+
+QUESTION = "Plot the total sales per store location in 2017"
+
+
+class DelayedFakeChatModel(BaseChatModel):
+    """Fake stage model answering `answer` after `seconds`, with a fixed completion size."""
+    answer: str
+    seconds: float
+    completion_tokens: int = 200
+
+    def _llm_type(self):
+        return "delayed-fake"
+
+    def _result(self, messages):
+        message = AIMessage(content=self.answer, usage_metadata={
+            "input_tokens": sum(len(str(message.content)) for message in messages) // 4,
+            "output_tokens": self.completion_tokens,
+            "total_tokens": 0,
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.seconds)
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.seconds)
+        return self._result(messages)
+
+
+def make_models(args):
+    prompt = HumanMessage("x" * args.prompt_chars)
+    return {
+        "router_hit": (DelayedFakeChatModel(answer="Visualization", seconds=args.router, completion_tokens=5), prompt),
+        "router_miss": (DelayedFakeChatModel(answer="Help", seconds=args.router, completion_tokens=5), prompt),
+        "rephrase": (DelayedFakeChatModel(answer=QUESTION, seconds=args.rephrase), prompt),
+        "pipeline": (DelayedFakeChatModel(answer="[]", seconds=args.pipeline), prompt),
+    }
+
+
+async def call(models, name):
+    model, prompt = models[name]
+    return (await model.ainvoke([prompt])).content
+
+
+async def sequential(models, hit):
+    start = time.perf_counter()
+    route = await call(models, "router_hit" if hit else "router_miss")
+    if route == "Visualization":
+        await call(models, "rephrase")
+        await call(models, "pipeline")
+    return time.perf_counter() - start
+
+
+async def speculative(models, manager, hit):
+    start = time.perf_counter()
+    speculation = manager.start("Visualization")
+
+    async def rephrase():
+        rephrased = await call(models, "rephrase")
+        manager.spawn(speculation, f"pipeline:{rephrased}", lambda: call(models, "pipeline"))
+        return rephrased
+
+    manager.spawn(speculation, "rephrase", rephrase)
+    route = await call(models, "router_hit" if hit else "router_miss")
+    if manager.resolve(speculation, route):
+        rephrased = await manager.take(speculation.id, "rephrase") or await call(models, "rephrase")
+        if await manager.take(speculation.id, f"pipeline:{rephrased}") is None:
+            await call(models, "pipeline")
+    return time.perf_counter() - start
+
+
+def summary(latencies):
+    if not latencies:
+        return "-"
+    return f"{statistics.mean(latencies):.3f}"
+
+
+async def run(args):
+    models = make_models(args)
+    manager = SpeculationManager()
+    rng = random.Random(args.seed)
+    hits = [rng.random() < args.hit_rate for _ in range(args.requests)]
+
+    results = {"sequential": {True: [], False: []}, "speculative": {True: [], False: []}}
+    for hit in hits:
+        results["sequential"][hit].append(await sequential(models, hit))
+        results["speculative"][hit].append(await speculative(models, manager, hit))
+
+    print(f"{'mode':<12} {'hit mean s':>11} {'miss mean s':>12} {'overall mean s':>15}")
+    for mode, latencies in results.items():
+        print(f"{mode:<12} {summary(latencies[True]):>11} {summary(latencies[False]):>12} "
+              f"{summary(latencies[True] + latencies[False]):>15}")
+
+    stats = manager.stats()
+    print(f"\nspeculative stages used: {stats['used_stages']}, saved {stats['saved_seconds']:.2f}s in total")
+    for outcome, values in stats["routes"].get("Visualization", {}).items():
+        print(f"{outcome:<6} speculations: {values['count']:>4}  tokens: {values['tokens']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--hit-rate", type=float, default=0.8, help="share of requests the router confirms")
+    parser.add_argument("--router", type=float, default=0.4, help="router call seconds")
+    parser.add_argument("--rephrase", type=float, default=0.6, help="rephrase call seconds")
+    parser.add_argument("--pipeline", type=float, default=1.0, help="pipeline generation call seconds")
+    parser.add_argument("--prompt-chars", type=int, default=6000)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
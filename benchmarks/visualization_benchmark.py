@@ -0,0 +1,110 @@
+"""
+End-to-end latency and success rate of the multi-call and single-call visualization modes.
+
+Each mode runs in its own process (the mode is read when the application is
+imported) and sends the chart questions to the `/query` endpoint in process.
+A request succeeds when it returns a chart. For the single-call mode the
+share of planned stages that were used, rather than falling back to the
+multi-call path, is reported as well.
+
+Runs against the live LLM providers and MongoDB configured in `.env`, or
+offline from a cassette recorded in both modes (see replay_benchmark.py):
+
+    python benchmarks/visualization_benchmark.py --requests 20
+    python benchmarks/visualization_benchmark.py --cassette cassettes/visualization.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+DEFAULT_QUESTIONS = [
+    "Plot the number of sales per purchase method",
+    "Show me a bar chart of the total sales amount for each store location",
+    "Generate a line chart showing monthly sales trends in 2017",
+    "Create a pie chart of the coupon usage",
+    "Plot the average customer satisfaction by store location",
+]
+MODES = ("multi_call", "single_call")
+PLAN_STAGES = ("plan", "pipeline", "chart")
+
+
+async def send_query(client, question):
+    start = time.perf_counter()
+    response = await client.post(
+        "/query", json={"query": question, "config": {"thread_id": str(uuid.uuid4())}}, timeout=300)
+    latency = time.perf_counter() - start
+    return latency, response.status_code == 200 and bool(response.json().get("chart"))
+
+
+async def run_mode(args):
+    import httpx
+    from prometheus_client import REGISTRY
+    from quality_agent.main import app
+
+    latencies, successes = [], 0
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for i in range(args.requests):
+            latency, success = await send_query(client, args.questions[i % len(args.questions)])
+            latencies.append(latency)
+            successes += success
+
+    def count(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    plan = {stage: {outcome: count("querygenai_visualization_plan_total", stage=stage, outcome=outcome)
+                    for outcome in ("used", "fallback")} for stage in PLAN_STAGES}
+    latencies.sort()
+    return {
+        "mode": args.run_mode,
+        "p50_s": statistics.median(latencies),
+        "p95_s": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        "mean_s": statistics.mean(latencies),
+        "success_rate": successes / len(latencies),
+        "plan": plan,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--questions", nargs="+", default=DEFAULT_QUESTIONS)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--cassette", help="replay this cassette instead of calling the live services")
+    parser.add_argument("--run-mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        # Answers must come from the workflow, not the caches filled by earlier requests
+        os.environ.update(VISUALIZATION_MODE=args.run_mode, ANSWER_CACHE_ENABLED="false",
+                          LLM_CACHE_ENABLED="false", PIPELINE_CACHE_ENABLED="false",
+                          AGGREGATION_CACHE_ENABLED="false", SPECULATION_ENABLED="false")
+        if args.cassette:
+            os.environ.update(CASSETTE_MODE="replay", CASSETTE_PATH=args.cassette)
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        print(json.dumps(asyncio.run(run_mode(args))))
+        return
+
+    print(f"{'mode':<12} {'p50 s':>7} {'p95 s':>7} {'mean s':>7} {'success':>8}  planned stages used")
+    for mode in args.modes:
+        command = [sys.executable, os.path.abspath(__file__), "--run-mode", mode,
+                   "--requests", str(args.requests), "--questions", *args.questions]
+        if args.cassette:
+            command += ["--cassette", args.cassette]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        used = "  ".join(
+            f"{stage} {values['used']:.0f}/{values['used'] + values['fallback']:.0f}"
+            for stage, values in result["plan"].items() if values["used"] + values["fallback"])
+        print(f"{result['mode']:<12} {result['p50_s']:>7.3f} {result['p95_s']:>7.3f} "
+              f"{result['mean_s']:>7.3f} {result['success_rate']:>7.0%}  {used or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,72 @@
-from typing import Optional
+import os
+from typing import Any, Dict, List, Literal, Optional
 from pydantic import BaseModel, Field
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Questions per /query/batch request and how many of them run at the same time
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "50"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+
+class QueryConfig(BaseModel):
+    thread_id: Optional[str] = Field(
+        None, example="1", description="Conversation id, a new one is created when omitted")
+    recursion_limit: int = Field(100, example=100)
 
 
 class Query(BaseModel):
     query: str = Field(..., example="Query for NLP")
+    config: Optional[QueryConfig] = None
 
 class QueryResponse(BaseModel):
     answer: str = Field(..., example="Final answer for the user query")
     chart: str = Field(...,
                        example="Chart generated from the user query in json format")
+    thread_id: Optional[str] = Field(None, example="1")
 
 
 class HelpResponse(BaseModel):
     help_text: str = Field(..., example="Detailed help text for the user")
+
+
+class BatchQuery(BaseModel):
+    queries: List[str] = Field(
+        ..., min_length=1, max_length=BATCH_MAX_QUERIES, example=["Sales in Denver", "Sales in Seattle"])
+    max_concurrency: Optional[int] = Field(
+        None, ge=1, le=BATCH_MAX_CONCURRENCY, example=8, description="Questions processed at the same time")
+
+
+class BatchQueryItem(BaseModel):
+    query: str = Field(..., example="Sales in Denver")
+    answer: str = Field("", example="Final answer for the user query")
+    chart: Optional[str] = Field(None, example="Chart in json format")
+    thread_id: str = Field(..., example="1")
+    duration_ms: float = Field(..., example=1530.2)
+    error: Optional[str] = Field(None, example="Error message if the query failed")
+
+
+class BatchQueryResponse(BaseModel):
+    results: List[BatchQueryItem]
+    duration_ms: float = Field(..., example=8120.5)
+    shared_calls: int = Field(
+        ..., example=12, description="Router, pipeline and aggregate calls reused across questions")
+
+
+class ChartSpec(BaseModel):
+    chart_type: Literal["bar", "line", "scatter", "pie", "histogram", "area", "box"] = Field(
+        ..., description="Plotly express chart to draw")
+    x: str = Field(..., description="Field of the pipeline output on the x axis, or the pie labels")
+    y: Optional[str] = Field(
+        None, description="Field on the y axis, or the pie values. Omitted for histograms of counts")
+    color: Optional[str] = Field(None, description="Field splitting the data into colored series")
+    title: str = Field(..., description="Chart title")
+
+
+class VisualizationPlan(BaseModel):
+    rephrased_question: str = Field(
+        ..., description="Plain text question retrieving the data to visualize")
+    pipeline: List[Dict[str, Any]] = Field(
+        ..., description="MongoDB aggregation pipeline on the sales collection producing the chart data")
+    chart: ChartSpec
@@ -1,6 +1,8 @@
-from datetime import datetime, timezone
+from datetime import timezone
+from functools import partial
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.prompts import PromptTemplate
+from prompts.promptRegistry import get_present_date
 from quality_agent.logger import setup_logger
 
 logger = setup_logger(__name__)
@@ -35,7 +37,7 @@ def get_schedule_prompt():
             ("system", schedule_prompt),
             MessagesPlaceholder(variable_name="question"),
         ]
-    ).partial(present_date=datetime.now(tz=timezone.utc))
+    ).partial(present_date=partial(get_present_date, timezone.utc))
     return prompt
 
 
@@ -0,0 +1,28 @@
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+history_summary_prompt = (
+    """You are an AI assistant responsible for summarizing the earlier part of a conversation between a user and a sales data assistant.
+       The summary replaces those messages in later prompts, so keep every detail a follow-up question could refer to:
+        - The questions the user asked and the filters they used (store locations, purchase methods, dates, items, customers).
+        - The figures, results and charts the assistant returned.
+        - Any preferences or corrections the user stated.
+
+        Summary of the conversation before these messages (may be empty):
+        {previous_summary}
+
+        Return only the updated summary as a few short sentences or bullet points, nothing else.
+    """
+)
+
+
+def get_history_summary_prompt():
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", history_summary_prompt),
+            MessagesPlaceholder(variable_name="messages"),
+        ]
+    )
+    return prompt
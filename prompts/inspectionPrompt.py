@@ -1,9 +1,9 @@
 from langchain_core.prompts import ChatPromptTemplate
 from langchain.prompts import PromptTemplate
-from datetime import datetime
 from bson import json_util
 from quality_agent.logger import setup_logger
 from langchain_core.prompts import MessagesPlaceholder
+from prompts.promptRegistry import get_present_date, render_static
 
 logger = setup_logger(__name__)
 
@@ -408,6 +408,16 @@ The `sales` collection stores information about individual sales transactions, w
 
 """
 
+# Values of the categorical fields of the `sales` collection (sample_supplies dataset)
+sales_store_locations = ["Denver", "Seattle", "London", "Austin", "New York", "San Diego"]
+sales_purchase_methods = ["Online", "In store", "Phone"]
+# Field paths described in `sales_schema`
+sales_schema_fields = [
+    "_id", "saleDate", "items", "items.name", "items.tags", "items.price", "items.quantity",
+    "storeLocation", "customer", "customer.gender", "customer.age", "customer.email",
+    "customer.satisfaction", "couponUsed", "purchaseMethod",
+]
+
 sale_example_query1 = "Retrieve Sales Made in Denver"
 
 sale_example_query_output1 = """
@@ -494,9 +504,9 @@ all_schemas = {'accounts': accounts_schema, 'customers': customers_schema, 'tran
 
 def get_fetch_sales_prompt():
     query_with_prompt_template = PromptTemplate(
-        template=sales_mongodb_prompt,
+        template=render_static(sales_mongodb_prompt, collection_schema=sales_schema, **sale_query_examples),
         input_variables=["user_question"]
-    ).partial(present_date=datetime.now())
+    ).partial(present_date=get_present_date)
 
     return query_with_prompt_template
 
@@ -511,12 +521,12 @@ def get_fetch_collections_prompt():
 
 def get_sample_analytics_mongodb_prompt():
     query_with_prompt_template = PromptTemplate(
-        template=sample_analytics_mongodb_prompt,
-        input_variables=["user_question", "example_query1", "example_query_output1", "example_query2", "example_query_output2", "example_query3", "example_query_output3", "example_query4", "example_query_output4", "collection_schemas"]
-    ).partial(present_date=datetime.now())
+        template=render_static(sample_analytics_mongodb_prompt, **query_examples),
+        input_variables=["user_question", "collection_schemas"]
+    ).partial(present_date=get_present_date)
     return query_with_prompt_template
 
-def get_inspection_prompt(inspection_tools):
+def get_inspection_prompt(inspection_tools=None):
     prompt = ChatPromptTemplate.from_messages(
         [
             (
@@ -535,5 +545,5 @@ def get_inspection_prompt(inspection_tools):
             MessagesPlaceholder(variable_name="message_history_with_input"),
             ("placeholder", "{agent_scratchpad}"),
         ]
-    ).partial(present_date=datetime.now())
+    ).partial(present_date=get_present_date)
     return prompt
@@ -0,0 +1,94 @@
+import importlib
+import os
+import threading
+from datetime import datetime
+from string import Formatter
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Granularity of `present_date` in the prompts. A date keeps the formatted
+# prompts, and so the LLM cache keys, identical for a whole day.
+PROMPT_DATE_FORMAT = os.getenv("PROMPT_DATE_FORMAT", "%Y-%m-%d")
+
+# Prompt name -> (module, builder function). Modules are imported on first use.
+PROMPT_BUILDERS = {
+    "router": ("prompts.routerPrompt", "get_router_prompt"),
+    "inspection": ("prompts.inspectionPrompt", "get_inspection_prompt"),
+    "sales_pipeline": ("prompts.inspectionPrompt", "get_fetch_sales_prompt"),
+    "fetch_collections": ("prompts.inspectionPrompt", "get_fetch_collections_prompt"),
+    "analytics_pipeline": ("prompts.inspectionPrompt", "get_sample_analytics_mongodb_prompt"),
+    "visualization_query": ("prompts.visualizationPrompt", "create_query_generation_prompt"),
+    "code_generation": ("prompts.visualizationPrompt", "create_code_generation_prompt"),
+    "visualization_plan": ("prompts.visualizationPrompt", "create_visualization_plan_prompt"),
+    "schedule": ("prompts.actionsPrompt", "get_schedule_prompt"),
+    "history_summary": ("prompts.historyPrompt", "get_history_summary_prompt"),
+}
+
+
+def get_present_date(tz=None):
+    """Partial of the `present_date` prompt variable, evaluated every time a prompt is formatted."""
+    return datetime.now(tz=tz).strftime(PROMPT_DATE_FORMAT)
+
+
+def escape_braces(text):
+    return str(text).replace("{", "{{").replace("}", "}}")
+
+
+def render_static(template, **values):
+    """
+    Substitutes the static `values` (schemas, few-shot examples) into an
+    f-string template once, leaving the other variables for each call.
+    """
+    parts = []
+    for literal, field, format_spec, conversion in Formatter().parse(template):
+        parts.append(escape_braces(literal))
+        if field is None:
+            continue
+        if field in values:
+            parts.append(escape_braces(values[field]))
+        else:
+            parts.append(
+                "{" + field + (f"!{conversion}" if conversion else "") + (f":{format_spec}" if format_spec else "") + "}")
+    return "".join(parts)
+
+
+class PromptRegistry:
+    """
+    Builds every prompt template once and shares it between the calls.
+    Templates are immutable, dynamic values like the current date are
+    callable partials resolved when a prompt is formatted.
+    """
+
+    def __init__(self, builders=PROMPT_BUILDERS):
+        self.builders = builders
+        self._prompts = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        prompt = self._prompts.get(name)
+        if prompt is not None:
+            return prompt
+        with self._lock:
+            if name not in self._prompts:
+                if name not in self.builders:
+                    raise ValueError(f"Unknown prompt '{name}', expected one of {list(self.builders)}")
+                module_name, builder_name = self.builders[name]
+                builder = getattr(importlib.import_module(module_name), builder_name)
+                self._prompts[name] = builder()
+                logger.info(f"Built prompt template '{name}'")
+            return self._prompts[name]
+
+    def loaded(self):
+        return list(self._prompts)
+
+    def clear(self):
+        with self._lock:
+            self._prompts.clear()
+
+
+prompt_registry = PromptRegistry()
+
+
+def get_prompt(name):
+    return prompt_registry.get(name)
@@ -2,6 +2,10 @@ from langchain.prompts import PromptTemplate
 from quality_agent.logger import setup_logger
 from langchain_core.prompts import MessagesPlaceholder
 from langchain_core.prompts import ChatPromptTemplate
+from prompts.inspectionPrompt import sales_schema, sale_query_examples
+from prompts.promptRegistry import render_static, get_present_date
+from models.models import VisualizationPlan
+import json
 
 
 logger = setup_logger(__name__)
@@ -55,7 +59,7 @@ def create_query_generation_prompt():
         [
             (
                 "system",
-                user_query_regenerate_prompt
+                render_static(user_query_regenerate_prompt, collection_schema=sales_schema)
             ),
             MessagesPlaceholder(variable_name="message_history_with_input"),
         ]
@@ -118,8 +122,58 @@ python_code_generation_prompt = """
 
 def create_code_generation_prompt():
     code_generation_prompt_template = PromptTemplate(
-        template=python_code_generation_prompt,
+        template=render_static(python_code_generation_prompt, collection_schema=sales_schema),
         input_variables=["column_names", "number_of_rows",
-                         "sample_record", "collection_schema", "user_query"]
+                         "sample_record", "user_query"]
     )
     return code_generation_prompt_template
+
+
+visualization_plan_prompt = """
+        You are an expert in MongoDB aggregation pipelines and data visualization with Plotly.
+        Based on the conversation history (which is related to visualizing data) and the schema provided,
+        plan the visualization the user asks for in a single answer:
+        1. Rephrase the user query into a plain text question retrieving the data to visualize.
+           Always think and consider if the question is asked for a time series or trend charts.
+        2. Write the aggregation pipeline on the sales collection that returns exactly the data of the chart.
+        3. Describe the chart drawn from the output documents of the pipeline.
+
+        **Collection Schema**:
+        {collection_schema}
+
+        **Pipeline examples**:
+            Input1: {sale_example_query1}
+            Output1: {sale_example_output1}
+
+            Input2: {sale_example_query2}
+            Output2: {sale_example_output2}
+
+        Today's date is {present_date}
+
+        **Output format**:
+        Return a single JSON object matching this JSON schema and nothing else:
+        {plan_schema}
+
+        Important Note:
+        1. The answer must be valid JSON. Write dates as {{"$date": "<ISO 8601 date>"}}, never ISODate(...).
+        2. The chart fields `x`, `y` and `color` must be fields of the pipeline output documents.
+           Use dotted paths for nested fields, e.g. "_id.month" after grouping on a document.
+        3. Project away the fields the chart does not use and sort time series by date.
+        4. If the user asks for a particular chart type use it, otherwise choose the best-fitting one.
+        5. Handle the empty results, arrays and null values properly so that pipeline query doesn't fail.
+        """
+
+
+def create_visualization_plan_prompt():
+    visualization_plan_prompt_template = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                render_static(visualization_plan_prompt, collection_schema=sales_schema,
+                              plan_schema=json.dumps(VisualizationPlan.model_json_schema()),
+                              **sale_query_examples)
+            ),
+            MessagesPlaceholder(variable_name="message_history_with_input"),
+        ]
+    ).partial(present_date=get_present_date)
+    return visualization_plan_prompt_template
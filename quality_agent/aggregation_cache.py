@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+import bson
+from bson import json_util
+from bson.json_util import CANONICAL_JSON_OPTIONS
+from quality_agent.logger import setup_logger
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = setup_logger(__name__)
+
+AGGREGATION_CACHE_ENABLED = os.getenv("AGGREGATION_CACHE_ENABLED", "true") == "true"
+AGGREGATION_CACHE_MAX_BYTES = int(os.getenv("AGGREGATION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Bounds how stale a result gets after a write made outside the application
+AGGREGATION_CACHE_TTL_SECONDS = float(os.getenv("AGGREGATION_CACHE_TTL_SECONDS", "300"))
+
+# Results of these change from one run to the next, or the pipeline writes
+UNCACHEABLE_MARKERS = ('"$sample"', '"$rand"', '"$$NOW"', '"$$CLUSTER_TIME"', '"$out"', '"$merge"', '"$currentDate"')
+
+
+def canonicalize(pipeline):
+    """
+    Canonical Extended JSON of the pipeline, so equal values of different BSON
+    types do not share a key. The fields of `$match` are sorted as their order
+    does not change the result, the order of all other documents does.
+    """
+    stages = []
+    for stage in pipeline:
+        if isinstance(stage, dict) and isinstance(stage.get("$match"), dict) and len(stage) == 1:
+            stage = {"$match": dict(sorted(stage["$match"].items()))}
+        stages.append(stage)
+    return json_util.dumps(stages, json_options=CANONICAL_JSON_OPTIONS)
+
+
+def encode_documents(documents):
+    """BSON of each document, None when one of them cannot be encoded."""
+    try:
+        return [bson.encode(document) for document in documents]
+    except Exception as e:
+        logger.warning(f"Unable to encode the aggregation result: {e}")
+        return None
+
+
+class AggregationResultCache:
+    """
+    Byte-bounded LRU cache of aggregation results keyed by the collection, the
+    row cap and the canonical pipeline. The results are kept BSON-encoded, so
+    each hit gets its own copy of the documents. Writes to a collection
+    invalidate its entries, results computed across a write are not stored.
+    """
+
+    def __init__(self, max_bytes=AGGREGATION_CACHE_MAX_BYTES, ttl_seconds=AGGREGATION_CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_key(self, collection, pipeline, max_rows):
+        """The cache key of the pipeline on `collection`, None when its result must not be cached."""
+        if not AGGREGATION_CACHE_ENABLED:
+            return None
+        try:
+            canonical = canonicalize(pipeline)
+        except Exception as e:
+            logger.warning(f"Unable to canonicalize the pipeline: {e}")
+            return None
+        if any(marker in canonical for marker in UNCACHEABLE_MARKERS):
+            return None
+        return (collection.full_name, max_rows, canonical)
+
+    def generation(self, key):
+        """Write generation of the collection of `key`, taken before running the pipeline."""
+        return self.collection_generation(key[0])
+
+    def collection_generation(self, collection_name):
+        """Number of writes to the collection (`<database>.<collection>`) invalidated so far."""
+        return self._generations[collection_name]
+
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        logger.info(f"Aggregation cache hit on {key[0]}")
+        _, truncated, value = entry
+        # Partial results of a rewritten pipeline are not stored
+        return {"documents": bson.decode_all(value), "truncated": truncated, "max_rows": key[1], "partial": False}
+
+    def store(self, key, generation, result, encoded):
+        """
+        Stores the result, `encoded` holding the BSON of its documents, unless
+        the collection was written to since `generation`.
+        """
+        if encoded is None:
+            return
+        value = b"".join(encoded)
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if self._generations[key[0]] != generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, result["truncated"], value)
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def _remove(self, key):
+        self._size -= len(self._entries.pop(key)[2])
+
+    def invalidate(self, *collection_names):
+        """Drops the results of the collections (`<database>.<collection>`), after a write."""
+        with self._lock:
+            for collection_name in collection_names:
+                self._generations[collection_name] += 1
+                for key in [key for key in self._entries if key[0] == collection_name]:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+aggregation_cache = AggregationResultCache()
@@ -0,0 +1,190 @@
+import asyncio
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from prompts.inspectionPrompt import sales_store_locations, sales_purchase_methods
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true") == "true"
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(
+    os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.85"))
+# How long a data-version stamp is trusted before the collection is checked again
+ANSWER_CACHE_VERSION_TTL_SECONDS = float(
+    os.getenv("ANSWER_CACHE_VERSION_TTL_SECONDS", "30"))
+
+STOPWORDS = {
+    "a", "an", "the", "me", "my", "show", "give", "tell", "list", "display",
+    "what", "which", "is", "are", "was", "were", "of", "in", "at", "for", "on",
+    "please", "can", "you", "could", "i", "want", "to", "see", "get", "and",
+    "all", "with", "from", "by", "do", "does", "how",
+}
+
+# The only words two questions sharing an answer may differ in, every other
+# content token must match exactly
+SYNONYMS = {
+    "avg": "average", "mean": "average",
+    "sum": "total",
+    "maximum": "max", "highest": "max",
+    "minimum": "min", "lowest": "min",
+    "asc": "ascending", "desc": "descending",
+}
+
+# Multi-word values are joined so they survive tokenization as one term
+ENTITY_TERMS = [term.lower() for term in sales_store_locations + sales_purchase_methods]
+
+
+def normalize_question(question):
+    """
+    Lowercases the question, joins multi-word entity values and returns its
+    content tokens with stopwords removed and plurals folded.
+    """
+    text = question.lower()
+    for term in ENTITY_TERMS:
+        if " " in term:
+            text = text.replace(term, term.replace(" ", "_"))
+    tokens = []
+    for token in re.findall(r"[a-z0-9_]+", text):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def fold_synonyms(tokens):
+    return [SYNONYMS.get(token, token) for token in tokens]
+
+
+def get_guard_terms(tokens):
+    """
+    Terms that must match exactly for two questions to share an answer: all
+    content tokens, with the synonyms folded. A single differing word, e.g.
+    "ascending" and "descending" or "M" and "F", changes the answer.
+    """
+    return frozenset(fold_synonyms(tokens))
+
+
+def cosine_similarity(first, second):
+    dot_product = sum(count * second[token] for token, count in first.items())
+    if not dot_product:
+        return 0.0
+    first_norm = math.sqrt(sum(count * count for count in first.values()))
+    second_norm = math.sqrt(sum(count * count for count in second.values()))
+    return dot_product / (first_norm * second_norm)
+
+
+class SemanticAnswerCache:
+    """
+    LRU cache of final answers keyed by the normalized question and the data
+    version of the queried collection. Questions hit the same entry when they
+    have the same guard terms, differing only in stopwords, plurals, word
+    order and synonyms; the token similarity picks among those entries.
+    `get_write_generation`, checked on every lookup, clears the cache after
+    the writes the application sees, `get_data_version` is checked every
+    `version_ttl_seconds` for the other ones.
+    """
+
+    def __init__(self, get_data_version, max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                 similarity_threshold=ANSWER_CACHE_SIMILARITY_THRESHOLD,
+                 version_ttl_seconds=ANSWER_CACHE_VERSION_TTL_SECONDS, get_write_generation=None):
+        self.get_data_version = get_data_version
+        self.get_write_generation = get_write_generation
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.version_ttl_seconds = version_ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._data_version_checked_at = 0.0
+        self._write_generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def current_data_version(self):
+        now = time.monotonic()
+        write_generation = self.get_write_generation() if self.get_write_generation is not None else None
+        if (self._data_version is None or write_generation != self._write_generation
+                or now - self._data_version_checked_at > self.version_ttl_seconds):
+            data_version = (write_generation, self.get_data_version())
+            if data_version != self._data_version:
+                logger.info(f"Data version changed to {data_version}, clearing answer cache")
+                with self._lock:
+                    self._entries.clear()
+            self._data_version = data_version
+            self._data_version_checked_at = now
+            self._write_generation = write_generation
+        return self._data_version
+
+    def lookup(self, question):
+        data_version = self.current_data_version()
+        tokens = normalize_question(question)
+        key = " ".join(sorted(tokens))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._find_similar(tokens)
+            if entry is None or entry["data_version"] != data_version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry["key"])
+            self.hits += 1
+        logger.info(f"Answer cache hit for question: {question}")
+        return entry
+
+    def store(self, question, response, node):
+        data_version = self.current_data_version()
+        tokens = normalize_question(question)
+        if not tokens:
+            return
+        key = " ".join(sorted(tokens))
+        with self._lock:
+            self._entries[key] = {
+                "key": key,
+                "vector": Counter(fold_synonyms(tokens)),
+                "guard_terms": get_guard_terms(tokens),
+                "data_version": data_version,
+                "response": response,
+                "node": node,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    async def alookup(self, question):
+        # The data-version check may hit the database
+        return await asyncio.to_thread(self.lookup, question)
+
+    async def astore(self, question, response, node):
+        await asyncio.to_thread(self.store, question, response, node)
+
+    def _find_similar(self, tokens):
+        vector = Counter(fold_synonyms(tokens))
+        guard_terms = get_guard_terms(tokens)
+        best_entry, best_score = None, self.similarity_threshold
+        for entry in self._entries.values():
+            if entry["guard_terms"] != guard_terms:
+                continue
+            score = cosine_similarity(vector, entry["vector"])
+            if score >= best_score:
+                best_entry, best_score = entry, score
+        return best_entry
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "data_version": self._data_version,
+        }
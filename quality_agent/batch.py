@@ -0,0 +1,51 @@
+import asyncio
+import copy
+from contextvars import ContextVar
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class SingleFlight:
+    """
+    Memoizes async calls by key for the lifetime of a batch. Concurrent callers
+    with the same key share one in-flight call instead of repeating it.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def run(self, key, factory):
+        call = self._calls.get(key)
+        if call is None:
+            self.misses += 1
+            call = asyncio.ensure_future(factory())
+            self._calls[key] = call
+        else:
+            self.hits += 1
+            logger.info(f"Reusing shared result for {key[0]}")
+        try:
+            result = await asyncio.shield(call)
+        except Exception:
+            # Failed calls are not memoized so other items can retry them
+            if self._calls.get(key) is call:
+                del self._calls[key]
+            raise
+        # Callers may mutate the result (e.g. the chart node rewrites `_id`)
+        return copy.deepcopy(result)
+
+
+current_batch = ContextVar("current_batch", default=None)
+
+
+async def deduplicate(namespace, key, factory):
+    """
+    Runs `factory()` once per (namespace, key) within the current batch, or
+    directly when no batch is active.
+    """
+    batch = current_batch.get()
+    if batch is None:
+        return await factory()
+    return await batch.run((namespace, key), factory)
@@ -0,0 +1,284 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import timezone
+from typing import Any, List, Optional
+from bson import json_util
+from bson.json_util import CANONICAL_JSON_OPTIONS
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pymongo.results import InsertOneResult
+from prompts.promptRegistry import get_present_date
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# "record" writes every LLM and Mongo exchange to the cassette, "replay" serves
+# them from it without network access. Empty disables cassettes.
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "")
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "cassettes/workflow.jsonl")
+# Latency injected on replay. Empty replays the recorded latency multiplied by
+# CASSETTE_LATENCY_SCALE, a number of milliseconds replaces it.
+CASSETTE_LLM_LATENCY_MS = os.getenv("CASSETTE_LLM_LATENCY_MS", "")
+CASSETTE_MONGO_LATENCY_MS = os.getenv("CASSETTE_MONGO_LATENCY_MS", "")
+CASSETTE_LATENCY_SCALE = float(os.getenv("CASSETTE_LATENCY_SCALE", "1.0"))
+
+CASSETTE_MODES = ("record", "replay")
+
+
+class CassetteMissError(LookupError):
+    """Raised on replay when the cassette holds no response for a request."""
+
+
+def get_request_key(kind, request):
+    text = json.dumps(request, default=str)
+    # Prompts embed the current date, mask it so a cassette replays on later days
+    for present_date in {get_present_date(), get_present_date(timezone.utc)}:
+        text = text.replace(present_date, "<present_date>")
+    return hashlib.sha256(f"{kind}\x00{text}".encode("utf-8")).hexdigest()
+
+
+def get_message_request(message):
+    """Request representation of a message without its generated ids."""
+    request = {"type": message.type, "content": message.content}
+    tool_calls = getattr(message, "tool_calls", None)
+    if tool_calls:
+        request["tool_calls"] = [{"name": call["name"], "args": call["args"]} for call in tool_calls]
+    return request
+
+
+def get_mongo_request(*values):
+    return json.loads(json_util.dumps(values, json_options=CANONICAL_JSON_OPTIONS))
+
+
+class Cassette:
+    """
+    JSONL file of recorded exchanges, one line per request with its response
+    and latency. Identical requests recorded several times are replayed in
+    the recorded order, cycling when exhausted.
+    """
+
+    def __init__(self, path, mode, llm_latency_ms=CASSETTE_LLM_LATENCY_MS,
+                 mongo_latency_ms=CASSETTE_MONGO_LATENCY_MS, latency_scale=CASSETTE_LATENCY_SCALE):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unknown cassette mode '{mode}', expected one of {CASSETTE_MODES}")
+        self.path = path
+        self.mode = mode
+        self.latencies_ms = {"llm": llm_latency_ms, "mongo": mongo_latency_ms}
+        self.latency_scale = latency_scale
+        self._entries = defaultdict(list)
+        self._positions = defaultdict(int)
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        if mode == "replay":
+            self._load()
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        logger.info(f"Cassette {mode} mode using {path}")
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry["key"]].append(entry)
+        except FileNotFoundError:
+            logger.error(f"Cassette {self.path} not found, record it first with CASSETTE_MODE=record")
+            raise
+        logger.info(f"Loaded {sum(len(entries) for entries in self._entries.values())} cassette entries")
+
+    def record(self, kind, request, response, latency):
+        entry = {"key": get_request_key(kind, request), "kind": kind, "request": request,
+                 "response": response, "latency": latency}
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+            self.recorded += 1
+
+    def replay(self, kind, request):
+        key = get_request_key(kind, request)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.misses += 1
+                raise CassetteMissError(f"No recorded {kind} response for request {json.dumps(request, default=str)[:300]}")
+            entry = entries[self._positions[key] % len(entries)]
+            self._positions[key] += 1
+            self.replayed += 1
+        return entry
+
+    def get_latency(self, entry):
+        """Seconds to wait before returning a replayed response."""
+        latency_ms = self.latencies_ms["llm" if entry["kind"] == "llm" else "mongo"]
+        if latency_ms:
+            return float(latency_ms) / 1000
+        return entry["latency"] * self.latency_scale
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "path": self.path,
+            "entries": sum(len(entries) for entries in self._entries.values()),
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "misses": self.misses,
+        }
+
+
+class CassetteChatModel(BaseChatModel):
+    """
+    Chat model that records the exchanges of the wrapped provider model, or
+    replays them without building the provider at all.
+    """
+
+    provider: str
+    cassette: Any
+    model: Optional[Any] = None
+    tools: List[str] = []
+
+    @property
+    def _llm_type(self):
+        return "cassette"
+
+    @property
+    def _identifying_params(self):
+        return {"provider": self.provider, "tools": self.tools}
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={
+            "model": self.model.bind_tools(tools, **kwargs) if self.model is not None else None,
+            "tools": [convert_to_openai_tool(tool)["function"]["name"] for tool in tools],
+        })
+
+    def _get_request(self, messages, stop):
+        return {"provider": self.provider, "tools": self.tools, "stop": stop,
+                "messages": [get_message_request(message) for message in messages]}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        request = self._get_request(messages, stop)
+        if self.cassette.replaying:
+            entry = self.cassette.replay("llm", request)
+            time.sleep(self.cassette.get_latency(entry))
+            return ChatResult(generations=[ChatGeneration(message=loads(entry["response"]))])
+        start = time.perf_counter()
+        message = self.model.invoke(messages, stop=stop, **kwargs)
+        self.cassette.record("llm", request, dumps(message), time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        request = self._get_request(messages, stop)
+        if self.cassette.replaying:
+            entry = self.cassette.replay("llm", request)
+            await asyncio.sleep(self.cassette.get_latency(entry))
+            return ChatResult(generations=[ChatGeneration(message=loads(entry["response"]))])
+        start = time.perf_counter()
+        message = await self.model.ainvoke(messages, stop=stop, **kwargs)
+        self.cassette.record("llm", request, dumps(message), time.perf_counter() - start)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class ReplayCursor:
+    """Cursor over recorded aggregation results, usable like a PyMongo command cursor."""
+
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._documents)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+
+class CassetteCollection:
+    """
+    Proxy of a PyMongo collection recording or replaying the operations the
+    workflow issues. Other attributes go to the real collection.
+    """
+
+    def __init__(self, collection, cassette):
+        self.collection = collection
+        self.cassette = cassette
+        self.full_name = collection.full_name
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def _call(self, operation, request, run):
+        request = {"collection": self.full_name, "operation": operation, "arguments": request}
+        if self.cassette.replaying:
+            entry = self.cassette.replay("mongo", request)
+            time.sleep(self.cassette.get_latency(entry))
+            return json_util.loads(entry["response"])
+        start = time.perf_counter()
+        result = run()
+        self.cassette.record(
+            "mongo", request, json_util.dumps(result, json_options=CANONICAL_JSON_OPTIONS),
+            time.perf_counter() - start)
+        return result
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        # Recorded results are read in full, they are already bounded by the row cap
+        def run():
+            with self.collection.aggregate(pipeline, *args, **kwargs) as cursor:
+                return list(cursor)
+        return ReplayCursor(self._call("aggregate", get_mongo_request(pipeline), run))
+
+    def insert_one(self, document, *args, **kwargs):
+        request = get_mongo_request(document)
+        inserted_id = self._call(
+            "insert_one", request, lambda: self.collection.insert_one(document, *args, **kwargs).inserted_id)
+        document.setdefault("_id", inserted_id)
+        return InsertOneResult(inserted_id, acknowledged=True)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        return self._call(
+            "find_one", get_mongo_request(filter, kwargs), lambda: self.collection.find_one(filter, *args, **kwargs))
+
+    def estimated_document_count(self, **kwargs):
+        return self._call(
+            "estimated_document_count", get_mongo_request(kwargs),
+            lambda: self.collection.estimated_document_count(**kwargs))
+
+
+class CassetteDatabase:
+    """Proxy of a PyMongo database whose collections record or replay through the cassette."""
+
+    def __init__(self, database, cassette):
+        self.database = database
+        self.cassette = cassette
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+    def __getitem__(self, name):
+        return self.get_collection(name)
+
+    def get_collection(self, name, **kwargs):
+        return CassetteCollection(self.database.get_collection(name, **kwargs), self.cassette)
+
+
+cassette = Cassette(CASSETTE_PATH, CASSETTE_MODE) if CASSETTE_MODE else None
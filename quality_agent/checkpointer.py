@@ -0,0 +1,211 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from langgraph.checkpoint.base import BaseCheckpointSaver
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+CHECKPOINTER_BACKEND = os.getenv("CHECKPOINTER_BACKEND", "memory")
+CHECKPOINTER_SQLITE_PATH = os.getenv("CHECKPOINTER_SQLITE_PATH", "checkpoints.sqlite")
+CHECKPOINTER_MAX_THREADS = int(os.getenv("CHECKPOINTER_MAX_THREADS", "1000"))
+CHECKPOINTER_TTL_SECONDS = float(os.getenv("CHECKPOINTER_TTL_SECONDS", "86400"))
+# Only the latest checkpoints of a conversation are needed to resume it
+CHECKPOINTER_MAX_CHECKPOINTS_PER_THREAD = int(
+    os.getenv("CHECKPOINTER_MAX_CHECKPOINTS_PER_THREAD", "10"))
+
+
+class BoundedMemorySaver(MemorySaver):
+    """
+    In-memory checkpointer that evicts whole conversations by LRU order and TTL,
+    and keeps only the most recent checkpoints of each conversation.
+    """
+
+    def __init__(self, max_threads=CHECKPOINTER_MAX_THREADS,
+                 ttl_seconds=CHECKPOINTER_TTL_SECONDS,
+                 max_checkpoints_per_thread=CHECKPOINTER_MAX_CHECKPOINTS_PER_THREAD):
+        super().__init__()
+        self.max_threads = max_threads
+        self.ttl_seconds = ttl_seconds
+        self.max_checkpoints_per_thread = max_checkpoints_per_thread
+        self._last_access = OrderedDict()
+        self._access_lock = threading.RLock()
+
+    def get_tuple(self, config):
+        self._touch(config["configurable"]["thread_id"])
+        return super().get_tuple(config)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        with self._access_lock:
+            next_config = super().put(config, checkpoint, metadata, new_versions)
+            self._trim_thread(thread_id, checkpoint_ns)
+        self._touch(thread_id)
+        return next_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        self._touch(config["configurable"]["thread_id"])
+        return super().put_writes(config, writes, task_id, task_path)
+
+    # The async variants of MemorySaver call the sync methods above, so they
+    # are covered without being overridden.
+
+    def _touch(self, thread_id):
+        with self._access_lock:
+            self._last_access[thread_id] = time.monotonic()
+            self._last_access.move_to_end(thread_id)
+            self._evict()
+
+    def _evict(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._last_access:
+            thread_id, last_access = next(iter(self._last_access.items()))
+            if last_access >= cutoff and len(self._last_access) <= self.max_threads:
+                break
+            self._last_access.pop(thread_id)
+            self.delete_thread(thread_id)
+            logger.info(f"Evicted conversation thread: {thread_id}")
+
+    def _trim_thread(self, thread_id, checkpoint_ns):
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        if len(checkpoints) <= self.max_checkpoints_per_thread:
+            return
+
+        # Checkpoint ids are time ordered, so the oldest ones sort first
+        checkpoint_ids = sorted(checkpoints)
+        stale_ids = checkpoint_ids[:-self.max_checkpoints_per_thread]
+        for checkpoint_id in stale_ids:
+            del checkpoints[checkpoint_id]
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+        # Drop the channel values that no retained checkpoint points to anymore
+        referenced_versions = set()
+        for saved_checkpoint, _, _ in checkpoints.values():
+            channel_versions = self.serde.loads_typed(saved_checkpoint)["channel_versions"]
+            referenced_versions.update(channel_versions.items())
+        for key in list(self.blobs.keys()):
+            if key[0] == thread_id and key[1] == checkpoint_ns and (key[2], key[3]) not in referenced_versions:
+                del self.blobs[key]
+
+
+def _get_async_sqlite_saver_class():
+    # Imported lazily so the sqlite extra is only required when it is selected
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+    class BoundedAsyncSqliteSaver(AsyncSqliteSaver):
+        """
+        On-disk checkpointer that survives restarts. Conversations are evicted by
+        LRU order and TTL and only their most recent checkpoints are kept.
+        """
+
+        def __init__(self, conn, max_threads=CHECKPOINTER_MAX_THREADS,
+                     ttl_seconds=CHECKPOINTER_TTL_SECONDS,
+                     max_checkpoints_per_thread=CHECKPOINTER_MAX_CHECKPOINTS_PER_THREAD,
+                     eviction_interval=100):
+            # AsyncSqliteSaver binds to the running loop in its constructor, but the
+            # graph is compiled at import time, so the loop is captured in `setup`.
+            BaseCheckpointSaver.__init__(self)
+            self.jsonplus_serde = JsonPlusSerializer()
+            self.conn = conn
+            self.lock = asyncio.Lock()
+            self.loop = None
+            self.is_setup = False
+            self.max_threads = max_threads
+            self.ttl_seconds = ttl_seconds
+            self.max_checkpoints_per_thread = max_checkpoints_per_thread
+            self.eviction_interval = eviction_interval
+            self._puts_since_eviction = 0
+
+        async def setup(self):
+            if self.is_setup:
+                return
+            self.loop = asyncio.get_running_loop()
+            await super().setup()
+            async with self.lock:
+                await self.conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS thread_access (
+                        thread_id TEXT PRIMARY KEY,
+                        last_access REAL NOT NULL
+                    );
+                    """
+                )
+                await self.conn.commit()
+
+        async def aput(self, config, checkpoint, metadata, new_versions):
+            next_config = await super().aput(config, checkpoint, metadata, new_versions)
+            async with self.lock:
+                await self.conn.execute(
+                    "INSERT INTO thread_access (thread_id, last_access) VALUES (?, ?) "
+                    "ON CONFLICT(thread_id) DO UPDATE SET last_access = excluded.last_access",
+                    (str(config["configurable"]["thread_id"]), time.time()),
+                )
+                await self.conn.commit()
+
+            self._puts_since_eviction += 1
+            if self._puts_since_eviction >= self.eviction_interval:
+                self._puts_since_eviction = 0
+                await self.aevict()
+            return next_config
+
+        async def aevict(self):
+            cutoff = time.time() - self.ttl_seconds
+            async with self.lock:
+                async with self.conn.execute(
+                    "SELECT thread_id FROM thread_access WHERE last_access < ? "
+                    "UNION SELECT thread_id FROM ("
+                    "SELECT thread_id FROM thread_access ORDER BY last_access DESC "
+                    "LIMIT -1 OFFSET ?)",
+                    (cutoff, self.max_threads),
+                ) as cursor:
+                    evicted = [row[0] for row in await cursor.fetchall()]
+
+                for thread_id in evicted:
+                    for table in ("checkpoints", "writes", "thread_access"):
+                        await self.conn.execute(
+                            f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+                for table in ("checkpoints", "writes"):
+                    await self.conn.execute(
+                        f"""
+                        DELETE FROM {table} WHERE checkpoint_id NOT IN (
+                            SELECT checkpoint_id FROM (
+                                SELECT checkpoint_id, ROW_NUMBER() OVER (
+                                    PARTITION BY thread_id, checkpoint_ns
+                                    ORDER BY checkpoint_id DESC) AS position
+                                FROM checkpoints
+                            ) WHERE position <= ?
+                        )
+                        """,
+                        (self.max_checkpoints_per_thread,),
+                    )
+                await self.conn.commit()
+            if evicted:
+                logger.info(f"Evicted {len(evicted)} conversation threads from sqlite")
+
+    return BoundedAsyncSqliteSaver
+
+
+def get_checkpointer(backend=CHECKPOINTER_BACKEND):
+    """
+    Returns the checkpointer selected with `CHECKPOINTER_BACKEND` (`memory` or `sqlite`).
+    """
+    try:
+        logger.info(f"Creating {backend} checkpointer")
+        if backend == "memory":
+            return BoundedMemorySaver()
+        elif backend == "sqlite":
+            import aiosqlite
+
+            saver_class = _get_async_sqlite_saver_class()
+            return saver_class(aiosqlite.connect(CHECKPOINTER_SQLITE_PATH))
+        raise ValueError(f"Unknown checkpointer backend: {backend}")
+    except Exception as e:
+        logger.error(f"Error creating checkpointer: {e}")
+        raise
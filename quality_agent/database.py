@@ -0,0 +1,185 @@
+import os
+import threading
+from bson.codec_options import CodecOptions, TypeDecoder, TypeRegistry
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from pymongo import AsyncMongoClient, MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+from quality_agent.cassette import CassetteDatabase, cassette
+from quality_agent.logger import setup_logger
+from quality_agent.metrics import (
+    METRICS_ENABLED, MONGO_POOL_WAIT, MONGO_POOL_CHECKED_OUT, MONGO_POOL_CONNECTIONS)
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = setup_logger(__name__)
+
+MONGODB_CONNECTION_STRING = os.getenv("MONGODB_CONNECTION_STRING")
+MONGODB_DATABASE_NAME = os.getenv("MONGODB_DATABASE_NAME")
+MONGODB_SALES_DATABASE_NAME = os.getenv("MONGODB_SALES_DATABASE_NAME")
+# Connection pool of the shared client, per server
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "100"))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", "0"))
+MONGODB_MAX_IDLE_TIME_MS = int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "0")) or None
+# Longest wait for a free connection when the pool is exhausted, 0 waits forever
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "0")) or None
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "30000"))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "20000"))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "0")) or None
+# e.g. "secondaryPreferred" to send the read-only aggregations to secondaries
+MONGODB_READ_PREFERENCE = os.getenv("MONGODB_READ_PREFERENCE", "primary")
+# The async request path uses PyMongo's asyncio driver instead of running the
+# blocking driver in worker threads. Not used while cassettes are enabled.
+MONGODB_ASYNC_ENABLED = os.getenv("MONGODB_ASYNC_ENABLED", "false") == "true"
+
+
+class Decimal128Decoder(TypeDecoder):
+    """Decodes Decimal128 values (e.g. item prices) to float while reading BSON."""
+    bson_type = Decimal128
+
+    def transform_bson(self, value):
+        return float(value.to_decimal())
+
+
+class ObjectIdDecoder(TypeDecoder):
+    """Decodes ObjectId values to str so results are JSON and chart friendly."""
+    bson_type = ObjectId
+
+    def transform_bson(self, value):
+        return str(value)
+
+
+# Result documents are converted by the driver during BSON decoding instead of
+# being copied again in Python afterwards
+codec_options = CodecOptions(
+    type_registry=TypeRegistry([Decimal128Decoder(), ObjectIdDecoder()]))
+
+
+class PoolMetricsListener(ConnectionPoolListener):
+    """Records how long operations wait for a pooled connection and how many are in use."""
+
+    def __init__(self, client_name):
+        self.client_name = client_name
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self.client_name).inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self.client_name).dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_WAIT.labels(self.client_name, event.reason).observe(event.duration)
+
+    def connection_checked_out(self, event):
+        MONGO_POOL_WAIT.labels(self.client_name, "success").observe(event.duration)
+        MONGO_POOL_CHECKED_OUT.labels(self.client_name).inc()
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_CHECKED_OUT.labels(self.client_name).dec()
+
+
+def get_client_options(client_name):
+    options = {
+        "maxPoolSize": MONGODB_MAX_POOL_SIZE,
+        "minPoolSize": MONGODB_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGODB_MAX_IDLE_TIME_MS,
+        "waitQueueTimeoutMS": MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": MONGODB_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": MONGODB_SOCKET_TIMEOUT_MS,
+        "readPreference": MONGODB_READ_PREFERENCE,
+        # Connect on the first operation, not when the client is created
+        "connect": False,
+    }
+    if METRICS_ENABLED:
+        options["event_listeners"] = [PoolMetricsListener(client_name)]
+    return options
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client():
+    """The MongoClient shared by the whole process, created on first use."""
+    client = _clients.get("sync")
+    if client is None:
+        with _clients_lock:
+            if "sync" not in _clients:
+                logger.info(f"Creating MongoDB client (max pool size {MONGODB_MAX_POOL_SIZE})")
+                _clients["sync"] = MongoClient(MONGODB_CONNECTION_STRING, **get_client_options("sync"))
+            client = _clients["sync"]
+    return client
+
+
+def get_async_client():
+    """
+    The AsyncMongoClient shared by the async request path, created on first
+    use. It is bound to the event loop of the application.
+    """
+    client = _clients.get("async")
+    if client is None:
+        with _clients_lock:
+            if "async" not in _clients:
+                logger.info(f"Creating async MongoDB client (max pool size {MONGODB_MAX_POOL_SIZE})")
+                _clients["async"] = AsyncMongoClient(MONGODB_CONNECTION_STRING, **get_client_options("async"))
+            client = _clients["async"]
+    return client
+
+
+def use_async_client():
+    """Whether the async request path reads through the asyncio driver."""
+    return MONGODB_ASYNC_ENABLED and cassette is None
+
+
+def get_database(client, name):
+    """
+    Returns the database with the shared codec options applied to all of its
+    collections. With cassettes enabled, its operations are recorded or replayed.
+    """
+    database = client.get_database(name, codec_options=codec_options)
+    if cassette is not None:
+        return CassetteDatabase(database, cassette)
+    return database
+
+
+def get_app_db():
+    return get_database(get_client(), MONGODB_DATABASE_NAME)
+
+
+def get_sales_db():
+    return get_database(get_client(), MONGODB_SALES_DATABASE_NAME)
+
+
+def get_async_sales_db():
+    return get_async_client().get_database(MONGODB_SALES_DATABASE_NAME, codec_options=codec_options)
+
+
+async def close_clients():
+    """Closes the shared clients, on application shutdown."""
+    with _clients_lock:
+        clients = dict(_clients)
+        _clients.clear()
+    if "sync" in clients:
+        clients["sync"].close()
+    if "async" in clients:
+        await clients["async"].close()
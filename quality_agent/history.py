@@ -0,0 +1,185 @@
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from langchain_core.messages import SystemMessage
+from quality_agent.logger import setup_logger
+from quality_agent.rate_limiter import CHARACTERS_PER_TOKEN
+
+logger = setup_logger(__name__)
+
+# Upper bound of the messages kept in the graph state of a thread
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "200"))
+HISTORY_SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY_ENABLED", "true") == "true"
+# Summaries cover prefixes of a multiple of this many messages, so consecutive
+# turns of a conversation reuse the same summary
+HISTORY_SUMMARY_BLOCK_MESSAGES = int(os.getenv("HISTORY_SUMMARY_BLOCK_MESSAGES", "6"))
+# Part of a node's budget kept free for the summary message
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "300"))
+HISTORY_SUMMARY_CACHE_SIZE = int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", "1024"))
+
+# Node -> (token budget of its history view, whether older turns are summarized).
+# The router only needs the last turns to resolve follow-up questions.
+NODE_HISTORY_BUDGETS = {
+    "router": (int(os.getenv("HISTORY_BUDGET_ROUTER", "512")), False),
+    "inspection": (int(os.getenv("HISTORY_BUDGET_INSPECTION", "2048")), True),
+    "visualization": (int(os.getenv("HISTORY_BUDGET_VISUALIZATION", "1024")), True),
+    "analyze_plot": (int(os.getenv("HISTORY_BUDGET_ANALYZE_PLOT", "2048")), True),
+}
+HISTORY_DEFAULT_BUDGET = int(os.getenv("HISTORY_DEFAULT_BUDGET", "2048"))
+
+# Tokens added by the chat format around each message
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+@lru_cache(maxsize=4096)
+def count_text_tokens(text):
+    return max(1, len(text) // CHARACTERS_PER_TOKEN)
+
+
+def get_message_text(message):
+    content = getattr(message, "content", message)
+    if isinstance(content, str):
+        return content
+    # Multimodal content, only the text parts are counted
+    return " ".join(
+        part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+
+
+def count_message_tokens(message):
+    return count_text_tokens(get_message_text(message)) + MESSAGE_TOKEN_OVERHEAD
+
+
+def add_messages_capped(left, right):
+    """
+    Reducer of `MultiAgentState.messages`: appends the new messages and keeps
+    at most `HISTORY_MAX_MESSAGES` of them.
+    """
+    if not isinstance(right, (list, tuple)):
+        right = [right]
+    messages = list(left or []) + list(right)
+    if HISTORY_MAX_MESSAGES and len(messages) > HISTORY_MAX_MESSAGES:
+        messages = messages[-HISTORY_MAX_MESSAGES:]
+    return messages
+
+
+def get_prefix_keys(messages):
+    """Returns the key of every prefix of the conversation, `keys[i]` identifies `messages[:i]`."""
+    keys = [""]
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(getattr(message, "type", "").encode("utf-8"))
+        digest.update(b"\x00")
+        digest.update(get_message_text(message).encode("utf-8"))
+        digest.update(b"\x00")
+        keys.append(digest.copy().hexdigest())
+    return keys
+
+
+def summarize_messages(previous_summary, messages):
+    from prompts.promptRegistry import get_prompt
+    from quality_agent.llmManager import get_llm_manager
+
+    chain = get_prompt("history_summary") | get_llm_manager().llm
+    response = chain.invoke({"previous_summary": previous_summary, "messages": messages})
+    return response.content
+
+
+class HistoryManager:
+    """
+    Builds the conversation history each node sends to its LLM: the newest
+    messages within the node's token budget, preceded by a summary of the
+    older ones. Summaries are computed in the background and cached by the
+    content of the summarized prefix, so a turn never waits for one.
+    """
+
+    def __init__(self, budgets=NODE_HISTORY_BUDGETS, summarizer=summarize_messages,
+                 summary_enabled=HISTORY_SUMMARY_ENABLED, block=HISTORY_SUMMARY_BLOCK_MESSAGES):
+        self.budgets = budgets
+        self.summarizer = summarizer
+        self.summary_enabled = summary_enabled
+        self.block = block
+        self._summaries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+
+    def get_view(self, messages, node):
+        messages = list(messages)
+        budget, summarize = self.budgets.get(node, (HISTORY_DEFAULT_BUDGET, True))
+        tokens = [count_message_tokens(message) for message in messages]
+        if sum(tokens) <= budget or len(messages) < 2:
+            return messages
+
+        summarize = summarize and self.summary_enabled
+        available = budget - (HISTORY_SUMMARY_MAX_TOKENS if summarize else 0)
+        # The newest message is always kept, it holds the current question
+        start = len(messages) - 1
+        used = tokens[start]
+        while start > 0 and used + tokens[start - 1] <= available:
+            start -= 1
+            used += tokens[start]
+        if not summarize:
+            return messages[start:]
+
+        # Align the window to a block so the summarized prefix stays the same
+        # for several turns
+        boundary = min(math.ceil(start / self.block) * self.block, len(messages) - 1)
+        keys = get_prefix_keys(messages[:boundary])
+        summary = self._get_summary(messages, keys, boundary)
+        if summary is None:
+            return messages[start:]
+        # A fallback summary covers a shorter prefix, the messages after it
+        # are kept as far as the budget allows
+        end, summary = summary
+        window = messages[max(start, end):]
+        # Keep the view within budget even if the summary came out too long
+        summary = summary[-HISTORY_SUMMARY_MAX_TOKENS * CHARACTERS_PER_TOKEN:]
+        return [SystemMessage(f"Summary of the earlier conversation:\n{summary}")] + window
+
+    def _get_summary(self, messages, keys, boundary):
+        """Returns (end, summary of `messages[:end]`) or None, summarizing the prefix in the background."""
+        with self._lock:
+            summary = self._summaries.get(keys[boundary])
+            if summary is not None:
+                self._summaries.move_to_end(keys[boundary])
+                return boundary, summary
+            # Until it is ready, the latest summary of a shorter prefix is used
+            fallback = None
+            for end in range(boundary - self.block, 0, -self.block):
+                if keys[end] in self._summaries:
+                    fallback = (end, self._summaries[keys[end]])
+                    break
+            if keys[boundary] not in self._pending:
+                start, previous_summary = fallback or (0, "")
+                self._pending[keys[boundary]] = self._executor.submit(
+                    self._summarize, keys[boundary], previous_summary, messages[start:boundary])
+        return fallback
+
+    def _summarize(self, key, previous_summary, messages):
+        try:
+            summary = self.summarizer(previous_summary, messages)
+            with self._lock:
+                self._summaries[key] = summary
+                while len(self._summaries) > HISTORY_SUMMARY_CACHE_SIZE:
+                    self._summaries.popitem(last=False)
+        except Exception as e:
+            logger.warning(f"Unable to summarize conversation history: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def wait_for_summaries(self, timeout=None):
+        with self._lock:
+            pending = list(self._pending.values())
+        wait(pending, timeout=timeout)
+
+
+history_manager = HistoryManager()
+
+
+def get_history_view(messages, node):
+    return history_manager.get_view(messages, node)
@@ -0,0 +1,273 @@
+import os
+import threading
+import time
+from collections import Counter
+from quality_agent.cassette import cassette
+from quality_agent.database import get_client
+from quality_agent.logger import setup_logger
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = setup_logger(__name__)
+
+INDEX_ADVISOR_ENABLED = os.getenv("INDEX_ADVISOR_ENABLED", "true") == "true"
+# Opt-in: create the recommended indexes once they are seen often enough
+INDEX_ADVISOR_AUTO_CREATE = os.getenv("INDEX_ADVISOR_AUTO_CREATE", "false") == "true"
+# Executions of a query shape before its index is recommended
+INDEX_ADVISOR_MIN_OCCURRENCES = int(os.getenv("INDEX_ADVISOR_MIN_OCCURRENCES", "5"))
+# Indexes the advisor creates at most per collection
+INDEX_ADVISOR_MAX_INDEXES = int(os.getenv("INDEX_ADVISOR_MAX_INDEXES", "5"))
+# Distinct query shapes kept per collection, new ones are ignored beyond it
+INDEX_ADVISOR_MAX_SHAPES = int(os.getenv("INDEX_ADVISOR_MAX_SHAPES", "500"))
+# Seconds the existing indexes of a collection are reused by the report
+INDEX_ADVISOR_INDEX_TTL_SECONDS = float(os.getenv("INDEX_ADVISOR_INDEX_TTL_SECONDS", "300"))
+
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte", "$ne", "$nin", "$regex", "$exists", "$not", "$elemMatch", "$all"}
+EQUALITY_OPERATORS = {"$eq", "$in"}
+
+
+def get_match_fields(match, equality, ranges):
+    """Sorts the fields of a `$match` document into equality and range predicates."""
+    for field, condition in match.items():
+        if field == "$and":
+            for clause in condition:
+                get_match_fields(clause, equality, ranges)
+        elif field.startswith("$"):
+            # $or, $nor and $expr cannot use a single compound index
+            continue
+        elif isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+            operators = set(condition)
+            if operators & RANGE_OPERATORS:
+                ranges.add(field)
+            elif operators & EQUALITY_OPERATORS:
+                equality.add(field)
+        else:
+            equality.add(field)
+
+
+def get_pipeline_keys(pipeline):
+    """
+    Fields of the leading `$match` and `$sort` stages, the only ones an index
+    can serve, and the `$group` keys. Returns (equality, sort, range, group).
+    """
+    equality, ranges, sort, group = set(), set(), [], []
+    leading = True
+    for stage in pipeline:
+        name, body = next(iter(stage.items()))
+        if leading and name == "$match" and isinstance(body, dict):
+            get_match_fields(body, equality, ranges)
+            continue
+        if leading and name == "$sort" and isinstance(body, dict):
+            sort.extend((field, 1 if direction == 1 else -1) for field, direction in body.items()
+                        if isinstance(direction, int))
+            leading = False
+            continue
+        leading = False
+        if name == "$group" and isinstance(body, dict):
+            group_id = body.get("_id")
+            if isinstance(group_id, str) and group_id.startswith("$"):
+                group.append(group_id[1:])
+            elif isinstance(group_id, dict):
+                group.extend(value[1:] for value in group_id.values()
+                             if isinstance(value, str) and value.startswith("$"))
+    ranges -= equality
+    return sorted(equality), sort, sorted(ranges), group
+
+
+def get_candidate_index(equality, sort, ranges):
+    """Compound index keys in Equality, Sort, Range order."""
+    keys = [(field, 1) for field in equality]
+    keys += [(field, direction) for field, direction in sort if field not in equality]
+    keys += [(field, 1) for field in ranges if field not in equality and field not in dict(sort)]
+    return tuple(keys)
+
+
+def is_prefix(keys, index_keys):
+    return len(keys) <= len(index_keys) and tuple(index_keys[:len(keys)]) == tuple(keys)
+
+
+class ShapeStats:
+    """Executions of one candidate index, split at the time its index was created."""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.count = 0
+        self.before = [0, 0.0]
+        self.after = [0, 0.0]
+        self.created_at = None
+
+    def add(self, seconds):
+        self.count += 1
+        period = self.after if self.created_at is not None else self.before
+        period[0] += 1
+        period[1] += seconds
+
+    def report(self):
+        def mean_ms(period):
+            return round(period[1] / period[0] * 1000, 2) if period[0] else None
+        return {
+            "keys": [list(key) for key in self.keys],
+            "executions": self.count,
+            "mean_ms_before": mean_ms(self.before),
+            "mean_ms_after": mean_ms(self.after),
+            "created_at": self.created_at,
+        }
+
+
+class IndexAdvisor:
+    """
+    Records the filter, sort and group keys of the executed pipelines with
+    their execution time, and turns the frequent ones into compound index
+    recommendations per collection. With `auto_create` the recommended
+    indexes are built in the background and the report compares the mean
+    latency of the pipelines before and after.
+    """
+
+    def __init__(self, min_occurrences=INDEX_ADVISOR_MIN_OCCURRENCES, auto_create=INDEX_ADVISOR_AUTO_CREATE,
+                 max_indexes=INDEX_ADVISOR_MAX_INDEXES, max_shapes=INDEX_ADVISOR_MAX_SHAPES,
+                 index_ttl=INDEX_ADVISOR_INDEX_TTL_SECONDS, client=None):
+        self.min_occurrences = min_occurrences
+        self.auto_create = auto_create
+        self.max_indexes = max_indexes
+        self.max_shapes = max_shapes
+        self.index_ttl = index_ttl
+        # Defaults to the shared MongoClient
+        self.client = client
+        self._shapes = {}
+        self._groups = {}
+        self._indexes = {}
+        self._created = Counter()
+        self._creating = set()
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.ignored = 0
+        self.created = 0
+
+    def record(self, collection_name, pipeline, seconds):
+        """Records an executed pipeline of `collection_name` (`<database>.<collection>`)."""
+        if not INDEX_ADVISOR_ENABLED:
+            return
+        try:
+            equality, sort, ranges, group = get_pipeline_keys(pipeline)
+        except Exception as e:
+            logger.warning(f"Unable to read the keys of the pipeline: {e}")
+            return
+        keys = get_candidate_index(equality, sort, ranges)
+        with self._lock:
+            self._groups.setdefault(collection_name, Counter()).update(group)
+            if not keys:
+                self.ignored += 1
+                return
+            shapes = self._shapes.setdefault(collection_name, {})
+            stats = shapes.get(keys)
+            if stats is None:
+                if len(shapes) >= self.max_shapes:
+                    self.ignored += 1
+                    return
+                stats = shapes[keys] = ShapeStats(keys)
+            stats.add(seconds)
+            self.recorded += 1
+            create = (self.auto_create and stats.count >= self.min_occurrences and stats.created_at is None
+                      and self._created[collection_name] < self.max_indexes
+                      and (collection_name, keys) not in self._creating)
+        if create:
+            self._create_in_background(collection_name)
+
+    def _get_collection(self, collection_name):
+        database_name, name = collection_name.split(".", 1)
+        return (self.client or get_client())[database_name][name]
+
+    def get_existing_indexes(self, collection_name):
+        """Key lists of the indexes of the collection, read at most every `index_ttl` seconds."""
+        with self._lock:
+            entry = self._indexes.get(collection_name)
+        if entry and time.monotonic() - entry[1] < self.index_ttl:
+            return entry[0]
+        # Text, 2dsphere and hashed keys keep their type, they serve none of the candidate keys
+        indexes = [tuple((field, direction if isinstance(direction, str) else int(direction))
+                         for field, direction in index["key"])
+                   for index in self._get_collection(collection_name).index_information().values()]
+        with self._lock:
+            self._indexes[collection_name] = (indexes, time.monotonic())
+        return indexes
+
+    def recommend(self, collection_name):
+        """Recommended index keys of the collection, the most time-consuming shapes first."""
+        with self._lock:
+            shapes = sorted(self._shapes.get(collection_name, {}).values(),
+                            key=lambda stats: stats.before[1] + stats.after[1], reverse=True)
+            frequent = [stats for stats in shapes if stats.count >= self.min_occurrences and stats.created_at is None]
+        try:
+            existing = self.get_existing_indexes(collection_name)
+        except Exception as e:
+            logger.warning(f"Unable to read the indexes of {collection_name}: {e}")
+            existing = []
+        recommended = []
+        for stats in frequent:
+            if any(is_prefix(stats.keys, index) for index in existing):
+                continue
+            # A recommended index whose keys extend these serves both shapes
+            if any(is_prefix(stats.keys, other.keys) for other in frequent if other is not stats):
+                continue
+            recommended.append(stats)
+        return recommended[:self.max_indexes]
+
+    def create_recommended(self, collection_name):
+        """Creates the recommended indexes of the collection, returns their names."""
+        if cassette is not None and cassette.replaying:
+            return []
+        names = []
+        for stats in self.recommend(collection_name)[:max(self.max_indexes - self._created[collection_name], 0)]:
+            with self._lock:
+                if (collection_name, stats.keys) in self._creating:
+                    continue
+                self._creating.add((collection_name, stats.keys))
+            try:
+                name = "advisor_" + "_".join(f"{field}_{direction}" for field, direction in stats.keys)
+                logger.info(f"Creating index {name} on {collection_name} "
+                            f"({stats.count} executions, {stats.report()['mean_ms_before']} ms on average)")
+                self._get_collection(collection_name).create_index(list(stats.keys), name=name)
+                with self._lock:
+                    stats.created_at = time.time()
+                    self.created += 1
+                    self._created[collection_name] += 1
+                    self._indexes.pop(collection_name, None)
+                names.append(name)
+            except Exception as e:
+                logger.error(f"Error creating index on {collection_name}: {e}")
+            finally:
+                with self._lock:
+                    self._creating.discard((collection_name, stats.keys))
+        return names
+
+    def _create_in_background(self, collection_name):
+        threading.Thread(target=self.create_recommended, args=(collection_name,), daemon=True).start()
+
+    def report(self):
+        """Recommended and created indexes per collection with their before/after latency."""
+        report = {}
+        for collection_name in list(self._groups):
+            with self._lock:
+                created = [stats.report() for stats in self._shapes.get(collection_name, {}).values() if stats.created_at]
+                groups = self._groups.get(collection_name, Counter()).most_common(5)
+            report[collection_name] = {
+                "recommended": [stats.report() for stats in self.recommend(collection_name)],
+                "created": created,
+                # Only served by an index after a leading $sort on the same key
+                "group_keys": dict(groups),
+            }
+        return report
+
+    def stats(self):
+        return {
+            "enabled": INDEX_ADVISOR_ENABLED,
+            "auto_create": self.auto_create,
+            "recorded": self.recorded,
+            "ignored": self.ignored,
+            "shapes": sum(len(shapes) for shapes in self._shapes.values()),
+            "created": self.created,
+        }
+
+
+index_advisor = IndexAdvisor()
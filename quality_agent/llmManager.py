@@ -1,77 +1,210 @@
-from langchain_cerebras import ChatCerebras
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_nvidia_ai_endpoints import ChatNVIDIA
-from langchain_fireworks import ChatFireworks
-from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
 from quality_agent.logger import setup_logger
-from langchain_groq import ChatGroq
-from langchain_google_genai import ChatGoogleGenerativeAI
+from quality_agent.llm_router import LLMRouter, LLM_FAILOVER_PROVIDERS
+from quality_agent.rate_limiter import ProviderLimiter, RateLimitedModel, get_provider_limits
+from quality_agent.llm_cache import llm_cache
+from quality_agent.cassette import CassetteChatModel, cassette
+from langchain_core.globals import set_llm_cache
+import httpx
+import importlib
 import os
+import threading
 
 logger = setup_logger(__name__)
 
+# All models answer at temperature 0, identical prompts are served from the cache
+if llm_cache is not None:
+    set_llm_cache(llm_cache)
+
 llm_to_use = os.getenv("LLM_TO_USE", "groq")
 
+# Provider used by each role. The main `llm` follows LLM_TO_USE, the other
+# roles keep their previous providers unless overridden.
+ROLE_PROVIDERS = {
+    "llm": llm_to_use,
+    "llm_for_router": os.getenv("LLM_FOR_ROUTER", "groq"),
+    "llm_for_documentation": os.getenv("LLM_FOR_DOCUMENTATION", "groq"),
+    "vision_llm": os.getenv("VISION_LLM", "google"),
+    "embeddings": os.getenv("EMBEDDINGS_LLM", "groq"),
+}
+
+# Provider name -> (module, class, constructor arguments). SDK modules are
+# only imported when a role selects the provider.
+PROVIDERS = {
+    "groq": ("langchain_groq", "ChatGroq", {
+        "model": "llama-3.1-70b-versatile",
+        "temperature": 0.0,
+        "max_retries": 2,
+    }),
+    "google": ("langchain_google_genai", "ChatGoogleGenerativeAI", {
+        "model": "gemini-1.5-flash",
+        "temperature": 0,
+        "max_tokens": None,
+        "timeout": None,
+        "max_retries": 2,
+    }),
+    "nvidia": ("langchain_nvidia_ai_endpoints", "ChatNVIDIA", {
+        "model": "meta/llama3-70b-instruct",
+        "temperature": 0,
+    }),
+    "fireworks": ("langchain_fireworks", "ChatFireworks", {
+        "model": "accounts/fireworks/models/llama-v3p1-70b-instruct",
+        "temperature": 0,
+        "max_tokens": None,
+        "timeout": None,
+        "max_retries": 2,
+    }),
+    "cerebras": ("langchain_cerebras", "ChatCerebras", {
+        "model": "llama3.1-70b",
+        "temperature": 0.0,
+        "max_retries": 2,
+    }),
+    "azure": ("langchain_openai", "AzureChatOpenAI", {
+        "azure_deployment": os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+        "temperature": 0,
+        "max_retries": 2,
+    }),
+}
+
+# Providers whose SDK accepts the shared httpx clients
+HTTPX_PROVIDERS = {"groq", "cerebras", "azure"}
+
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "100"))
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_HTTP_TIMEOUT_SECONDS = float(os.getenv("LLM_HTTP_TIMEOUT_SECONDS", "60"))
+
+
+def get_http_client_kwargs():
+    return {
+        "limits": httpx.Limits(
+            max_connections=LLM_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+        "timeout": LLM_HTTP_TIMEOUT_SECONDS,
+    }
+
+
+class ProviderRegistry:
+    """
+    Process-wide cache of chat model clients. A provider's SDK is imported
+    and its client built on first use, and roles selecting the same provider
+    share one client. Clients are rate limited per provider and share one
+    HTTP connection pool.
+    """
+
+    def __init__(self, providers=PROVIDERS):
+        self.providers = providers
+        self._clients = {}
+        self.limiters = {}
+        self._http_client = None
+        self._http_async_client = None
+        self._lock = threading.Lock()
+
+    def _get_http_clients(self):
+        if self._http_client is None:
+            self._http_client = httpx.Client(**get_http_client_kwargs())
+            self._http_async_client = httpx.AsyncClient(**get_http_client_kwargs())
+        return {"http_client": self._http_client, "http_async_client": self._http_async_client}
+
+    def get(self, name):
+        client = self._clients.get(name)
+        if client is not None:
+            return client
+        with self._lock:
+            if name not in self._clients:
+                if name not in self.providers:
+                    raise ValueError(f"Unknown LLM provider '{name}', expected one of {sorted(self.providers)}")
+                self.limiters[name] = ProviderLimiter(name, **get_provider_limits(name))
+                self._clients[name] = RateLimitedModel(self._build(name), self.limiters[name])
+            return self._clients[name]
+
+    def _build(self, name):
+        # Replayed providers are served from the cassette without their SDK
+        if cassette is not None and cassette.replaying:
+            logger.info(f"Replaying LLM provider '{name}' from the cassette")
+            return CassetteChatModel(provider=name, cassette=cassette)
+        module_name, class_name, kwargs = self.providers[name]
+        logger.info(f"Building LLM provider '{name}'")
+        model_class = getattr(importlib.import_module(module_name), class_name)
+        if name in HTTPX_PROVIDERS:
+            kwargs = {**kwargs, **self._get_http_clients()}
+        model = model_class(**kwargs)
+        if cassette is not None:
+            # Every exchange reaches the provider to be recorded, the cache is left to the provider model
+            return CassetteChatModel(provider=name, cassette=cassette, model=model, cache=False)
+        return model
+
+    def loaded(self):
+        return sorted(self._clients)
+
+    def stats(self):
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+    async def aclose(self):
+        if self._http_client is not None:
+            self._http_client.close()
+            await self._http_async_client.aclose()
+
+
+provider_registry = ProviderRegistry()
+
 
 class LLMManager:
-    def __init__(self):
+    """
+    Exposes the chat model of each role. Models are resolved through the
+    provider registry when a role is first accessed.
+    """
+
+    def __init__(self, registry: ProviderRegistry = provider_registry, role_providers=None,
+                 failover_providers=LLM_FAILOVER_PROVIDERS):
         try:
             logger.info("Initializing LLMManager")
-
-            self.llm_for_router = ChatGroq(
-                model="llama-3.1-70b-versatile",
-                temperature=0.0,
-                max_retries=2,
-            )
-
-            self.llm_for_documentation = ChatGroq(
-                model="llama-3.1-70b-versatile",
-                temperature=0.0,
-                max_retries=2,
-            )
-
-            self.vision_llm = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash",
-                temperature=0,
-                max_tokens=None,
-                timeout=None,
-                max_retries=2,
-                # other params...
-            )
-
-            if llm_to_use == "nvidia":
-                self.llm = ChatNVIDIA(model="meta/llama3-70b-instruct", temperature=0)
-            elif llm_to_use == "fireworks":
-                self.llm = ChatFireworks(
-                    model="accounts/fireworks/models/llama-v3p1-70b-instruct",
-                    temperature=0,
-                    max_tokens=None,
-                    timeout=None,
-                    max_retries=2,
-                )
-            elif llm_to_use == "groq":
-                self.llm = ChatGroq(
-                    model="llama-3.1-70b-versatile",
-                    temperature=0.0,
-                    max_retries=2,
-                )
-            elif llm_to_use == "cerebras":
-                self.llm = ChatCerebras(
-                    model="llama3.1-70b",
-                    temperature=0.0,
-                    max_retries=2,
-                )
-
-            self.embeddings = ChatGroq(
-                model="llama-3.1-70b-versatile",
-                temperature=0.0,
-                max_retries=2,
-            )
+            self.registry = registry
+            self.role_providers = {**ROLE_PROVIDERS, **(role_providers or {})}
+            self.failover_providers = failover_providers
+            for role, provider in self.role_providers.items():
+                if provider not in registry.providers:
+                    raise ValueError(f"Unknown LLM provider '{provider}' for {role}")
+            for provider in failover_providers:
+                if provider not in registry.providers:
+                    raise ValueError(f"Unknown LLM provider '{provider}' in LLM_FAILOVER_PROVIDERS")
+            self._router = None
+            self._router_lock = threading.Lock()
             logger.info("LLMManager initialized successfully")
         except Exception as e:
             logger.error(f"Error initializing LLMManager: {e}")
             raise
 
+    def get_model(self, role):
+        return self.registry.get(self.role_providers[role])
+
+    @property
+    def llm(self):
+        # Several failover providers put a latency-aware router in front of them
+        if len(self.failover_providers) < 2:
+            return self.get_model("llm")
+        with self._router_lock:
+            if self._router is None:
+                self._router = LLMRouter(
+                    {name: self.registry.get(name) for name in self.failover_providers})
+            return self._router
+
+    @property
+    def llm_for_router(self):
+        return self.get_model("llm_for_router")
+
+    @property
+    def llm_for_documentation(self):
+        return self.get_model("llm_for_documentation")
+
+    @property
+    def vision_llm(self):
+        return self.get_model("vision_llm")
+
+    @property
+    def embeddings(self):
+        return self.get_model("embeddings")
+
     def invoke(self, prompt: ChatPromptTemplate, **kwargs) -> str:
         try:
             logger.info(f"Invoking LLM with prompt: {prompt}")
@@ -82,3 +215,38 @@ class LLMManager:
         except Exception as e:
             logger.error(f"Error invoking LLM: {e}")
             raise
+
+    async def ainvoke(self, prompt: ChatPromptTemplate, **kwargs) -> str:
+        """
+        Async variant of `invoke`. The request waits for the provider's rate
+        limits and a concurrency slot instead of failing under bursts.
+        """
+        try:
+            logger.info(f"Invoking LLM with prompt: {prompt}")
+            messages = prompt.format_messages(**kwargs)
+            response = await self.llm.ainvoke(messages)
+            logger.info(f"LLM response: {response.content}")
+            return response.content
+        except Exception as e:
+            logger.error(f"Error invoking LLM: {e}")
+            raise
+
+    def stats(self):
+        return {
+            "providers": self.registry.stats(),
+            "failover": self._router.stats() if self._router else None,
+        }
+
+
+_llm_manager = None
+_llm_manager_lock = threading.Lock()
+
+
+def get_llm_manager():
+    """Returns the process-wide LLMManager."""
+    global _llm_manager
+    if _llm_manager is None:
+        with _llm_manager_lock:
+            if _llm_manager is None:
+                _llm_manager = LLMManager()
+    return _llm_manager
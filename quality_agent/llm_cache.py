@@ -0,0 +1,210 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true") == "true"
+LLM_CACHE_MEMORY_MAX_BYTES = int(os.getenv("LLM_CACHE_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+# Opt-in disk tier, e.g. /var/lib/query-genai/llm_cache.sqlite. Empty keeps the cache in memory only
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "")
+LLM_CACHE_DISK_MAX_BYTES = int(os.getenv("LLM_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+
+# Prompt type -> (text identifying the formatted prompt, default TTL in seconds).
+# Override a TTL with LLM_CACHE_TTL_SECONDS_<TYPE>.
+PROMPT_TYPES = {
+    "router": ("AI router agent responsible for classifying", 7 * 86400),
+    # Embeds `present_date`, answers for relative dates change with it
+    "sales_pipeline": ("converting into nosql mongodb aggregation pipeline", 86400),
+    "visualization_query": ("expert in generating MongoDB queries based on the schema", 7 * 86400),
+    "code_generation": ("expert Python programmer with deep knowledge of data visualization", 7 * 86400),
+    "inspection_agent": ("quickly evaluates user input and selects appropriate tools", 3600),
+}
+
+PROMPT_TYPE_TTLS = {
+    prompt_type: float(os.getenv(f"LLM_CACHE_TTL_SECONDS_{prompt_type.upper()}", str(ttl)))
+    for prompt_type, (_, ttl) in PROMPT_TYPES.items()
+}
+
+
+def get_prompt_type(prompt):
+    for prompt_type, (marker, _) in PROMPT_TYPES.items():
+        if marker in prompt:
+            return prompt_type
+    return "default"
+
+
+def get_cache_key(prompt, llm_string):
+    return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+
+class DiskTier:
+    """SQLite store of serialized responses, evicting the least recently used beyond `max_bytes`."""
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, prompt_type TEXT, expires_at REAL, accessed_at REAL, size INTEGER, value TEXT)")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+        self._connection.commit()
+        self.size = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT expires_at, value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[0] < now:
+                self._delete(key)
+                return None
+            self._connection.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            return row
+
+    def put(self, key, prompt_type, expires_at, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._delete(key)
+            self._connection.execute(
+                "INSERT INTO llm_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (key, prompt_type, expires_at, time.time(), size, value))
+            self.size += size
+            if self.size > self.max_bytes:
+                self._evict()
+            self._connection.commit()
+
+    def _delete(self, key):
+        row = self._connection.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row:
+            self._connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self.size -= row[0]
+            self._connection.commit()
+
+    def _evict(self):
+        self._connection.execute("DELETE FROM llm_cache WHERE expires_at < ?", (time.time(),))
+        rows = self._connection.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at").fetchall()
+        self.size = sum(size for _, size in rows)
+        for key, size in rows:
+            if self.size <= self.max_bytes:
+                break
+            self._connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self.size -= size
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM llm_cache")
+            self._connection.commit()
+            self.size = 0
+
+
+class LLMResponseCache(BaseCache):
+    """
+    Content-addressed cache of LLM responses keyed on the model settings and
+    the exact formatted prompt. A byte-bounded in-memory LRU sits in front of
+    an optional SQLite tier that survives restarts. Entries expire after the
+    TTL of their prompt type.
+    """
+
+    def __init__(self, memory_max_bytes=LLM_CACHE_MEMORY_MAX_BYTES, path=LLM_CACHE_PATH,
+                 disk_max_bytes=LLM_CACHE_DISK_MAX_BYTES):
+        self.memory_max_bytes = memory_max_bytes
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self.disk = DiskTier(path, disk_max_bytes) if path else None
+        self.hits = defaultdict(int)
+        self.disk_hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def _remember(self, key, expires_at, value):
+        with self._lock:
+            if key in self._memory:
+                self._memory_size -= len(self._memory.pop(key)[1])
+            if len(value) > self.memory_max_bytes:
+                return
+            self._memory[key] = (expires_at, value)
+            self._memory_size += len(value)
+            while self._memory_size > self.memory_max_bytes:
+                _, (_, evicted) = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def lookup(self, prompt, llm_string):
+        key = get_cache_key(prompt, llm_string)
+        prompt_type = get_prompt_type(prompt)
+        value = None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._memory[key]
+                self._memory_size -= len(entry[1])
+            elif entry is not None:
+                self._memory.move_to_end(key)
+                value = entry[1]
+        if value is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.disk_hits[prompt_type] += 1
+                self._remember(key, *entry)
+                value = entry[1]
+        if value is None:
+            self.misses[prompt_type] += 1
+            return None
+        self.hits[prompt_type] += 1
+        logger.info(f"LLM cache hit for {prompt_type} prompt")
+        return loads(value)
+
+    def update(self, prompt, llm_string, return_val):
+        prompt_type = get_prompt_type(prompt)
+        ttl = PROMPT_TYPE_TTLS.get(prompt_type, LLM_CACHE_TTL_SECONDS)
+        if ttl <= 0:
+            return
+        key = get_cache_key(prompt, llm_string)
+        value = dumps(list(return_val))
+        expires_at = time.time() + ttl
+        self._remember(key, expires_at, value)
+        if self.disk is not None:
+            try:
+                self.disk.put(key, prompt_type, expires_at, value)
+            except sqlite3.Error as e:
+                logger.warning(f"Unable to persist LLM response: {e}")
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        hits = sum(self.hits.values())
+        lookups = hits + sum(self.misses.values())
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_bytes": self.disk.size if self.disk is not None else None,
+            "hits": dict(self.hits),
+            "disk_hits": dict(self.disk_hits),
+            "misses": dict(self.misses),
+            "hit_ratio": hits / lookups if lookups else 0.0,
+        }
+
+
+llm_cache = LLMResponseCache() if LLM_CACHE_ENABLED else None
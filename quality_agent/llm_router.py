@@ -0,0 +1,241 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from langchain_core.runnables import Runnable
+from langchain_core.runnables.config import patch_config
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Providers of the main `llm` role in order of preference, e.g. "groq,cerebras"
+LLM_FAILOVER_PROVIDERS = [
+    name.strip() for name in os.getenv("LLM_FAILOVER_PROVIDERS", "").split(",") if name.strip()
+]
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "100"))
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("LLM_CIRCUIT_FAILURE_THRESHOLD", "3"))
+LLM_CIRCUIT_RESET_SECONDS = float(os.getenv("LLM_CIRCUIT_RESET_SECONDS", "30"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false") == "true"
+# A second provider is asked once the first is slower than this percentile of its latencies
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+# Threads of the sync hedged requests, a losing request finishes in the background
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_HEDGE_MAX_WORKERS", "16")))
+
+
+class ProviderHealth:
+    """Rolling latency and error profile of a provider with its circuit breaker."""
+
+    def __init__(self, name, window=LLM_LATENCY_WINDOW,
+                 failure_threshold=LLM_CIRCUIT_FAILURE_THRESHOLD, reset_seconds=LLM_CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def record_success(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.outcomes.append(True)
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+
+    def record_failure(self):
+        with self._lock:
+            self.outcomes.append(False)
+            self.consecutive_failures += 1
+            # A failed trial request after the reset period reopens the circuit at once
+            if self.consecutive_failures >= self.failure_threshold or self.open_until:
+                self.open_until = time.monotonic() + self.reset_seconds
+                logger.warning(f"Circuit opened for LLM provider '{self.name}'")
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def percentile(self, percent):
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(round(percent / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    def hedge_delay(self):
+        if len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return self.percentile(LLM_HEDGE_PERCENTILE)
+
+    def stats(self):
+        outcomes = list(self.outcomes)
+        return {
+            "circuit_open": self.is_open(),
+            "p50_seconds": self.percentile(50),
+            "p95_seconds": self.percentile(95),
+            "error_rate": outcomes.count(False) / len(outcomes) if outcomes else 0.0,
+            "requests": len(outcomes),
+        }
+
+
+class LLMRouter(Runnable):
+    """
+    Routes chat model requests over several providers. Healthy providers are
+    tried fastest first by rolling median latency, failures fall over to the
+    next provider and open the provider's circuit after repeated errors. With
+    hedging enabled, a request slower than the provider's latency percentile
+    is also sent to the next provider and the first answer wins.
+    """
+
+    def __init__(self, providers, health=None, hedge=LLM_HEDGE_ENABLED):
+        self.providers = providers
+        self.health = health or {name: ProviderHealth(name) for name in providers}
+        self.hedge = hedge
+
+    def bind_tools(self, tools, **kwargs):
+        """Binds the tools on every provider, sharing the health profiles."""
+        return LLMRouter(
+            {name: model.bind_tools(tools, **kwargs) for name, model in self.providers.items()},
+            health=self.health,
+            hedge=self.hedge,
+        )
+
+    def get_ordered_providers(self):
+        names = list(self.providers)
+        healthy = [name for name in names if not self.health[name].is_open()]
+        healthy.sort(key=lambda name: (self.health[name].percentile(50) or 0.0, names.index(name)))
+        # When every circuit is open, the one closest to its reset is tried first
+        broken = sorted(
+            (name for name in names if self.health[name].is_open()),
+            key=lambda name: self.health[name].open_until)
+        return healthy + broken
+
+    def get_hedge_backup(self, order, position, tried=()):
+        """Returns the next untried provider with a closed circuit, if hedging is enabled."""
+        if not self.hedge:
+            return None
+        for name in order[position + 1:]:
+            if name not in tried and not self.health[name].is_open():
+                return name
+        return None
+
+    def stats(self):
+        return {name: health.stats() for name, health in self.health.items()}
+
+    def _call_provider(self, name, input, config, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = self.providers[name].invoke(input, config, **kwargs)
+        except Exception:
+            self.health[name].record_failure()
+            raise
+        self.health[name].record_success(time.perf_counter() - start)
+        return result
+
+    async def _acall_provider(self, name, input, config, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await self.providers[name].ainvoke(input, config, **kwargs)
+        except Exception:
+            self.health[name].record_failure()
+            raise
+        self.health[name].record_success(time.perf_counter() - start)
+        return result
+
+    @staticmethod
+    def _get_hedge_config(config):
+        # The hedged request runs without callbacks, so only the first
+        # request's tokens reach the token stream
+        return {**config, "callbacks": None}
+
+    def invoke(self, input, config=None, **kwargs):
+        return self._call_with_config(partial(self._invoke, **kwargs), input, config)
+
+    def _invoke(self, input, run_manager, config, **kwargs):
+        config = patch_config(config, callbacks=run_manager.get_child())
+        order = self.get_ordered_providers()
+        last_error = None
+        # Providers already asked, including the backups of hedged requests
+        tried = set()
+        for position, name in enumerate(order):
+            if name in tried:
+                continue
+            tried.add(name)
+            backup = self.get_hedge_backup(order, position, tried)
+            delay = self.health[name].hedge_delay() if backup else None
+            try:
+                if delay is None:
+                    return self._call_provider(name, input, config, **kwargs)
+                return self._invoke_hedged(name, backup, delay, input, config, tried, **kwargs)
+            except Exception as e:
+                logger.warning(f"LLM provider '{name}' failed: {e}")
+                last_error = e
+        raise last_error
+
+    def _invoke_hedged(self, name, backup, delay, input, config, tried, **kwargs):
+        first = _executor.submit(self._call_provider, name, input, config, **kwargs)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        logger.info(f"Hedging LLM request of '{name}' to '{backup}' after {delay:.2f}s")
+        tried.add(backup)
+        second = _executor.submit(
+            self._call_provider, backup, input, self._get_hedge_config(config), **kwargs)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+        return first.result()
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return await self._acall_with_config(partial(self._ainvoke, **kwargs), input, config)
+
+    async def _ainvoke(self, input, run_manager, config, **kwargs):
+        config = patch_config(config, callbacks=run_manager.get_child())
+        order = self.get_ordered_providers()
+        last_error = None
+        # Providers already asked, including the backups of hedged requests
+        tried = set()
+        for position, name in enumerate(order):
+            if name in tried:
+                continue
+            tried.add(name)
+            backup = self.get_hedge_backup(order, position, tried)
+            delay = self.health[name].hedge_delay() if backup else None
+            try:
+                if delay is None:
+                    return await self._acall_provider(name, input, config, **kwargs)
+                return await self._ainvoke_hedged(name, backup, delay, input, config, tried, **kwargs)
+            except Exception as e:
+                logger.warning(f"LLM provider '{name}' failed: {e}")
+                last_error = e
+        raise last_error
+
+    async def _ainvoke_hedged(self, name, backup, delay, input, config, tried, **kwargs):
+        first = asyncio.ensure_future(self._acall_provider(name, input, config, **kwargs))
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        logger.info(f"Hedging LLM request of '{name}' to '{backup}' after {delay:.2f}s")
+        tried.add(backup)
+        second = asyncio.ensure_future(
+            self._acall_provider(backup, input, self._get_hedge_config(config), **kwargs))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
@@ -1,14 +1,31 @@
 from quality_agent.workflowManager import WorkflowManager
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
-from models.models import Query, QueryResponse
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from models.models import Query, QueryResponse, BatchQuery, BatchQueryItem, BatchQueryResponse, BATCH_MAX_CONCURRENCY
+from quality_agent.batch import SingleFlight, current_batch
+from quality_agent.answer_cache import SemanticAnswerCache, ANSWER_CACHE_ENABLED
+from quality_agent.mongo_data_retriever import get_sales_data_version, get_sales_write_generation
+from quality_agent.pipeline_cache import pipeline_cache
+from quality_agent.aggregation_cache import aggregation_cache
+from quality_agent.database import close_clients
+from langchain_core.messages import HumanMessage, AIMessage
 from langchain.globals import set_debug, set_verbose
-from quality_agent.llmManager import LLMManager
+from quality_agent.llmManager import get_llm_manager
+from quality_agent.llm_cache import llm_cache
+from quality_agent.metrics import get_metrics_callbacks, stats_collector
+from quality_agent.speculation import speculation_manager
+from quality_agent.index_advisor import index_advisor
+from quality_agent.rollups import rollup_manager
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from typing import List
+from bson import json_util
 from quality_agent.logger import setup_logger
+import asyncio
 import json
 import getpass
+import time
+import uuid
 import os
 from dotenv import load_dotenv
 
@@ -31,10 +48,13 @@ def _set_if_undefined(var: str):
 
 # _set_if_undefined("OPENAI_API_KEY")
 
+# Only data answers are cached, help and fallback answers are cheap already
+CACHEABLE_ROUTES = {"Query_Data", "Visualization"}
+
 # Initialize managers
 try:
     logger.info("Initializing managers")
-    llm_manager = LLMManager()
+    llm_manager = get_llm_manager()
 
     workflow_manager = WorkflowManager(llm_manager=llm_manager)
     logger.info("Managers initialized successfully")
@@ -51,6 +71,21 @@ except Exception as e:
     logger.error(f"Error generating workflow graph: {e}")
     raise
 
+# Sales inserted through the application, or seen by the rollup change
+# stream, invalidate the answers at once, like the cached aggregation results
+answer_cache = SemanticAnswerCache(get_data_version=get_sales_data_version,
+                                   get_write_generation=get_sales_write_generation)
+
+stats_collector.register("answer_cache", answer_cache.stats)
+stats_collector.register("pipeline_cache", pipeline_cache.stats)
+stats_collector.register("aggregation_cache", aggregation_cache.stats)
+if llm_cache is not None:
+    stats_collector.register("llm_cache", llm_cache.stats)
+stats_collector.register("llm_limiter", lambda: llm_manager.stats()["providers"], label="provider")
+stats_collector.register("llm_failover", lambda: llm_manager.stats()["failover"], label="provider")
+stats_collector.register("index_advisor", index_advisor.stats)
+stats_collector.register("rollups", rollup_manager.stats)
+
 app = FastAPI()
 
 origins = ["http://localhost:4200", "http://localhost:3005"]
@@ -63,6 +98,38 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def start_rollups():
+    try:
+        await asyncio.to_thread(rollup_manager.start)
+    except Exception as e:
+        # Pipelines keep running on the raw sales
+        logger.error(f"Error starting the sales rollups: {e}")
+
+
+@app.on_event("shutdown")
+async def stop_rollups():
+    rollup_manager.stop()
+
+
+@app.on_event("shutdown")
+async def close_checkpointer():
+    # The sqlite checkpointer keeps a connection thread open
+    conn = getattr(graph.checkpointer, "conn", None)
+    if conn is not None:
+        await conn.close()
+
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await llm_manager.registry.aclose()
+
+
+@app.on_event("shutdown")
+async def close_mongo_clients():
+    await close_clients()
+
+
 @app.get("/")
 async def redirect_root_to_docs():
     return RedirectResponse("/docs")
@@ -72,47 +139,7 @@ async def redirect_root_to_docs():
 async def runQuery(query: Query) -> QueryResponse:
     try:
         logger.info(f"Processing query: {query.query}")
-        response = []
-        finalResponse = QueryResponse(answer="", chart="", reviewImage=None)
-        config = {"configurable": {"thread_id": "1"}, "recursion_limit": 100}
-        input = {"question": query.query}
-        state = graph.get_state(config)
-        input = handleInterrupts(query, config, state, input)
-
-        for stream_data in graph.stream(input, config):
-            if "__end__" not in stream_data:
-                response.append(stream_data)
-                node_response = (
-                    stream_data.get("query_data_node")
-                    or stream_data.get("record_sales_node")
-                    or stream_data.get("human_record_sales_confirmation_node")
-                    or stream_data.get("help_node")
-                    or stream_data.get("no_context_node")
-                )
-
-                visualization_response = (
-                    stream_data.get("visualization_node")
-                    or stream_data.get("generate_mongo_query_node")
-                    or stream_data.get("generate_chart_node")
-                    or stream_data.get("analyze_plot_node")
-                )
-                # analyzing_plot_response =  stream_data.get('analyze_plot_node')
-                # interrupt_responses = stream_data.get('__interrupt__')
-                if node_response:
-                    finalResponse.answer = node_response.get("answer")
-                elif visualization_response:
-                    finalResponse.chart = visualization_response.get("chart")
-                    finalResponse.answer = visualization_response.get("answer")
-                # elif analyzing_plot_response:
-                #     finalResponse.answer = analyzing_plot_response.get('answer')
-                # elif interrupt_responses:
-                #     finalResponse.answer = '\n'.join(
-                #         message.value for message in interrupt_responses)
-
-        if finalResponse.answer == "" and finalResponse.chart == "":
-            finalResponse.answer = (
-                "Unable to process the query. Could you provide more information?"
-            )
+        finalResponse = await execute_query(query, get_run_config(query))
         logger.info(f"Query processed successfully: {finalResponse.answer}")
         return finalResponse
     except Exception as e:
@@ -120,7 +147,306 @@ async def runQuery(query: Query) -> QueryResponse:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def handleInterrupts(query, config, state, input):
+@app.post("/query/batch")
+async def runQueryBatch(batch: BatchQuery) -> BatchQueryResponse:
+    """
+    Runs independent questions concurrently. Identical router, pipeline generation
+    and aggregation calls are shared between the questions of the batch.
+    """
+    try:
+        logger.info(f"Processing batch of {len(batch.queries)} queries")
+        # The request model bounds both the batch size and its concurrency
+        semaphore = asyncio.Semaphore(batch.max_concurrency or BATCH_MAX_CONCURRENCY)
+        shared_calls = SingleFlight()
+        token = current_batch.set(shared_calls)
+
+        async def run_item(question):
+            query = Query(query=question)
+            config = get_run_config(query)
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await execute_query(query, config)
+                    error = None
+                except Exception as e:
+                    logger.error(f"Error processing batch query '{question}': {e}")
+                    response = QueryResponse(answer="", chart="")
+                    error = str(e)
+                return BatchQueryItem(
+                    query=question,
+                    answer=response.answer or "",
+                    chart=response.chart,
+                    thread_id=config["configurable"]["thread_id"],
+                    duration_ms=(time.perf_counter() - start) * 1000,
+                    error=error,
+                )
+
+        start = time.perf_counter()
+        try:
+            results = await asyncio.gather(*(run_item(question) for question in batch.queries))
+        finally:
+            current_batch.reset(token)
+        logger.info(f"Batch processed, {shared_calls.hits} shared calls")
+        return BatchQueryResponse(
+            results=results,
+            duration_ms=(time.perf_counter() - start) * 1000,
+            shared_calls=shared_calls.hits,
+        )
+    except Exception as e:
+        logger.error(f"Error processing batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def execute_query(query, config):
+    finalResponse = QueryResponse(
+        answer="", chart="", thread_id=config["configurable"]["thread_id"])
+    input = {"question": query.query}
+    state = await graph.aget_state(config)
+    is_first_turn = not state.values.get("messages")
+    input = await handleInterrupts(query, config, state, input)
+
+    if input is not None:
+        cached_answer = await lookup_cached_answer(query, config)
+        if cached_answer:
+            finalResponse.answer = cached_answer["response"]["answer"]
+            finalResponse.chart = cached_answer["response"]["chart"]
+            return finalResponse
+
+    question_type = None
+    answering_node = None
+    # `astream` runs the async node variants so slow LLM and Mongo calls
+    # don't block the event loop for other requests.
+    async for stream_data in graph.astream(input, config):
+        if "__end__" not in stream_data:
+            update_query_response(finalResponse, stream_data)
+            for node_name, node_update in stream_data.items():
+                if node_update and "question_type" in node_update:
+                    question_type = node_update["question_type"]
+                if node_update and node_update.get("answer"):
+                    answering_node = node_name
+
+    if finalResponse.answer == "" and finalResponse.chart == "":
+        finalResponse.answer = (
+            "Unable to process the query. Could you provide more information?"
+        )
+    elif is_first_turn and question_type in CACHEABLE_ROUTES and finalResponse.answer:
+        # Follow-up questions depend on the conversation, so only answers to
+        # the first question of a thread are reusable by other conversations.
+        await store_cached_answer(query, finalResponse, answering_node)
+    return finalResponse
+
+
+async def lookup_cached_answer(query, config):
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    try:
+        cached_answer = await answer_cache.alookup(query.query)
+        if cached_answer:
+            # Keep the conversation history as if the graph had answered
+            await graph.aupdate_state(
+                config,
+                {
+                    "question": query.query,
+                    "answer": cached_answer["response"]["answer"],
+                    "chart": cached_answer["response"]["chart"],
+                    "messages": [HumanMessage(query.query),
+                                 AIMessage(cached_answer["response"]["answer"])],
+                },
+                as_node=cached_answer["node"],
+            )
+        return cached_answer
+    except Exception as e:
+        logger.warning(f"Answer cache lookup failed: {e}")
+        return None
+
+
+async def store_cached_answer(query, finalResponse, answering_node):
+    if not ANSWER_CACHE_ENABLED or answering_node is None:
+        return
+    try:
+        await answer_cache.astore(
+            query.query,
+            {"answer": finalResponse.answer, "chart": finalResponse.chart},
+            answering_node,
+        )
+    except Exception as e:
+        logger.warning(f"Answer cache store failed: {e}")
+
+
+@app.get("/cache/stats")
+async def getCacheStats():
+    return {
+        "answer_cache": answer_cache.stats(),
+        "pipeline_cache": pipeline_cache.stats(),
+        "aggregation_cache": aggregation_cache.stats(),
+        "llm_cache": llm_cache.stats() if llm_cache is not None else None,
+    }
+
+
+@app.get("/llm/stats")
+async def getLLMStats():
+    """
+    Queue depth and waiting times of the provider rate limits, the failover
+    health and the outcomes of the speculative stages.
+    """
+    return {**llm_manager.stats(), "speculation": speculation_manager.stats()}
+
+
+@app.get("/mongo/index-advice")
+async def getIndexAdvice():
+    """
+    Indexes recommended from the filters and sorts of the executed pipelines
+    and, with INDEX_ADVISOR_AUTO_CREATE, the created ones with their latency before and after.
+    """
+    report = await asyncio.to_thread(index_advisor.report)
+    return {**index_advisor.stats(), "collections": report}
+
+
+@app.post("/rollups/rebuild")
+async def rebuildRollups():
+    """Recomputes the sales rollups, e.g. after they went stale."""
+    await asyncio.to_thread(rollup_manager.rebuild)
+    return rollup_manager.stats()
+
+
+@app.get("/metrics")
+async def getMetrics():
+    """Node, LLM, Mongo and chart timings plus the cache and rate limit stats in the Prometheus format."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.post("/query/stream")
+async def runQueryStream(query: Query):
+    """
+    Streams the workflow as Server-Sent Events: one event per finished node and
+    the inspection agent's answer token by token.
+    """
+    logger.info(f"Streaming query: {query.query}")
+    config = get_run_config(query)
+
+    async def event_stream():
+        try:
+            finalResponse = QueryResponse(
+                answer="", chart="", thread_id=config["configurable"]["thread_id"])
+            input = {"question": query.query}
+            state = await graph.aget_state(config)
+            is_first_turn = not state.values.get("messages")
+            input = await handleInterrupts(query, config, state, input)
+
+            cached_answer = await lookup_cached_answer(query, config) if input is not None else None
+            if cached_answer:
+                finalResponse.answer = cached_answer["response"]["answer"]
+                finalResponse.chart = cached_answer["response"]["chart"]
+                yield format_sse("done", finalResponse.model_dump())
+                return
+
+            question_type = None
+            answering_node = None
+            async for mode, chunk in graph.astream(
+                    input, config, stream_mode=["updates", "messages"]):
+                if mode == "messages":
+                    message, metadata = chunk
+                    if (metadata.get("langgraph_node") == "query_data_node"
+                            and isinstance(message.content, str) and message.content):
+                        yield format_sse("token", {"text": message.content})
+                    continue
+
+                for node_name, node_update in chunk.items():
+                    if not node_update:
+                        continue
+                    if "question_type" in node_update:
+                        question_type = node_update["question_type"]
+                    if node_update.get("answer"):
+                        answering_node = node_name
+                    update_query_response(finalResponse, {node_name: node_update})
+                    yield format_sse(node_name, get_node_event(node_update))
+
+            if finalResponse.answer == "" and finalResponse.chart == "":
+                finalResponse.answer = (
+                    "Unable to process the query. Could you provide more information?"
+                )
+            elif is_first_turn and question_type in CACHEABLE_ROUTES and finalResponse.answer:
+                await store_cached_answer(query, finalResponse, answering_node)
+            yield format_sse("done", finalResponse.model_dump())
+        except Exception as e:
+            logger.error(f"Error streaming query: {e}")
+            yield format_sse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def get_run_config(query):
+    """
+    Builds the graph config from the request so every conversation gets its own thread.
+    """
+    query_config = query.config
+    thread_id = query_config.thread_id if query_config and query_config.thread_id else str(uuid.uuid4())
+    recursion_limit = query_config.recursion_limit if query_config else 100
+    return {"configurable": {"thread_id": thread_id}, "recursion_limit": recursion_limit,
+            "callbacks": get_metrics_callbacks()}
+
+
+def update_query_response(finalResponse, stream_data):
+    node_response = (
+        stream_data.get("query_data_node")
+        or stream_data.get("record_sales_node")
+        or stream_data.get("human_record_sales_confirmation_node")
+        or stream_data.get("help_node")
+        or stream_data.get("no_context_node")
+    )
+
+    visualization_response = (
+        stream_data.get("visualization_node")
+        or stream_data.get("generate_mongo_query_node")
+        or stream_data.get("generate_chart_node")
+        or stream_data.get("analyze_plot_node")
+    )
+    # analyzing_plot_response =  stream_data.get('analyze_plot_node')
+    # interrupt_responses = stream_data.get('__interrupt__')
+    if node_response:
+        finalResponse.answer = node_response.get("answer")
+    elif visualization_response:
+        finalResponse.chart = visualization_response.get("chart")
+        finalResponse.answer = visualization_response.get("answer")
+    # elif analyzing_plot_response:
+    #     finalResponse.answer = analyzing_plot_response.get('answer')
+    # elif interrupt_responses:
+    #     finalResponse.answer = '\n'.join(
+    #         message.value for message in interrupt_responses)
+
+
+def get_node_event(node_update):
+    """Summarizes a node's state update into the payload of its SSE event."""
+    event = {}
+    if "question_type" in node_update:
+        event["question_type"] = node_update["question_type"]
+    if "rephrasedQuestion" in node_update:
+        event["rephrasedQuestion"] = node_update["rephrasedQuestion"]
+    if "mongoPipeline" in node_update:
+        event["pipeline"] = node_update["mongoPipeline"]
+    if "mongoQueryResult" in node_update:
+        event["row_count"] = len(node_update["mongoQueryResult"] or [])
+    if "mongoQueryTruncated" in node_update:
+        event["truncated"] = node_update["mongoQueryTruncated"]
+    if "mongoQueryPartial" in node_update:
+        event["partial"] = node_update["mongoQueryPartial"]
+    if node_update.get("chart"):
+        event["chart"] = node_update["chart"]
+    if node_update.get("answer"):
+        event["answer"] = node_update["answer"]
+    return event
+
+
+def format_sse(event, data):
+    # json_util handles the datetimes and ObjectIds found in generated pipelines
+    return f"event: {event}\ndata: {json_util.dumps(data)}\n\n"
+
+
+async def handleInterrupts(query, config, state, input):
     try:
         logger.info("Handling interrupts")
         for task in state.tasks:
@@ -131,7 +457,7 @@ def handleInterrupts(query, config, state, input):
                 or task.name == "human_record_sales_confirmation_node"
             ):
                 input = None
-                graph.update_state(config=config, values={"question": query.query})
+                await graph.aupdate_state(config=config, values={"question": query.query})
         logger.info("Interrupts handled successfully")
         return input
     except Exception as e:
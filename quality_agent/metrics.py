@@ -0,0 +1,257 @@
+import os
+import threading
+import time
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from quality_agent.logger import setup_logger
+from quality_agent.rate_limiter import CHARACTERS_PER_TOKEN, estimate_tokens
+
+logger = setup_logger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true") == "true"
+
+# Label of the observations made before the router picked the route
+UNKNOWN_ROUTE = "unknown"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+ROW_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+WORKFLOW_DURATION = Histogram(
+    "querygenai_workflow_duration_seconds", "Duration of a workflow run",
+    ["route", "status"], buckets=LATENCY_BUCKETS)
+NODE_DURATION = Histogram(
+    "querygenai_node_duration_seconds", "Duration of a workflow node",
+    ["node", "route", "status"], buckets=LATENCY_BUCKETS)
+LLM_DURATION = Histogram(
+    "querygenai_llm_duration_seconds", "Duration of a chat model call",
+    ["node", "route", "provider", "model", "status"], buckets=LATENCY_BUCKETS)
+LLM_TOKENS = Histogram(
+    "querygenai_llm_call_tokens", "Tokens of a chat model call",
+    ["node", "route", "provider", "model", "type"], buckets=TOKEN_BUCKETS)
+LLM_TOKENS_TOTAL = Counter(
+    "querygenai_llm_tokens_total", "Tokens sent to and received from the chat models",
+    ["node", "route", "provider", "model", "type"])
+MONGO_DURATION = Histogram(
+    "querygenai_mongo_duration_seconds", "Duration of a MongoDB operation",
+    ["operation", "collection", "status"], buckets=LATENCY_BUCKETS)
+MONGO_ROWS = Histogram(
+    "querygenai_mongo_rows", "Documents returned or written by a MongoDB operation",
+    ["operation", "collection"], buckets=ROW_BUCKETS)
+MONGO_PAYLOAD_BYTES = Histogram(
+    "querygenai_mongo_payload_bytes", "BSON size of the documents of a MongoDB operation",
+    ["operation", "collection"], buckets=SIZE_BUCKETS)
+MONGO_POOL_WAIT = Histogram(
+    "querygenai_mongo_pool_wait_seconds", "Time waited to check a connection out of the MongoDB pool",
+    ["client", "status"], buckets=LATENCY_BUCKETS)
+MONGO_POOL_CHECKED_OUT = Gauge(
+    "querygenai_mongo_pool_checked_out", "MongoDB connections in use", ["client"])
+MONGO_POOL_CONNECTIONS = Gauge(
+    "querygenai_mongo_pool_connections", "Open MongoDB connections", ["client"])
+CHART_EXEC_DURATION = Histogram(
+    "querygenai_chart_exec_duration_seconds", "Duration of executing the generated plot code",
+    ["status"], buckets=LATENCY_BUCKETS)
+CHART_PAYLOAD_BYTES = Histogram(
+    "querygenai_chart_payload_bytes", "Size of the chart JSON returned to the client",
+    buckets=SIZE_BUCKETS)
+PIPELINE_GUARD = Counter(
+    "querygenai_pipeline_guard_total", "Decisions of the guard on generated pipelines",
+    ["collection", "decision"])
+ROLLUP_REWRITE = Counter(
+    "querygenai_rollup_rewrite_total", "Sales pipelines answered from a rollup collection or from the raw sales",
+    ["grain", "outcome"])
+VISUALIZATION_PLAN = Counter(
+    "querygenai_visualization_plan_total", "Single-call visualization plans by stage and outcome",
+    ["stage", "outcome"])
+
+
+def record_mongo_operation(operation, collection, seconds, status="success", rows=None, payload_bytes=None):
+    MONGO_DURATION.labels(operation, collection, status).observe(seconds)
+    if rows is not None:
+        MONGO_ROWS.labels(operation, collection).observe(rows)
+    if payload_bytes is not None:
+        MONGO_PAYLOAD_BYTES.labels(operation, collection).observe(payload_bytes)
+
+
+def record_chart_execution(seconds, status="success", payload_bytes=None):
+    CHART_EXEC_DURATION.labels(status).observe(seconds)
+    if payload_bytes is not None:
+        CHART_PAYLOAD_BYTES.observe(payload_bytes)
+
+
+def record_pipeline_guard(collection, decision):
+    PIPELINE_GUARD.labels(collection, decision).inc()
+
+
+def record_rollup_rewrite(grain, outcome):
+    """`outcome` is "rewritten", "ineligible" or "not_ready" (rollups not built or stale)."""
+    ROLLUP_REWRITE.labels(grain, outcome).inc()
+
+
+def record_visualization_plan(stage, outcome):
+    """`outcome` is "used" when the planned stage succeeded, "fallback" when the multi-call path took over."""
+    VISUALIZATION_PLAN.labels(stage, outcome).inc()
+
+
+def get_token_usage(response, prompt_tokens):
+    """Prompt and completion tokens reported by the provider, estimated when it reports none."""
+    generation = response.generations[0][0] if response.generations and response.generations[0] else None
+    message = getattr(generation, "message", None)
+    # Some wrappers report usage without token counts, which is no usage at all
+    usage = getattr(message, "usage_metadata", None) or {}
+    if "input_tokens" in usage or "output_tokens" in usage:
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    token_usage = (response.llm_output or {}).get("token_usage") or {}
+    if "prompt_tokens" in token_usage or "completion_tokens" in token_usage:
+        return token_usage.get("prompt_tokens", 0), token_usage.get("completion_tokens", 0)
+    text = generation.text if generation is not None else ""
+    return prompt_tokens, len(text) // CHARACTERS_PER_TOKEN
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Times the workflow, its nodes and their chat model calls for one request.
+    Observations are held back until the router has picked the route, so
+    they can all be labelled with it.
+    """
+
+    run_inline = True
+
+    def __init__(self):
+        self.route = None
+        self._workflow_run_id = None
+        self._runs = {}
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _observe(self, observe):
+        with self._lock:
+            if self.route is None:
+                self._pending.append(observe)
+                return
+            route = self.route
+        observe(route)
+
+    def _set_route(self, route):
+        with self._lock:
+            if self.route is None:
+                self.route = route
+            pending, self._pending = self._pending, []
+            route = self.route
+        for observe in pending:
+            observe(route)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        if parent_run_id is None:
+            self._workflow_run_id = run_id
+            self._runs[run_id] = ("workflow", None, time.perf_counter())
+            return
+        # Only the node runs themselves, not the runnables nested in them
+        node = (metadata or {}).get("langgraph_node")
+        if parent_run_id == self._workflow_run_id and node and not node.startswith("__"):
+            self._runs[run_id] = ("node", node, time.perf_counter())
+
+    def _end_chain(self, run_id, status, outputs=None):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        kind, node, start = run
+        duration = time.perf_counter() - start
+        if kind == "node":
+            if isinstance(outputs, dict) and outputs.get("question_type"):
+                self._set_route(outputs["question_type"])
+            self._observe(lambda route: NODE_DURATION.labels(node, route, status).observe(duration))
+        else:
+            self._set_route(UNKNOWN_ROUTE)
+            self._observe(lambda route: WORKFLOW_DURATION.labels(route, status).observe(duration))
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end_chain(run_id, "success", outputs)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end_chain(run_id, "error")
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        metadata = metadata or {}
+        labels = (
+            metadata.get("langgraph_node", "none"),
+            metadata.get("ls_provider", "unknown"),
+            metadata.get("ls_model_name", "unknown"),
+        )
+        prompt_tokens = sum(estimate_tokens(prompt) for prompt in messages)
+        self._runs[run_id] = ("llm", (labels, prompt_tokens), time.perf_counter())
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        _, ((node, provider, model), estimated_prompt_tokens), start = run
+        duration = time.perf_counter() - start
+        prompt_tokens, completion_tokens = get_token_usage(response, estimated_prompt_tokens)
+
+        def observe(route):
+            LLM_DURATION.labels(node, route, provider, model, "success").observe(duration)
+            for token_type, tokens in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+                LLM_TOKENS.labels(node, route, provider, model, token_type).observe(tokens)
+                LLM_TOKENS_TOTAL.labels(node, route, provider, model, token_type).inc(tokens)
+        self._observe(observe)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        _, ((node, provider, model), _), start = run
+        duration = time.perf_counter() - start
+        self._observe(lambda route: LLM_DURATION.labels(node, route, provider, model, "error").observe(duration))
+
+
+class StatsCollector:
+    """
+    Exports the `stats()` of the caches, rate limiters and failover router as
+    gauges, read when the metrics are scraped. Numeric values become gauges,
+    nested dicts become a `key` label.
+    """
+
+    def __init__(self):
+        self.sources = {}
+
+    def register(self, name, get_stats, label=None):
+        """`label` names the top-level keys of sources keyed by e.g. provider."""
+        self.sources[name] = (get_stats, label)
+
+    def collect(self):
+        for name, (get_stats, label) in list(self.sources.items()):
+            try:
+                stats = get_stats() or {}
+            except Exception as e:
+                logger.warning(f"Unable to read the {name} stats: {e}")
+                continue
+            groups = stats.items() if label else [(None, stats)]
+            families = {}
+            for group, values in groups:
+                for key, value in (values or {}).items():
+                    items = value.items() if isinstance(value, dict) else [(None, value)]
+                    for item, number in items:
+                        if isinstance(number, bool):
+                            number = int(number)
+                        if not isinstance(number, (int, float)):
+                            continue
+                        labels = ([label] if label else []) + (["key"] if item is not None else [])
+                        family_key = (key, tuple(labels))
+                        if family_key not in families:
+                            families[family_key] = GaugeMetricFamily(
+                                f"querygenai_{name}_{key}", f"{name} {key}", labels=labels)
+                        families[family_key].add_metric(
+                            ([group] if label else []) + ([str(item)] if item is not None else []), number)
+            yield from families.values()
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+def get_metrics_callbacks():
+    """Callbacks to add to the graph config of a request."""
+    return [MetricsCallbackHandler()] if METRICS_ENABLED else []
@@ -1,102 +1,312 @@
-from pymongo import MongoClient
 from langchain.chains import LLMChain
-from quality_agent.llmManager import LLMManager
-from datetime import datetime
-from prompts.inspectionPrompt import get_sample_analytics_mongodb_prompt, query_examples, get_fetch_collections_prompt,get_fetch_sales_prompt, all_schemas, sales_schema, sale_query_examples
+from langgraph.constants import TAG_NOSTREAM
+from quality_agent.llmManager import get_llm_manager
+from prompts.inspectionPrompt import all_schemas
+from prompts.promptRegistry import get_prompt
 from quality_agent.logger import setup_logger
-import re
+from quality_agent.database import get_app_db, get_sales_db, get_async_sales_db, use_async_client
+from quality_agent.batch import deduplicate
+from quality_agent.pipeline_cache import pipeline_cache, PIPELINE_CACHE_ENABLED
+from quality_agent.pipeline_parser import parse_pipeline, parse_document, validate_pipeline, PipelineParseError
+from quality_agent.metrics import record_mongo_operation, METRICS_ENABLED
+from quality_agent.pipeline_guard import pipeline_guard, PipelineRejectedError
+from quality_agent.index_advisor import index_advisor
+from quality_agent.rollups import rollup_manager
+from quality_agent.aggregation_cache import aggregation_cache, canonicalize, encode_documents
+from quality_agent.speculation import speculation_manager, current_speculation_id
+import asyncio
 import os
 import json
-from bson.decimal128 import Decimal128
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
 logger = setup_logger(__name__)
 
-client = MongoClient(os.getenv('MONGODB_CONNECTION_STRING'))
-db = client[os.getenv('MONGODB_DATABASE_NAME')]
-sales_db = client[os.getenv('MONGODB_SALES_DATABASE_NAME')]
+# Documents fetched per round trip while streaming aggregation results
+MONGO_BATCH_SIZE = int(os.getenv("MONGO_BATCH_SIZE", "500"))
+# Hard cap on the rows a single pipeline returns to the agent and chart stages
+MONGO_MAX_ROWS = int(os.getenv("MONGO_MAX_ROWS", "5000"))
 # collection = db["movies"]
-llm = LLMManager().llm
+llm = get_llm_manager().llm
 
 
 nosql_llm_chain = LLMChain(
-    llm=llm, prompt=get_sample_analytics_mongodb_prompt(), verbose=True)
+    llm=llm, prompt=get_prompt("analytics_pipeline"), verbose=True)
 
-fetch_collections_llm_chain = LLMChain(llm=llm, prompt=get_fetch_collections_prompt(), verbose=True)
+fetch_collections_llm_chain = LLMChain(llm=llm, prompt=get_prompt("fetch_collections"), verbose=True)
 
-fetch_sales_llm_chain = LLMChain(llm=llm, prompt=get_fetch_sales_prompt(), verbose=True)
+# The pipeline is an intermediate result, so its tokens are kept out of the
+# `messages` stream that feeds the `/query/stream` endpoint.
+fetch_sales_llm_chain = LLMChain(
+    llm=llm.with_config(tags=[TAG_NOSTREAM]), prompt=get_prompt("sales_pipeline"), verbose=True)
 
 
-def iso_date_replacer(match):
-    iso_date_str = match.group(1)
-    # Convert the extracted string into a Python datetime object
-    return f'datetime.fromisoformat("{iso_date_str[:-1]}")'
+def get_sales_pipeline(llm_output):
+    """
+    Converts the raw LLM output for the sales prompt into an aggregation pipeline.
+    """
+    try:
+        pipeline = parse_pipeline(llm_output)
+    except PipelineParseError as e:
+        logger.error(f"Invalid pipeline generated: {e}")
+        raise
+
+    logger.info(f"Query generated: {pipeline}")
+    # pipeline.append({
+    #     "$project": {"audit": 0}
+    # })
+    return pipeline
+
+
+def get_capped_pipeline(pipeline, max_rows):
+    # The extra document tells the caller that the result was truncated
+    return list(pipeline) + [{"$limit": max_rows + 1}]
+
+
+def iter_pipeline_results(collection, pipeline, batch_size=MONGO_BATCH_SIZE):
+    """
+    Streams the results of an aggregation pipeline checked by the pipeline
+    guard, fetching `batch_size` documents per round trip. Decimal128 and
+    ObjectId values are already converted by the codec options of the database.
+    """
+    with collection.aggregate(pipeline, batchSize=batch_size,
+                              **pipeline_guard.get_aggregate_options()) as cursor:
+        yield from cursor
+
+
+def collect_pipeline_results(collection, pipeline, max_rows=MONGO_MAX_ROWS):
+    """
+    Executes the aggregation pipeline and keeps at most `max_rows` documents.
+    Returns the documents together with the truncation metadata, and whether
+    they are partial because the pipeline guard bounded the scan. Complete
+    results are reused from the aggregation cache until the collection is
+    written to.
+    """
+    cache_key = aggregation_cache.get_key(collection, pipeline, max_rows)
+    if cache_key is not None:
+        cached = aggregation_cache.lookup(cache_key)
+        if cached is not None:
+            return cached
+        generation = aggregation_cache.generation(cache_key)
+    documents = []
+    truncated = False
+    start = time.perf_counter()
+    try:
+        guarded_pipeline, partial = pipeline_guard.check(collection, get_capped_pipeline(pipeline, max_rows))
+        for doc in iter_pipeline_results(collection, guarded_pipeline):
+            if len(documents) == max_rows:
+                truncated = True
+                break
+            documents.append(doc)
+    except PipelineRejectedError:
+        raise
+    except Exception:
+        record_mongo_operation("aggregate", collection.name, time.perf_counter() - start, "error")
+        raise
+    # The payload metric and the aggregation cache share the BSON of the documents
+    encoded = encode_documents(documents) if METRICS_ENABLED or cache_key is not None else None
+    result = get_pipeline_result(collection, pipeline, documents, truncated, max_rows, start, encoded, partial)
+    # The bound of a rewritten scan depends on the collection size at the time
+    if cache_key is not None and not partial:
+        aggregation_cache.store(cache_key, generation, result, encoded)
+    return result
+
 
-def convert_decimal128_to_float(record):
+async def acollect_pipeline_results(collection, pipeline, max_rows=MONGO_MAX_ROWS, batch_size=MONGO_BATCH_SIZE):
     """
-    Recursively converts Decimal128 fields in a MongoDB record to float.
+    Async variant of `collect_pipeline_results` for a collection of the
+    asyncio driver, the batches are fetched without blocking the event loop.
     """
-    if isinstance(record, list):
-        # Process each element if it's a list
-        return [convert_decimal128_to_float(item) for item in record]
-    elif isinstance(record, dict):
-        # Process each key-value pair if it's a dictionary
-        return {
-            key: convert_decimal128_to_float(value)
-            for key, value in record.items()
-        }
-    elif isinstance(record, Decimal128):
-        # Convert Decimal128 to a float
-        return float(record.to_decimal())
-    else:
-        # Return other types as-is
-        return record
+    cache_key = aggregation_cache.get_key(collection, pipeline, max_rows)
+    if cache_key is not None:
+        cached = aggregation_cache.lookup(cache_key)
+        if cached is not None:
+            return cached
+        generation = aggregation_cache.generation(cache_key)
+    documents = []
+    truncated = False
+    start = time.perf_counter()
+    try:
+        guarded_pipeline, partial = await pipeline_guard.acheck(collection, get_capped_pipeline(pipeline, max_rows))
+        async with await collection.aggregate(guarded_pipeline, batchSize=batch_size,
+                                              **pipeline_guard.get_aggregate_options()) as cursor:
+            async for doc in cursor:
+                if len(documents) == max_rows:
+                    truncated = True
+                    break
+                documents.append(doc)
+    except PipelineRejectedError:
+        raise
+    except Exception:
+        record_mongo_operation("aggregate", collection.name, time.perf_counter() - start, "error")
+        raise
+    # The payload metric and the aggregation cache share the BSON of the documents
+    encoded = encode_documents(documents) if METRICS_ENABLED or cache_key is not None else None
+    result = get_pipeline_result(collection, pipeline, documents, truncated, max_rows, start, encoded, partial)
+    # The bound of a rewritten scan depends on the collection size at the time
+    if cache_key is not None and not partial:
+        aggregation_cache.store(cache_key, generation, result, encoded)
+    return result
+
+
+def get_pipeline_result(collection, pipeline, documents, truncated, max_rows, start, encoded=None, partial=False):
+    seconds = time.perf_counter() - start
+    index_advisor.record(collection.full_name, pipeline, seconds)
+    record_mongo_operation(
+        "aggregate", collection.name, seconds, rows=len(documents),
+        payload_bytes=sum(len(doc) for doc in encoded) if METRICS_ENABLED and encoded is not None else None)
+    if truncated:
+        logger.warning(f"Pipeline result truncated to {max_rows} rows")
+    if partial:
+        logger.warning("Pipeline result only covers the documents the rewritten pipeline read")
+    return {"documents": documents, "truncated": truncated, "max_rows": max_rows, "partial": partial}
+
+
+def run_sales_pipeline(pipeline):
+    """
+    Executes the aggregation pipeline on the sales collection.
+    Returns the records capped at `MONGO_MAX_ROWS` and whether they were truncated.
+    Eligible pipelines are answered from the rollup collections.
+    """
+    return collect_pipeline_results(*rollup_manager.route(get_sales_db(), pipeline))
+
+
+def get_cached_sales_pipeline(query):
+    return pipeline_cache.lookup(query) if PIPELINE_CACHE_ENABLED else None
+
+
+def cache_sales_pipeline(query, pipeline):
+    if PIPELINE_CACHE_ENABLED:
+        pipeline_cache.store(query, pipeline)
+
+
+def generate_sales_pipeline(query):
+    """
+    Generates the aggregation pipeline for the sales collection from the user question.
+    Questions with the same shape as an earlier one reuse its pipeline template.
+    """
+    pipeline = get_cached_sales_pipeline(query)
+    if pipeline is not None:
+        return pipeline
+    # The schema and examples are rendered into the prompt template
+    response = fetch_sales_llm_chain.invoke({"user_question": query})
+    pipeline = get_sales_pipeline(response['text'])
+    cache_sales_pipeline(query, pipeline)
+    return pipeline
+
+
+async def agenerate_sales_pipeline(query):
+    """
+    Async variant of `generate_sales_pipeline`. Identical questions within a
+    batch share one LLM call.
+    """
+    async def generate():
+        pipeline = get_cached_sales_pipeline(query)
+        if pipeline is not None:
+            return pipeline
+        response = await fetch_sales_llm_chain.ainvoke({"user_question": query})
+        pipeline = get_sales_pipeline(response['text'])
+        cache_sales_pipeline(query, pipeline)
+        return pipeline
+
+    return await deduplicate("sales_pipeline", query, generate)
+
+
+async def atake_or_generate_sales_pipeline(query, speculation_id=None):
+    """
+    Sales pipeline of the question, taken from the speculative run started
+    for it during routing when there is one. The speculation defaults to the
+    one kept for the current request.
+    """
+    pipeline = await speculation_manager.take(
+        speculation_id or current_speculation_id.get(), f"pipeline:{query}")
+    if pipeline is None:
+        pipeline = await agenerate_sales_pipeline(query)
+    return pipeline
+
+
+async def arun_sales_pipeline(pipeline):
+    """
+    Async variant of `run_sales_pipeline`. The aggregation runs on the asyncio
+    driver when MONGODB_ASYNC_ENABLED, otherwise the blocking one is offloaded
+    to a worker thread. Identical pipelines within a batch share one call.
+    """
+    def run():
+        if use_async_client():
+            return acollect_pipeline_results(*rollup_manager.route(get_async_sales_db(), pipeline))
+        return asyncio.to_thread(run_sales_pipeline, pipeline)
+
+    # Only the fields of `$match` may be reordered, a `$sort` or `$project`
+    # with the keys in another order is another pipeline
+    return await deduplicate("sales_aggregate", canonicalize(pipeline), run)
+
+
+def get_sales_tool_output(result):
+    """
+    Shapes a pipeline result for the agent, which must know when it only sees
+    the first rows of the result, or a result computed on part of the data.
+    """
+    return {
+        "records": result["documents"],
+        "truncated": result["truncated"],
+        "row_limit": result["max_rows"],
+        "partial": result["partial"],
+    }
+
+
+def get_rejected_tool_output(error):
+    """Tells the agent why the pipeline guard refused the query, so it can narrow it."""
+    return {"records": [], "truncated": False, "row_limit": MONGO_MAX_ROWS, "partial": False, "rejected": str(error)}
+
 
 def get_sales_data(query):
     try:
         logger.info(f"Executing query: {query}")
-        response = fetch_sales_llm_chain.invoke(
-            {
-                "user_question": query,
-                "collection_schema": sales_schema,
-                **sale_query_examples
-            })
-        iso_date_pattern = re.compile(r'ISODate\("([^"]+)"\)')
-        query_modified = re.sub(
-            iso_date_pattern, iso_date_replacer, response['text'])
-        query_modified = query_modified.replace('null', 'None').replace(
-            '```json', '').replace('```', '').replace('\n', '')
-        
-        logger.info(f"Query generated: {query_modified}")
-
-        try:
-            # Safely parse the modified query string
-            pipeline = eval(query_modified)
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error: {e}")
-            logger.error(f"Query: {query_modified}")
-            pipeline = json.loads(query_modified)
-
-        logger.info(f"Query generated: {pipeline}")
-        # pipeline.append({
-        #     "$project": {"audit": 0}
-        # })
-
-        collection = sales_db["sales"]
-        results = collection.aggregate(pipeline)
-        documents = []
-        for doc in results:
-            documents.append(doc)
-        converted_records = [
-        convert_decimal128_to_float(record) for record in documents
-    ]
-        return converted_records
+        pipeline = generate_sales_pipeline(query)
+        return get_sales_tool_output(run_sales_pipeline(pipeline))
+    except PipelineRejectedError as e:
+        return get_rejected_tool_output(e)
     except Exception as e:
         logger.error(f"Error retrieving msales data: {e}")
         raise
 
+
+async def aget_sales_data(query):
+    """
+    Async variant of `get_sales_data`. The LLM call is awaited and the blocking
+    PyMongo aggregation is offloaded to a worker thread, so the event loop stays free.
+    """
+    try:
+        logger.info(f"Executing query: {query}")
+        pipeline = await atake_or_generate_sales_pipeline(query)
+        return get_sales_tool_output(await arun_sales_pipeline(pipeline))
+    except PipelineRejectedError as e:
+        return get_rejected_tool_output(e)
+    except Exception as e:
+        logger.error(f"Error retrieving msales data: {e}")
+        raise
+
+
+def get_sales_data_version():
+    """
+    Returns a cheap stamp that changes when documents are added to the sales
+    collection. Updates, and deletes that keep the latest `_id` and the
+    estimated count, leave it unchanged; the writes of the application are
+    caught by `get_sales_write_generation` instead.
+    """
+    collection = get_sales_db()["sales"]
+    latest = collection.find_one({}, projection={"_id": 1}, sort=[("_id", -1)])
+    latest_id = latest["_id"] if latest else None
+    return f"{collection.estimated_document_count()}:{latest_id}"
+
+
+def get_sales_write_generation():
+    """Writes to the sales collection seen by the application, see `AggregationResultCache.invalidate`."""
+    return aggregation_cache.collection_generation(get_sales_db()["sales"].full_name)
+
+
 def get_analytics_data(query):
     try:
         logger.info(f"Executing query: {query}")
@@ -119,47 +329,28 @@ def get_analytics_data(query):
         response = nosql_llm_chain.invoke(
             {
                 "user_question": query,
-                "collection_schemas": collection_schemas,
-                **query_examples
+                "collection_schemas": collection_schemas
             })
                 
                 
-        response = response['text'].replace(
-            '```json', '').replace('```', '').replace('\n', '')
-        
-        logger.info(f"Final Response: {response}")
+        logger.info(f"Final Response: {response['text']}")
 
-        response = json.loads(response)
+        response = parse_document(response['text'])
 
         base_collection = response['base_collection']
 
-        pipeline = str(response['pipeline'])
-
-        iso_date_pattern = re.compile(r'ISODate\("([^"]+)"\)')
-        query_modified = re.sub(
-            iso_date_pattern, iso_date_replacer, pipeline)
-        query_modified = query_modified.replace('null', 'None').replace(
-            '```json', '').replace('```', '').replace('\n', '')
-        try:
-            # Safely parse the modified query string
-            pipeline = eval(query_modified)
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error: {e}")
-            logger.error(f"Query: {query_modified}")
-            pipeline = json.loads(query_modified)
+        pipeline = validate_pipeline(response['pipeline'])
 
         logger.info(f"Final Query generated: {pipeline}")
         pipeline.append({
             "$project": {"audit": 0}
         })
 
-        collection = db[base_collection]
+        collection = get_app_db()[base_collection]
         logger.info(f"Executing pipeline...")
-        results = collection.aggregate(pipeline)
-        documents = []
-        for doc in results:
-            documents.append(doc)
-        return documents
+        return get_sales_tool_output(collect_pipeline_results(collection, pipeline))
+    except PipelineRejectedError as e:
+        return get_rejected_tool_output(e)
     except Exception as e:
         logger.error(f"Error retrieving analytics data: {e}")
         raise
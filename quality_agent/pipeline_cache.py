@@ -0,0 +1,239 @@
+import copy
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from prompts.inspectionPrompt import sales_schema, sales_schema_fields, sales_store_locations, sales_purchase_methods
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+PIPELINE_CACHE_ENABLED = os.getenv("PIPELINE_CACHE_ENABLED", "true") == "true"
+PIPELINE_CACHE_MAX_ENTRIES = int(os.getenv("PIPELINE_CACHE_MAX_ENTRIES", "256"))
+
+# Questions relative to the current date depend on `present_date` in the prompt
+RELATIVE_TIME_PATTERN = re.compile(
+    r"\b(today|yesterday|tomorrow|now|current|currently|recent|recently|last|this|past|previous|next|ago)\b",
+    re.IGNORECASE)
+
+SLOT_PATTERNS = [
+    ("store", re.compile(
+        r"\b(" + "|".join(re.escape(value) for value in sales_store_locations) + r")\b", re.IGNORECASE)),
+    ("method", re.compile(
+        r"\b(" + "|".join(re.escape(value) for value in sales_purchase_methods) + r")\b", re.IGNORECASE)),
+    ("year", re.compile(r"\b((?:19|20)\d{2})\b")),
+    ("number", re.compile(r"\b(\d+)\b")),
+]
+
+CANONICAL_VALUES = {
+    value.lower(): value for value in sales_store_locations + sales_purchase_methods
+}
+
+# Stages after which documents no longer have the collection's shape
+RESHAPING_STAGES = {
+    "$group", "$project", "$addFields", "$set", "$replaceRoot", "$replaceWith",
+    "$lookup", "$facet", "$bucket", "$bucketAuto", "$count", "$sortByCount", "$unset",
+}
+
+SCHEMA_VERSION = hashlib.sha256(sales_schema.encode("utf-8")).hexdigest()[:12]
+
+
+class Slot:
+    """Placeholder for a question literal inside a pipeline template."""
+
+    def __init__(self, index, kind, original=None, offset=0):
+        self.index = index
+        self.kind = kind
+        self.original = original
+        self.offset = offset
+
+    def fill(self, values):
+        value = values[self.index]
+        if self.kind == "year":
+            return self.original.replace(year=int(value) + self.offset)
+        if self.kind == "number":
+            return int(value)
+        return value
+
+
+def extract_slots(question):
+    """
+    Replaces the literals of a question (store locations, purchase methods,
+    years and numbers) with slots. Returns the question template and the slot
+    (kind, value) pairs in order of appearance.
+    """
+    matches = []
+    taken = []
+    for kind, pattern in SLOT_PATTERNS:
+        for match in pattern.finditer(question):
+            if any(start < match.end() and match.start() < end for start, end in taken):
+                continue
+            taken.append((match.start(), match.end()))
+            value = match.group(1)
+            matches.append((match.start(), match.end(), kind, CANONICAL_VALUES.get(value.lower(), value)))
+    matches.sort()
+
+    template = []
+    slots = []
+    position = 0
+    for start, end, kind, value in matches:
+        template.append(question[position:start])
+        template.append(f"{{{kind}}}")
+        slots.append((kind, value))
+        position = end
+    template.append(question[position:])
+    template = re.sub(r"\s+", " ", "".join(template).lower()).strip(" ?.!")
+    return template, slots
+
+
+def templatize(node, slots, usage):
+    """
+    Returns a copy of the pipeline where the values of the slots are replaced
+    by `Slot` placeholders and counts how often each slot was used.
+    """
+    if isinstance(node, list):
+        return [templatize(item, slots, usage) for item in node]
+    if isinstance(node, dict):
+        return {key: templatize(value, slots, usage) for key, value in node.items()}
+    for index, (kind, value) in enumerate(slots):
+        if kind in ("store", "method") and isinstance(node, str) and node == value:
+            usage[index] += 1
+            return Slot(index, kind)
+        # Year ranges end at the start of the next year
+        if kind == "year" and isinstance(node, datetime) and node.year - int(value) in (0, 1):
+            usage[index] += 1
+            return Slot(index, kind, original=node, offset=node.year - int(value))
+        if kind == "number" and type(node) is int and node == int(value):
+            usage[index] += 1
+            return Slot(index, kind)
+    return node
+
+
+def fill_template(node, values):
+    if isinstance(node, list):
+        return [fill_template(item, values) for item in node]
+    if isinstance(node, dict):
+        return {key: fill_template(value, values) for key, value in node.items()}
+    if isinstance(node, Slot):
+        return node.fill(values)
+    return copy.copy(node)
+
+
+def get_referenced_fields(pipeline):
+    """
+    Collects the collection fields a pipeline refers to before its first
+    reshaping stage, where field names still come from the schema.
+    """
+    fields = set()
+
+    def collect(node, in_match):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if in_match and not key.startswith("$"):
+                    fields.add(key)
+                collect(value, in_match)
+        elif isinstance(node, list):
+            for item in node:
+                collect(item, in_match)
+        elif isinstance(node, str) and node.startswith("$") and not node.startswith("$$"):
+            fields.add(node[1:])
+
+    for stage in pipeline:
+        if not isinstance(stage, dict) or not stage:
+            continue
+        stage_name = next(iter(stage))
+        if stage_name in RESHAPING_STAGES:
+            break
+        collect(stage[stage_name], stage_name == "$match")
+        if stage_name == "$sort":
+            fields.update(stage[stage_name].keys())
+    return fields
+
+
+def is_valid_for_schema(pipeline):
+    for field in get_referenced_fields(pipeline):
+        if field not in sales_schema_fields:
+            logger.info(f"Pipeline refers to unknown field '{field}', not caching it")
+            return False
+    return True
+
+
+class PipelineTemplateCache:
+    """
+    LRU cache of generated pipelines keyed by the shape of the question. A
+    question that only differs by its literals reuses the template with the
+    new values and skips the LLM call.
+    """
+
+    def __init__(self, max_entries=PIPELINE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    def lookup(self, question):
+        if RELATIVE_TIME_PATTERN.search(question):
+            return None
+        template, slots = extract_slots(question)
+        key = (SCHEMA_VERSION, template, tuple(kind for kind, _ in slots))
+        with self._lock:
+            pipeline_template = self._entries.get(key)
+            if pipeline_template is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        try:
+            pipeline = fill_template(pipeline_template, [value for _, value in slots])
+        except ValueError as e:
+            # e.g. February 29th moved to a year that is not a leap year
+            logger.info(f"Unable to fill pipeline template: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        logger.info(f"Pipeline cache hit for template: {template}")
+        return pipeline
+
+    def store(self, question, pipeline):
+        if RELATIVE_TIME_PATTERN.search(question) or not isinstance(pipeline, list):
+            return
+        template, slots = extract_slots(question)
+        usage = [0] * len(slots)
+        pipeline_template = templatize(pipeline, slots, usage)
+
+        # Every literal of the question must map to the pipeline, and numbers
+        # must map to exactly one place to be substituted safely
+        ambiguous = any(
+            count == 0 or (kind == "number" and count > 1)
+            for count, (kind, _) in zip(usage, slots)
+        )
+        values = [value for _, value in slots]
+        if ambiguous or len(set(values)) != len(values) or not is_valid_for_schema(pipeline):
+            self.rejected += 1
+            return
+
+        key = (SCHEMA_VERSION, template, tuple(kind for kind, _ in slots))
+        with self._lock:
+            self._entries[key] = pipeline_template
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "rejected": self.rejected,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+pipeline_cache = PipelineTemplateCache()
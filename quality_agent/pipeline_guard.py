@@ -0,0 +1,361 @@
+import os
+import threading
+import time
+from collections import Counter
+from quality_agent.cassette import cassette
+from quality_agent.logger import setup_logger
+from quality_agent.metrics import record_pipeline_guard
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = setup_logger(__name__)
+
+PIPELINE_GUARD_ENABLED = os.getenv("PIPELINE_GUARD_ENABLED", "true") == "true"
+# Server-side time limit of every generated aggregation, 0 disables it
+PIPELINE_MAX_TIME_MS = int(os.getenv("PIPELINE_MAX_TIME_MS", "30000"))
+# Collection scans examining more documents than this are rejected or rewritten
+PIPELINE_GUARD_MAX_SCAN_DOCS = int(os.getenv("PIPELINE_GUARD_MAX_SCAN_DOCS", "100000"))
+# "reject" refuses the pipeline, "rewrite" bounds the scan to the newest
+# PIPELINE_GUARD_MAX_SCAN_DOCS documents (the answer then only covers those),
+# "log" only logs the decision
+PIPELINE_GUARD_ACTION = os.getenv("PIPELINE_GUARD_ACTION", "reject")
+# "queryPlanner" only plans the pipeline, documents examined by a collection
+# scan are estimated from the collection size. "executionStats" runs it
+# (bounded by PIPELINE_MAX_TIME_MS) and reports the documents examined.
+PIPELINE_GUARD_VERBOSITY = os.getenv("PIPELINE_GUARD_VERBOSITY", "queryPlanner")
+# Collections up to this size may be joined ($lookup, $graphLookup) without
+# an index on the join field, larger ones are scanned once per input document
+PIPELINE_GUARD_MAX_LOOKUP_SCAN_DOCS = int(os.getenv("PIPELINE_GUARD_MAX_LOOKUP_SCAN_DOCS", "1000"))
+# Seconds the collection sizes and indexes used for the estimate are reused
+PIPELINE_GUARD_COUNT_TTL_SECONDS = float(os.getenv("PIPELINE_GUARD_COUNT_TTL_SECONDS", "60"))
+
+PIPELINE_GUARD_ACTIONS = ("reject", "rewrite", "log")
+# Stages reading another collection of the database
+FOREIGN_STAGES = ("$lookup", "$graphLookup", "$unionWith")
+
+
+class PipelineRejectedError(ValueError):
+    """Raised when a generated pipeline would scan too many documents."""
+
+
+def get_explain_command(collection, pipeline, max_time_ms):
+    command = {"explain": {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}},
+               "verbosity": PIPELINE_GUARD_VERBOSITY}
+    if max_time_ms:
+        command["maxTimeMS"] = max_time_ms
+    return command
+
+
+def find_plan_stages(node, in_plan=False):
+    """Yields the stage names of the winning plans anywhere in an explain output."""
+    if isinstance(node, dict):
+        if in_plan and isinstance(node.get("stage"), str):
+            yield node["stage"]
+        for key, value in node.items():
+            yield from find_plan_stages(value, in_plan or key == "winningPlan")
+    elif isinstance(node, list):
+        for item in node:
+            yield from find_plan_stages(item, in_plan)
+
+
+def find_docs_examined(node):
+    """Sum of `totalDocsExamined` of an executionStats explain output, None when absent."""
+    if isinstance(node, dict):
+        if "executionStats" in node and isinstance(node["executionStats"], dict):
+            return node["executionStats"].get("totalDocsExamined")
+        found = [find_docs_examined(value) for value in node.values()]
+    elif isinstance(node, list):
+        found = [find_docs_examined(item) for item in node]
+    else:
+        return None
+    found = [docs for docs in found if docs is not None]
+    return sum(found) if found else None
+
+
+def find_foreign_docs_examined(node):
+    """
+    Sum of the `totalDocsExamined` the executionStats explain output reports
+    for the $lookup, $graphLookup and $unionWith stages, None when absent.
+    """
+    if isinstance(node, dict):
+        if "totalDocsExamined" in node and any(stage in node for stage in FOREIGN_STAGES):
+            return node["totalDocsExamined"]
+        found = [find_foreign_docs_examined(value) for value in node.values()]
+    elif isinstance(node, list):
+        found = [find_foreign_docs_examined(item) for item in node]
+    else:
+        return None
+    found = [docs for docs in found if docs is not None]
+    return sum(found) if found else None
+
+
+def get_match_fields(pipeline):
+    """Fields a leading `$match` of `pipeline` filters on, including `$expr` equalities of a field."""
+    if not pipeline or not isinstance(pipeline[0], dict) or not isinstance(pipeline[0].get("$match"), dict):
+        return ()
+    match = pipeline[0]["$match"]
+    fields = [field for field in match if not field.startswith("$")]
+    expression = match.get("$expr")
+    if isinstance(expression, dict) and isinstance(expression.get("$eq"), list):
+        fields += [operand[1:] for operand in expression["$eq"]
+                   if isinstance(operand, str) and operand.startswith("$") and not operand.startswith("$$")]
+    return tuple(fields)
+
+
+def get_foreign_reads(pipeline, top_level=True):
+    """
+    Yields a dict per stage reading another collection: its position in the
+    pipeline (None when nested), the stage, the collection, the fields an
+    index could serve the read with and whether it runs per input document.
+    """
+    for position, stage in enumerate(pipeline):
+        if not isinstance(stage, dict) or len(stage) != 1:
+            continue
+        name, body = next(iter(stage.items()))
+        read = None
+        if name == "$lookup" and isinstance(body, dict):
+            fields = (body["foreignField"],) if "foreignField" in body else get_match_fields(body.get("pipeline"))
+            # An uncorrelated sub-pipeline is run once, not per input document
+            read = {"collection": body.get("from"), "fields": fields,
+                    "per_document": "localField" in body or "let" in body}
+        elif name == "$graphLookup" and isinstance(body, dict):
+            read = {"collection": body.get("from"), "fields": (body.get("connectToField"),), "per_document": True}
+        elif name == "$unionWith":
+            body = body if isinstance(body, dict) else {"coll": body}
+            read = {"collection": body.get("coll"), "fields": get_match_fields(body.get("pipeline")),
+                    "per_document": False}
+        if read is not None and isinstance(read["collection"], str):
+            yield {"position": position if top_level else None, "stage": name, **read}
+        if isinstance(body, dict):
+            nested = [body.get("pipeline")] if name in FOREIGN_STAGES else []
+            if name == "$facet":
+                nested = list(body.values())
+            for sub_pipeline in nested:
+                if isinstance(sub_pipeline, list):
+                    yield from get_foreign_reads(sub_pipeline, top_level=False)
+
+
+def bound_scan(pipeline, max_docs):
+    """Restricts the pipeline to the `max_docs` newest documents, through the `_id` index."""
+    return [{"$sort": {"_id": -1}}, {"$limit": max_docs}] + list(pipeline)
+
+
+class PipelineGuard:
+    """
+    Explains a generated pipeline before it runs and rejects or rewrites
+    the ones that would scan more than `max_scan_docs` documents, or join a
+    collection larger than `max_lookup_scan_docs` without an index on the
+    join field. The `$limit` on the returned rows is added by the caller
+    (MONGO_MAX_ROWS), the guard adds the `maxTimeMS` options of the aggregation.
+    The checks return the pipeline to run and whether it was rewritten, the
+    result of a rewritten pipeline only covers part of the data.
+    """
+
+    def __init__(self, max_scan_docs=PIPELINE_GUARD_MAX_SCAN_DOCS, action=PIPELINE_GUARD_ACTION,
+                 max_time_ms=PIPELINE_MAX_TIME_MS, count_ttl=PIPELINE_GUARD_COUNT_TTL_SECONDS,
+                 max_lookup_scan_docs=PIPELINE_GUARD_MAX_LOOKUP_SCAN_DOCS):
+        if action not in PIPELINE_GUARD_ACTIONS:
+            raise ValueError(f"Unknown pipeline guard action '{action}', expected one of {PIPELINE_GUARD_ACTIONS}")
+        self.max_scan_docs = max_scan_docs
+        self.action = action
+        self.max_time_ms = max_time_ms
+        self.count_ttl = count_ttl
+        self.max_lookup_scan_docs = max_lookup_scan_docs
+        self._counts = {}
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self.decisions = Counter()
+
+    def get_aggregate_options(self):
+        return {"maxTimeMS": self.max_time_ms} if self.max_time_ms else {}
+
+    def _get_cached_count(self, collection):
+        with self._lock:
+            entry = self._counts.get(collection.full_name)
+        if entry and time.monotonic() - entry[1] < self.count_ttl:
+            return entry[0]
+        return None
+
+    def _cache_count(self, collection, count):
+        with self._lock:
+            self._counts[collection.full_name] = (count, time.monotonic())
+
+    def _get_cached_indexes(self, collection):
+        with self._lock:
+            entry = self._indexes.get(collection.full_name)
+        if entry and time.monotonic() - entry[1] < self.count_ttl:
+            return entry[0]
+        return None
+
+    def _cache_indexes(self, collection, index_information):
+        # Only the leading key of an index serves an equality on a single field
+        fields = {"_id"} | {index["key"][0][0] for index in index_information.values() if index.get("key")}
+        with self._lock:
+            self._indexes[collection.full_name] = (fields, time.monotonic())
+        return fields
+
+    def get_foreign_reads(self, collection, pipeline):
+        """The foreign reads of the pipeline with the size and the indexed fields of their collections."""
+        reads = []
+        for read in get_foreign_reads(pipeline):
+            foreign = collection.database[read["collection"]]
+            count = self._get_cached_count(foreign)
+            if count is None:
+                count = foreign.estimated_document_count()
+                self._cache_count(foreign, count)
+            indexed = self._get_cached_indexes(foreign)
+            if indexed is None:
+                indexed = self._cache_indexes(foreign, foreign.index_information())
+            reads.append({**read, "count": count, "indexed": bool(indexed & set(read["fields"]))})
+        return reads
+
+    async def aget_foreign_reads(self, collection, pipeline):
+        """Async variant of `get_foreign_reads`."""
+        reads = []
+        for read in get_foreign_reads(pipeline):
+            foreign = collection.database[read["collection"]]
+            count = self._get_cached_count(foreign)
+            if count is None:
+                count = await foreign.estimated_document_count()
+                self._cache_count(foreign, count)
+            indexed = self._get_cached_indexes(foreign)
+            if indexed is None:
+                indexed = self._cache_indexes(foreign, await foreign.index_information())
+            reads.append({**read, "count": count, "indexed": bool(indexed & set(read["fields"]))})
+        return reads
+
+    def get_foreign_scans(self, explain, foreign_reads):
+        """
+        Foreign reads without an index that examine too many documents. The
+        documents examined reported by an executionStats explain take
+        precedence over the collection sizes.
+        """
+        docs_examined = find_foreign_docs_examined(explain)
+        scans = []
+        for read in foreign_reads:
+            if read["indexed"]:
+                continue
+            if docs_examined is not None:
+                too_many = docs_examined > self.max_scan_docs
+            elif read["per_document"]:
+                too_many = read["count"] > self.max_lookup_scan_docs
+            else:
+                too_many = read["count"] > self.max_scan_docs
+            if too_many:
+                scans.append(read)
+        return scans
+
+    def bound_foreign_scans(self, pipeline, scans):
+        """
+        Caps the input documents of each join and the documents each union
+        reads, returns None when a scan is nested and cannot be bounded.
+        """
+        if any(scan["position"] is None for scan in scans):
+            return None
+        pipeline = list(pipeline)
+        for scan in sorted(scans, key=lambda scan: scan["position"], reverse=True):
+            position = scan["position"]
+            if scan["per_document"]:
+                pipeline.insert(position, {"$limit": max(1, self.max_scan_docs // max(scan["count"], 1))})
+            else:
+                body = pipeline[position]["$unionWith"]
+                body = body if isinstance(body, dict) else {"coll": body}
+                pipeline[position] = {"$unionWith": {
+                    **body, "pipeline": bound_scan(body.get("pipeline", []), self.max_scan_docs)}}
+        return pipeline
+
+    def _record(self, collection, decision):
+        with self._lock:
+            self.decisions[decision] += 1
+        record_pipeline_guard(collection.name, decision)
+
+    def decide(self, collection, pipeline, explain, collection_count, foreign_reads=()):
+        """Applies the action to the explained pipeline, returns the pipeline to run and whether it was rewritten."""
+        stages = set(find_plan_stages(explain))
+        docs_examined = find_docs_examined(explain)
+        if docs_examined is None and "COLLSCAN" in stages:
+            docs_examined = collection_count
+        scan = "COLLSCAN" in stages and docs_examined is not None and docs_examined > self.max_scan_docs
+        foreign_scans = self.get_foreign_scans(explain, foreign_reads)
+        if not scan and not foreign_scans:
+            logger.info(f"Pipeline on {collection.name} allowed (plan {sorted(stages)}, ~{docs_examined} documents examined)")
+            self._record(collection, "allowed")
+            return pipeline, False
+
+        reasons = []
+        if scan:
+            reasons.append(f"the pipeline scans the whole {collection.name} collection "
+                           f"(~{docs_examined} documents, limit {self.max_scan_docs})")
+        for read in foreign_scans:
+            reasons.append(f"{read['stage']} scans the {read['collection']} collection (~{read['count']} documents"
+                           f"{' per input document' if read['per_document'] else ''}), "
+                           f"no index on {', '.join(read['fields']) or 'its filter'}")
+        reason = "; ".join(reasons)
+        rewritten = None
+        if self.action == "rewrite":
+            rewritten = self.bound_foreign_scans(pipeline, foreign_scans)
+            if rewritten is not None and scan:
+                rewritten = bound_scan(rewritten, self.max_scan_docs)
+        if self.action == "reject" or (self.action == "rewrite" and rewritten is None):
+            logger.warning(f"Pipeline rejected: {reason}: {pipeline}")
+            self._record(collection, "rejected")
+            hint = "Add a filter on an indexed field or narrow the date range"
+            if foreign_scans:
+                hint += ", and join on indexed fields"
+            raise PipelineRejectedError(f"Query rejected because {reason}. {hint}.")
+        if self.action == "rewrite":
+            logger.warning(f"Pipeline rewritten to read at most {self.max_scan_docs} documents: {reason}")
+            self._record(collection, "rewritten")
+            return rewritten, True
+        logger.warning(f"Pipeline allowed although {reason}")
+        self._record(collection, "logged")
+        return pipeline, False
+
+    def _skip(self, collection):
+        # Replayed collections have no server to explain against
+        if not PIPELINE_GUARD_ENABLED or (cassette is not None and cassette.replaying):
+            self._record(collection, "unchecked")
+            return True
+        return False
+
+    def check(self, collection, pipeline):
+        """
+        Returns the pipeline to run on `collection` and whether it was
+        rewritten, raises PipelineRejectedError.
+        """
+        if self._skip(collection):
+            return pipeline, False
+        try:
+            explain = collection.database.command(get_explain_command(collection, pipeline, self.max_time_ms))
+            count = self._get_cached_count(collection)
+            if count is None:
+                count = collection.estimated_document_count()
+                self._cache_count(collection, count)
+            foreign_reads = self.get_foreign_reads(collection, pipeline)
+        except Exception as e:
+            # The time limit still bounds a pipeline that could not be explained
+            logger.warning(f"Unable to explain the pipeline on {collection.name}, running it unchecked: {e}")
+            self._record(collection, "unchecked")
+            return pipeline, False
+        return self.decide(collection, pipeline, explain, count, foreign_reads)
+
+    async def acheck(self, collection, pipeline):
+        """Async variant of `check` for a collection of the asyncio driver."""
+        if self._skip(collection):
+            return pipeline, False
+        try:
+            explain = await collection.database.command(get_explain_command(collection, pipeline, self.max_time_ms))
+            count = self._get_cached_count(collection)
+            if count is None:
+                count = await collection.estimated_document_count()
+                self._cache_count(collection, count)
+            foreign_reads = await self.aget_foreign_reads(collection, pipeline)
+        except Exception as e:
+            logger.warning(f"Unable to explain the pipeline on {collection.name}, running it unchecked: {e}")
+            self._record(collection, "unchecked")
+            return pipeline, False
+        return self.decide(collection, pipeline, explain, count, foreign_reads)
+
+
+pipeline_guard = PipelineGuard()
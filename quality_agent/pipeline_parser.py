@@ -0,0 +1,373 @@
+import json
+import re
+from datetime import datetime, timezone
+from bson.decimal128 import Decimal128
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+ALLOWED_STAGES = {
+    "$match", "$project", "$group", "$sort", "$limit", "$skip", "$unwind",
+    "$addFields", "$set", "$unset", "$count", "$lookup", "$facet", "$bucket",
+    "$bucketAuto", "$sortByCount", "$replaceRoot", "$replaceWith", "$sample",
+    # Read other collections, the pipeline guard bounds their scans
+    "$graphLookup", "$unionWith",
+}
+
+ALLOWED_OPERATORS = {
+    # query
+    "$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin", "$and", "$or",
+    "$not", "$nor", "$exists", "$type", "$regex", "$options", "$expr", "$mod",
+    "$all", "$elemMatch", "$size",
+    # arithmetic
+    "$add", "$subtract", "$multiply", "$divide", "$abs", "$ceil", "$floor",
+    "$round", "$trunc", "$sqrt", "$pow", "$ln", "$log", "$log10", "$exp",
+    # accumulators
+    "$sum", "$avg", "$min", "$max", "$push", "$addToSet", "$count", "$first",
+    "$last", "$stdDevPop", "$stdDevSamp", "$top", "$bottom", "$topN",
+    "$bottomN", "$firstN", "$lastN", "$maxN", "$minN", "$median", "$percentile",
+    # arrays and objects
+    "$filter", "$map", "$reduce", "$arrayElemAt", "$slice", "$concatArrays",
+    "$isArray", "$indexOfArray", "$reverseArray", "$zip", "$range",
+    "$sortArray", "$arrayToObject", "$objectToArray", "$mergeObjects",
+    "$setUnion", "$setIntersection", "$setDifference", "$setIsSubset",
+    "$setEquals", "$anyElementTrue", "$allElementsTrue", "$getField",
+    # strings
+    "$concat", "$substr", "$substrBytes", "$substrCP", "$toLower", "$toUpper",
+    "$trim", "$ltrim", "$rtrim", "$split", "$strLenCP", "$strLenBytes",
+    "$strcasecmp", "$regexMatch", "$regexFind", "$regexFindAll",
+    "$replaceAll", "$replaceOne", "$indexOfCP", "$indexOfBytes",
+    # conditionals, types and misc
+    "$cond", "$ifNull", "$switch", "$cmp", "$literal", "$let", "$toString",
+    "$toInt", "$toDouble", "$toDecimal", "$toDate", "$toLong", "$toBool",
+    "$toObjectId", "$convert", "$rand",
+    # dates
+    "$year", "$month", "$dayOfMonth", "$dayOfWeek", "$dayOfYear", "$hour",
+    "$minute", "$second", "$millisecond", "$week", "$isoWeek", "$isoWeekYear",
+    "$isoDayOfWeek", "$dateToString", "$dateFromString", "$dateTrunc",
+    "$dateAdd", "$dateSubtract", "$dateDiff", "$dateFromParts", "$dateToParts",
+}
+
+LITERALS = {
+    "true": True, "True": True, "false": False, "False": False,
+    "null": None, "None": None,
+}
+
+CODE_FENCE_PATTERN = re.compile(r"```[a-zA-Z]*\s*(.*?)```", re.DOTALL)
+SHELL_AGGREGATE_PATTERN = re.compile(r"^db\.[\w.]+\.aggregate\((.*)\)\s*;?$", re.DOTALL)
+# String literals are matched first so ISODate(...) inside them is left alone
+ISODATE_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*"|ISODate\("([^"\\]*)"\)')
+NUMBER_PATTERN = re.compile(r"-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_$][\w$.]*")
+WHITESPACE_PATTERN = re.compile(r"(?:\s+|//[^\n]*|/\*.*?\*/)+", re.DOTALL)
+
+ESCAPES = {'"': '"', "'": "'", "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class PipelineParseError(ValueError):
+    """Raised when generated pipeline text is malformed or not allowed."""
+
+
+def parse_date(value):
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (ValueError, AttributeError):
+        raise PipelineParseError(f"Invalid date: {value!r}")
+    if parsed.tzinfo is not None:
+        # PyMongo treats naive datetimes as UTC
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_object_id(value):
+    if not isinstance(value, str) or not ObjectId.is_valid(value):
+        raise PipelineParseError(f"Invalid ObjectId: {value!r}")
+    return ObjectId(value)
+
+
+def parse_decimal(value):
+    try:
+        return Decimal128(str(value))
+    except Exception:
+        raise PipelineParseError(f"Invalid decimal: {value!r}")
+
+
+def parse_int64(value):
+    try:
+        return Int64(int(value))
+    except (TypeError, ValueError):
+        raise PipelineParseError(f"Invalid integer: {value!r}")
+
+
+# Mongo shell constructors
+CONSTRUCTORS = {
+    "ISODate": parse_date,
+    "Date": parse_date,
+    "ObjectId": parse_object_id,
+    "NumberDecimal": parse_decimal,
+    "NumberLong": parse_int64,
+    "NumberInt": lambda value: int(parse_int64(value)),
+}
+
+# MongoDB Extended JSON wrappers
+EXTENDED_JSON = {
+    "$date": parse_date,
+    "$oid": parse_object_id,
+    "$numberDecimal": parse_decimal,
+    "$numberLong": parse_int64,
+    "$numberInt": lambda value: int(parse_int64(value)),
+    "$numberDouble": float,
+}
+
+
+def convert_extended_json(document):
+    """Converts single-key Extended JSON documents like {"$date": ...} to their value."""
+    if len(document) == 1:
+        key = next(iter(document))
+        if key in EXTENDED_JSON:
+            value = document[key]
+            # Canonical Extended JSON nests dates as {"$date": {"$numberLong": ...}}
+            if key == "$date" and isinstance(value, Int64):
+                return datetime.fromtimestamp(value / 1000, tz=timezone.utc).replace(tzinfo=None)
+            return EXTENDED_JSON[key](value)
+    return document
+
+
+def reject_constant(name):
+    raise PipelineParseError(f"Invalid number: {name}")
+
+
+class _Parser:
+    """Recursive descent parser over Mongo shell / Extended JSON text."""
+
+    def __init__(self, text):
+        self.text = text
+        self.position = 0
+
+    def error(self, message):
+        snippet = self.text[max(self.position - 20, 0):self.position + 20]
+        return PipelineParseError(f"{message} at position {self.position}: ...{snippet}...")
+
+    def skip_whitespace(self):
+        match = WHITESPACE_PATTERN.match(self.text, self.position)
+        if match:
+            self.position = match.end()
+
+    def peek(self):
+        self.skip_whitespace()
+        return self.text[self.position] if self.position < len(self.text) else ""
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise self.error(f"Expected '{character}'")
+        self.position += 1
+
+    def parse(self):
+        value = self.parse_value()
+        if self.peek():
+            raise self.error("Unexpected trailing content")
+        return value
+
+    def parse_value(self):
+        character = self.peek()
+        if character == "{":
+            return self.parse_object()
+        if character == "[":
+            return self.parse_array()
+        if character == '"' or character == "'":
+            return self.parse_string()
+        if character == "/":
+            return self.parse_regex()
+        if character == "-" or character == "." or character.isdigit():
+            return self.parse_number()
+        if character:
+            return self.parse_identifier_value()
+        raise self.error("Unexpected end of input")
+
+    def parse_object(self):
+        self.expect("{")
+        document = {}
+        while self.peek() != "}":
+            if self.peek() == '"' or self.peek() == "'":
+                key = self.parse_string()
+            else:
+                match = IDENTIFIER_PATTERN.match(self.text, self.position)
+                if not match:
+                    raise self.error("Expected a key")
+                key = match.group()
+                self.position = match.end()
+            self.expect(":")
+            document[key] = self.parse_value()
+            if self.peek() == ",":
+                self.position += 1
+            elif self.peek() != "}":
+                raise self.error("Expected ',' or '}'")
+        self.position += 1
+        return convert_extended_json(document)
+
+    def parse_array(self):
+        self.expect("[")
+        items = []
+        while self.peek() != "]":
+            items.append(self.parse_value())
+            if self.peek() == ",":
+                self.position += 1
+            elif self.peek() != "]":
+                raise self.error("Expected ',' or ']'")
+        self.position += 1
+        return items
+
+    def parse_string(self):
+        quote = self.text[self.position]
+        self.position += 1
+        parts = []
+        start = self.position
+        while True:
+            end = self.text.find(quote, self.position)
+            backslash = self.text.find("\\", self.position, end if end != -1 else None)
+            if end == -1:
+                raise self.error("Unterminated string")
+            if backslash == -1:
+                parts.append(self.text[start:end])
+                self.position = end + 1
+                return "".join(parts)
+            parts.append(self.text[start:backslash])
+            escaped = self.text[backslash + 1:backslash + 2]
+            if escaped == "u":
+                code = self.text[backslash + 2:backslash + 6]
+                if not re.fullmatch(r"[0-9a-fA-F]{4}", code):
+                    self.position = backslash
+                    raise self.error("Invalid unicode escape")
+                parts.append(chr(int(code, 16)))
+                self.position = start = backslash + 6
+            elif escaped in ESCAPES:
+                parts.append(ESCAPES[escaped])
+                self.position = start = backslash + 2
+            else:
+                # Keep unknown escapes (e.g. regex classes like \d) as written
+                parts.append(self.text[backslash:backslash + 2])
+                self.position = start = backslash + 2
+
+    def parse_regex(self):
+        match = re.compile(r"/((?:\\.|[^/\\\n])+)/([imsx]*)").match(self.text, self.position)
+        if not match:
+            raise self.error("Invalid regular expression")
+        self.position = match.end()
+        return Regex(match.group(1), match.group(2))
+
+    def parse_number(self):
+        match = NUMBER_PATTERN.match(self.text, self.position)
+        if not match:
+            raise self.error("Invalid number")
+        self.position = match.end()
+        literal = match.group()
+        if any(character in literal for character in ".eE"):
+            return float(literal)
+        return int(literal)
+
+    def parse_identifier_value(self):
+        match = IDENTIFIER_PATTERN.match(self.text, self.position)
+        if not match:
+            raise self.error("Unexpected character")
+        name = match.group()
+        self.position = match.end()
+        if name in LITERALS:
+            return LITERALS[name]
+        if name == "new":
+            return self.parse_identifier_value()
+        if name in CONSTRUCTORS:
+            self.expect("(")
+            if self.peek() == ")":
+                self.position += 1
+                if name in ("ISODate", "Date"):
+                    return datetime.now(timezone.utc).replace(tzinfo=None)
+                raise self.error(f"{name}() needs an argument")
+            argument = self.parse_value()
+            self.expect(")")
+            return CONSTRUCTORS[name](argument)
+        self.position = match.start()
+        raise self.error(f"Unknown identifier '{name}'")
+
+
+def strip_wrappers(text):
+    """Removes markdown code fences and a `db.<collection>.aggregate(...)` call."""
+    fenced = CODE_FENCE_PATTERN.search(text)
+    if fenced:
+        text = fenced.group(1)
+    text = text.strip()
+    shell_call = SHELL_AGGREGATE_PATTERN.match(text)
+    if shell_call:
+        text = shell_call.group(1)
+    return text
+
+
+def replace_isodate(match):
+    if match.group(1) is None:
+        return match.group(0)
+    return '{"$date": "' + match.group(1) + '"}'
+
+
+def parse_document(text):
+    """
+    Parses Mongo shell / Extended JSON text (ISODate, ObjectId, true/false/null,
+    unquoted keys, trailing commas, code fences) into Python values.
+    """
+    if not isinstance(text, str):
+        raise PipelineParseError(f"Expected text, got {type(text).__name__}")
+    text = strip_wrappers(text)
+    # Most generated pipelines are plain JSON apart from ISODate, which the C
+    # JSON decoder handles much faster than the parser below
+    try:
+        return json.loads(
+            ISODATE_PATTERN.sub(replace_isodate, text),
+            object_hook=convert_extended_json,
+            parse_constant=reject_constant,
+        )
+    except json.JSONDecodeError:
+        return _Parser(text).parse()
+
+
+def validate_operators(node, path):
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key.startswith("$") and key not in ALLOWED_OPERATORS:
+                raise PipelineParseError(f"Operator '{key}' is not allowed at {path}")
+            validate_operators(value, f"{path}.{key}")
+    elif isinstance(node, list):
+        for index, item in enumerate(node):
+            validate_operators(item, f"{path}[{index}]")
+
+
+def validate_pipeline(pipeline):
+    """
+    Checks that the pipeline is a list of single-stage documents that only use
+    allowed stages and operators. Returns the pipeline.
+    """
+    if not isinstance(pipeline, list):
+        raise PipelineParseError("The pipeline must be a list of stages")
+    for index, stage in enumerate(pipeline):
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise PipelineParseError(f"Stage {index} must be a document with exactly one stage operator")
+        stage_name, stage_body = next(iter(stage.items()))
+        if stage_name not in ALLOWED_STAGES:
+            raise PipelineParseError(f"Stage '{stage_name}' is not allowed")
+        if stage_name == "$facet":
+            if not isinstance(stage_body, dict):
+                raise PipelineParseError("$facet must be a document of pipelines")
+            for facet in stage_body.values():
+                validate_pipeline(facet)
+        elif stage_name in ("$lookup", "$unionWith") and isinstance(stage_body, dict) and "pipeline" in stage_body:
+            validate_operators({key: value for key, value in stage_body.items() if key != "pipeline"},
+                               f"[{index}].{stage_name}")
+            validate_pipeline(stage_body["pipeline"])
+        else:
+            validate_operators(stage_body, f"[{index}].{stage_name}")
+    return pipeline
+
+
+def parse_pipeline(text):
+    """Parses and validates an aggregation pipeline generated by the LLM."""
+    return validate_pipeline(parse_document(text))
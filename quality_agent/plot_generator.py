@@ -1,21 +1,56 @@
 import json
 import matplotlib.pyplot as plt
+import pandas as pd
+import plotly.express as px
 from langchain.chains import LLMChain
-from quality_agent.llmManager import LLMManager
-from quality_agent.mongo_data_retriever import get_sales_data
-from prompts.inspectionPrompt import sales_schema as collection_schema
-from prompts.visualizationPrompt import create_query_generation_prompt, create_code_generation_prompt
+from langgraph.constants import TAG_NOSTREAM
+from models.models import VisualizationPlan
+from quality_agent.llmManager import get_llm_manager
+from quality_agent.mongo_data_retriever import generate_sales_pipeline, atake_or_generate_sales_pipeline, run_sales_pipeline, arun_sales_pipeline
+from quality_agent.speculation import speculation_manager
+from prompts.promptRegistry import get_prompt
 from langchain_core.tools import tool
+from quality_agent.history import get_history_view
+from quality_agent.pipeline_parser import parse_document, validate_pipeline
+from quality_agent.metrics import record_chart_execution, record_visualization_plan
 from quality_agent.logger import setup_logger
+import asyncio
+import os
 import re
+import time
 import base64
 from io import BytesIO
 from langchain_core.messages import  AIMessage
 
 logger = setup_logger(__name__)
 
-llm = LLMManager().llm
-vision_llm = LLMManager().vision_llm
+# "multi_call" rephrases the question, generates the pipeline and generates the
+# plotting code in three LLM calls. "single_call" plans all three in one
+# structured answer, the multi-call stage takes over when a planned one fails.
+VISUALIZATION_MODE = os.getenv("VISUALIZATION_MODE", "multi_call")
+VISUALIZATION_MODES = ("multi_call", "single_call")
+if VISUALIZATION_MODE not in VISUALIZATION_MODES:
+    raise ValueError(f"Unknown visualization mode '{VISUALIZATION_MODE}', expected one of {VISUALIZATION_MODES}")
+
+# Plotly Express function per chart type of the visualization plan
+CHART_FUNCTIONS = {
+    "bar": px.bar,
+    "line": px.line,
+    "scatter": px.scatter,
+    "area": px.area,
+    "box": px.box,
+    "histogram": px.histogram,
+}
+
+llm = get_llm_manager().llm
+
+# The collection schema is rendered into both prompt templates
+query_generation_chain = get_prompt("visualization_query") | llm
+
+code_generation_chain = LLMChain(llm=llm, prompt=get_prompt("code_generation"), verbose=True)
+
+# The plan is an intermediate result, kept out of the `messages` stream like the pipeline
+visualization_plan_chain = get_prompt("visualization_plan") | llm.with_config(tags=[TAG_NOSTREAM])
 
 
 def rephrase_user_query_for_visualization(state):
@@ -27,22 +62,127 @@ def rephrase_user_query_for_visualization(state):
         dict: A dictionary containing the rephrased question under the key 'rephrasedQuestion'.
     """
     try:
-        query_generation_prompt = create_query_generation_prompt()
-        query_generation_chain = query_generation_prompt | llm
-
         new_user_query = query_generation_chain.invoke({
-           "message_history_with_input": state['messages'],
-            "collection_schema": collection_schema
+           "message_history_with_input": get_history_view(state['messages'], "visualization")
         })
 
         logger.info(f"Rephrased Question: {new_user_query.content}")
 
-        return {"rephrasedQuestion": new_user_query.content}
+        return {"rephrasedQuestion": new_user_query.content, "visualizationPlan": None}
     except Exception as e:
         logger.error(f"Error rephrasing user query for visualization: {e}")
         raise
 
 
+async def atake_speculative_visualization(state):
+    """First visualization stage of the speculative run started during routing, if any."""
+    if not state.get('speculationId'):
+        return None
+    update = await speculation_manager.take(state['speculationId'], "rephrase")
+    if update is not None:
+        logger.info(f"Rephrased Question (speculative): {update['rephrasedQuestion']}")
+    return update
+
+
+async def arephrase_user_query_for_visualization(state):
+    """
+    Async variant of `rephrase_user_query_for_visualization`. Uses the
+    rephrased question of the speculative run started during routing if any.
+    """
+    try:
+        update = await atake_speculative_visualization(state)
+        if update is not None:
+            return update
+
+        new_user_query = await query_generation_chain.ainvoke({
+           "message_history_with_input": get_history_view(state['messages'], "visualization")
+        })
+
+        logger.info(f"Rephrased Question: {new_user_query.content}")
+
+        return {"rephrasedQuestion": new_user_query.content, "visualizationPlan": None}
+    except Exception as e:
+        logger.error(f"Error rephrasing user query for visualization: {e}")
+        raise
+
+
+def get_visualization_plan(llm_output):
+    """
+    Converts the structured LLM answer of the visualization plan prompt into
+    the state update of the visualization node.
+    """
+    plan = VisualizationPlan.model_validate(parse_document(llm_output))
+    pipeline = validate_pipeline(plan.pipeline)
+    logger.info(f"Rephrased Question: {plan.rephrased_question}")
+    logger.info(f"Planned pipeline: {pipeline}, chart: {plan.chart}")
+    return {
+        "rephrasedQuestion": plan.rephrased_question,
+        "visualizationPlan": {"pipeline": pipeline, "chart": plan.chart.model_dump()},
+    }
+
+
+def plan_visualization(state):
+    """
+    Single-call variant of `rephrase_user_query_for_visualization`: one LLM
+    call returns the rephrased question, the pipeline and the chart. Falls
+    back to rephrasing when the answer is not a valid plan.
+    """
+    try:
+        response = visualization_plan_chain.invoke({
+            "message_history_with_input": get_history_view(state['messages'], "visualization")
+        })
+        try:
+            update = get_visualization_plan(response.content)
+        except ValueError as e:
+            logger.warning(f"Invalid visualization plan, using the multi-call path: {e}")
+            record_visualization_plan("plan", "fallback")
+            return rephrase_user_query_for_visualization(state)
+        record_visualization_plan("plan", "used")
+        return update
+    except Exception as e:
+        logger.error(f"Error planning visualization: {e}")
+        raise
+
+
+async def aplan_visualization(state):
+    """
+    Async variant of `plan_visualization`.
+    """
+    try:
+        update = await atake_speculative_visualization(state)
+        if update is not None:
+            return update
+
+        response = await visualization_plan_chain.ainvoke({
+            "message_history_with_input": get_history_view(state['messages'], "visualization")
+        })
+        try:
+            update = get_visualization_plan(response.content)
+        except ValueError as e:
+            logger.warning(f"Invalid visualization plan, using the multi-call path: {e}")
+            record_visualization_plan("plan", "fallback")
+            return await arephrase_user_query_for_visualization(state)
+        record_visualization_plan("plan", "used")
+        return update
+    except Exception as e:
+        logger.error(f"Error planning visualization: {e}")
+        raise
+
+
+def get_mongo_query_update(pipeline, result):
+    retrieved_data = result["documents"]
+    if not retrieved_data:
+        return {"mongoPipeline": pipeline, "mongoQueryResult": [], "mongoQueryTruncated": False,
+                "mongoQueryPartial": result["partial"]}
+    logger.info(f"Retrieved {len(retrieved_data)} rows, truncated: {result['truncated']}")
+    return {
+        "mongoPipeline": pipeline,
+        "mongoQueryResult": retrieved_data,
+        "mongoQueryTruncated": result["truncated"],
+        "mongoQueryPartial": result["partial"],
+    }
+
+
 def generate_mongo_query(state):
     """
     Generates a MongoDB query based on the provided state and retrieves data.
@@ -53,22 +193,162 @@ def generate_mongo_query(state):
         state (dict): A dictionary containing the 'rephrasedQuestion' key used to generate the query.
     Returns:
         dict or str: A dictionary with the key 'mongoQueryResult' containing the retrieved data,
-                     or a string message indicating no data was retrieved.
+                     the key 'mongoPipeline' containing the executed pipeline and the key
+                     'mongoQueryTruncated' telling whether the rows were capped at `MONGO_MAX_ROWS`
+                     and 'mongoQueryPartial' whether the pipeline guard bounded the scan.
     """
     try:
-        retrieved_data = get_sales_data(state['rephrasedQuestion'])
+        plan = state.get('visualizationPlan')
+        if plan:
+            try:
+                result = run_sales_pipeline(plan['pipeline'])
+                record_visualization_plan("pipeline", "used")
+                return get_mongo_query_update(plan['pipeline'], result)
+            except Exception as e:
+                logger.warning(f"Planned pipeline failed, generating it again: {e}")
+                record_visualization_plan("pipeline", "fallback")
 
-        # Check if retrieved_data is empty
-        if not retrieved_data:
-            return {"mongoQueryResult": []}
-        else:
-            logger.info(f"Retrieved Data: {retrieved_data}")
-        return {"mongoQueryResult": retrieved_data}
+        pipeline = generate_sales_pipeline(state['rephrasedQuestion'])
+        return get_mongo_query_update(pipeline, run_sales_pipeline(pipeline))
     except Exception as e:
         logger.error(f"Error generating MongoDB query: {e}")
         raise
 
 
+async def agenerate_mongo_query(state):
+    """
+    Async variant of `generate_mongo_query`.
+    """
+    try:
+        plan = state.get('visualizationPlan')
+        if plan:
+            try:
+                result = await arun_sales_pipeline(plan['pipeline'])
+                record_visualization_plan("pipeline", "used")
+                return get_mongo_query_update(plan['pipeline'], result)
+            except Exception as e:
+                logger.warning(f"Planned pipeline failed, generating it again: {e}")
+                record_visualization_plan("pipeline", "fallback")
+
+        pipeline = await atake_or_generate_sales_pipeline(state['rephrasedQuestion'], state.get('speculationId'))
+        return get_mongo_query_update(pipeline, await arun_sales_pipeline(pipeline))
+    except Exception as e:
+        logger.error(f"Error generating MongoDB query: {e}")
+        raise
+
+
+def get_code_generation_inputs(state):
+    """
+    Builds the inputs of the code generation prompt from the retrieved data.
+    Returns None when no data was retrieved, there is nothing to plot then.
+    """
+    retrieved_data = state['mongoQueryResult']
+    if not retrieved_data:
+        return None
+    # Extract relevant information from the data (e.g., column names, a sample record, and count)
+    # Get the column names from the first document
+    column_names = list(retrieved_data[0].keys())
+    # Count the number of rows/documents
+    number_of_rows = len(retrieved_data)
+    sample_record = retrieved_data[0]  # Show the full sample record
+    return {
+        "column_names": column_names,
+        "number_of_rows": number_of_rows,
+        "sample_record": sample_record,
+        "user_query": state['rephrasedQuestion']
+    }
+
+
+def get_chart_update(figure, start):
+    """
+    Converts the figure to JSON and returns the chart state update.
+    """
+    chart_response = figure.to_json()
+    record_chart_execution(time.perf_counter() - start, payload_bytes=len(chart_response))
+    logger.info(f'Final response plot: {chart_response}')
+    ai_msg = "The requested plot has been generated successfully."
+
+    return {"chart": chart_response, "answer": ai_msg, "messages":[AIMessage(ai_msg)]}
+
+
+def get_no_data_update():
+    ai_msg = "No data was found for the requested plot."
+    return {"chart": None, "answer": ai_msg, "messages": [AIMessage(ai_msg)]}
+
+
+def render_planned_chart(chart, retrieved_data):
+    """
+    Draws the chart of the visualization plan with Plotly Express. Returns
+    None when the chart does not fit the retrieved data, the plotting code
+    is generated then.
+    """
+    start = time.perf_counter()
+    try:
+        # Nested fields like `_id.month` become columns
+        df = pd.json_normalize(retrieved_data)
+        fields = [chart[axis] for axis in ("x", "y", "color") if chart.get(axis)]
+        missing = [field for field in fields if field not in df.columns]
+        if df.empty or missing:
+            raise ValueError(f"Fields {missing} are not in the {len(df)} retrieved rows")
+
+        if chart['chart_type'] == "pie":
+            figure = px.pie(df, names=chart['x'], values=chart.get('y'), title=chart['title'])
+        else:
+            figure = CHART_FUNCTIONS[chart['chart_type']](
+                df, x=chart['x'], y=chart.get('y'), color=chart.get('color'), title=chart['title'])
+        update = get_chart_update(figure, start)
+        record_visualization_plan("chart", "used")
+        return update
+    except Exception as e:
+        logger.warning(f"Unable to draw the planned chart, generating the plotting code: {e}")
+        record_chart_execution(time.perf_counter() - start, "error")
+        record_visualization_plan("chart", "fallback")
+        return None
+
+
+def execute_generated_chart_code(code_text, retrieved_data):
+    """
+    Executes the generated plotting code and returns the chart state update.
+    """
+    generated_code = re.sub(r'```python|```', '', code_text).strip()
+
+    # Step 6: Display the generated code (optional for debugging)
+    logger.info(f"Generated Python Code:\n{generated_code}")
+
+    # Pass the data into the local context
+    local_context = {"data": retrieved_data}
+
+    start = time.perf_counter()
+    try:
+        # Execute the generated code to produce `fig`
+        exec(generated_code, local_context, local_context)
+
+        # Retrieve the plot if it exists
+        final_response_plot = local_context.get('fig')
+        if not final_response_plot:
+            logger.error("No plot was generated.")
+            record_chart_execution(time.perf_counter() - start, "no_plot")
+            return {"chart": None}
+
+        #final_response_plot.show()
+
+
+        # Convert the plot to JSON
+        return get_chart_update(final_response_plot, start)
+
+    except KeyError as e:
+        logger.error(
+            "No plot object named 'fig' was found in the generated code.")
+        record_chart_execution(time.perf_counter() - start, "error")
+        return {"chart": None}
+
+    except Exception as e:
+        logger.error(
+            f"Error occurred while executing the generated code: {str(e)}")
+        record_chart_execution(time.perf_counter() - start, "error")
+        return {"chart": None}
+
+
 def generate_chart_based_on_query(state):
     """
     Generates a chart based on the provided query state.
@@ -84,69 +364,52 @@ def generate_chart_based_on_query(state):
                      or an error message string if an error occurs during code execution.
     """
     try:
-        retrieved_data = state['mongoQueryResult']
-        # Extract relevant information from the data (e.g., column names, a sample record, and count)
-        # Get the column names from the first document
-        column_names = list(retrieved_data[0].keys())
-        # Count the number of rows/documents
-        number_of_rows = len(retrieved_data)
-        id = "_id"
-        for record in retrieved_data:
-            for key in record:
-                if key == id:
-                    record[key] = str(record[key])
-        sample_record = retrieved_data[0]  # Show the full sample record
-        code_generation_prompt = create_code_generation_prompt()
-        code_generation_chain = LLMChain(
-            llm=llm, prompt=code_generation_prompt, verbose=True)
-
-        # Use the LLM chain to generate Python code for plotting
-        code_response = code_generation_chain.invoke({
-            "column_names": column_names,
-            "number_of_rows": number_of_rows,
-            "sample_record": sample_record,
-            "collection_schema": collection_schema,
-            "user_query": state['rephrasedQuestion']
-        })
+        plan = state.get('visualizationPlan')
+        if plan:
+            update = render_planned_chart(plan['chart'], state['mongoQueryResult'])
+            if update is not None:
+                return update
 
-        generated_code = re.sub(r'```python|```', '',
-                                code_response['text']).strip()
+        code_generation_inputs = get_code_generation_inputs(state)
+        if code_generation_inputs is None:
+            logger.info("No data retrieved, skipping the plotting code generation")
+            return get_no_data_update()
 
-        # Step 6: Display the generated code (optional for debugging)
-        logger.info(f"Generated Python Code:\n{generated_code}")
+        # Use the LLM chain to generate Python code for plotting
+        code_response = code_generation_chain.invoke(code_generation_inputs)
 
-        # Pass the data into the local context
-        local_context = {"data": retrieved_data}
+        return execute_generated_chart_code(
+            code_response['text'], state['mongoQueryResult'])
 
-        try:
-            # Execute the generated code to produce `fig`
-            exec(generated_code, local_context, local_context)
-
-            # Retrieve the plot if it exists
-            final_response_plot = local_context.get('fig')
-            if not final_response_plot:
-                logger.error("No plot was generated.")
-                return {"chart": None}
-            
-            #final_response_plot.show()
+    except Exception as e:
+        logger.error(f"Error generating chart based on query: {e}")
+        raise
 
 
-            # Convert the plot to JSON
-            chart_response = final_response_plot.to_json()
-            logger.info(f'Final response plot: {chart_response}')
-            ai_msg = "The requested plot has been generated successfully."
+async def agenerate_chart_based_on_query(state):
+    """
+    Async variant of `generate_chart_based_on_query`. The generated plotting code
+    is executed in a worker thread since building the figure is CPU bound.
+    """
+    try:
+        plan = state.get('visualizationPlan')
+        if plan:
+            update = await asyncio.to_thread(
+                render_planned_chart, plan['chart'], state['mongoQueryResult'])
+            if update is not None:
+                return update
 
-            return {"chart": chart_response, "answer": ai_msg, "messages":[AIMessage(ai_msg)]}
+        code_generation_inputs = get_code_generation_inputs(state)
+        if code_generation_inputs is None:
+            logger.info("No data retrieved, skipping the plotting code generation")
+            return get_no_data_update()
 
-        except KeyError as e:
-            logger.error(
-                "No plot object named 'fig' was found in the generated code.")
-            return {"chart": None}
+        code_response = await code_generation_chain.ainvoke(code_generation_inputs)
 
-        except Exception as e:
-            logger.error(
-                f"Error occurred while executing the generated code: {str(e)}")
-            return {"chart": None}
+        return await asyncio.to_thread(
+            execute_generated_chart_code,
+            code_response['text'],
+            state['mongoQueryResult'])
 
     except Exception as e:
         logger.error(f"Error generating chart based on query: {e}")
@@ -0,0 +1,305 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from functools import partial
+from langchain_core.messages import BaseMessage
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable
+from langchain_core.runnables.config import patch_config
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Default number of concurrent requests per provider, override with <PROVIDER>_MAX_CONCURRENCY
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+# Rough characters per token, used to charge the token bucket before the usage is known
+CHARACTERS_PER_TOKEN = 4
+
+
+def get_provider_limits(name):
+    """
+    Reads the quota of a provider from <PROVIDER>_RPM, <PROVIDER>_TPM and
+    <PROVIDER>_MAX_CONCURRENCY. A limit of 0 disables it.
+    """
+    prefix = name.upper()
+    return {
+        "requests_per_minute": float(os.getenv(f"{prefix}_RPM", "0")),
+        "tokens_per_minute": float(os.getenv(f"{prefix}_TPM", "0")),
+        "max_concurrency": int(os.getenv(f"{prefix}_MAX_CONCURRENCY", str(LLM_MAX_CONCURRENCY))),
+    }
+
+
+def estimate_tokens(input):
+    if isinstance(input, PromptValue):
+        input = input.to_messages()
+    if isinstance(input, str):
+        return max(1, len(input) // CHARACTERS_PER_TOKEN)
+    characters = 0
+    for message in input if isinstance(input, (list, tuple)) else [input]:
+        content = message.content if isinstance(message, BaseMessage) else message
+        characters += len(content if isinstance(content, str) else str(content))
+    return max(1, characters // CHARACTERS_PER_TOKEN)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `per_minute` tokens per minute.
+    The level may go below zero when the real usage exceeds the estimate, the
+    debt then delays the next requests.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount):
+        """Takes `amount` if available and returns 0, otherwise the seconds to wait."""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self.level >= amount:
+                self.level -= amount
+                return 0.0
+            return (amount - self.level) / self.rate
+
+    def adjust(self, amount):
+        with self._lock:
+            self._refill()
+            self.level -= amount
+
+
+class ProviderLimiter:
+    """
+    Request and token quotas of a provider plus a bound on its concurrent
+    requests. Callers queue instead of failing with 429s, and the queue depth
+    and waiting times are recorded. Threads and the tasks of any event loop
+    share the same concurrency slots, freed slots go to the waiters in order.
+    """
+
+    def __init__(self, name, requests_per_minute=0, tokens_per_minute=0, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        # Slots taken, and the waiters: a threading.Event or an asyncio (loop, future)
+        self._active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.in_flight = 0
+        self.requests_total = 0
+        self.wait_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _take_slot(self, waiter):
+        """Takes a concurrency slot and returns True, or queues `waiter`."""
+        with self._lock:
+            if self._active < self.max_concurrency and not self._waiters:
+                self._active += 1
+                return True
+            self._waiters.append(waiter)
+            return False
+
+    def _release_slot(self):
+        with self._lock:
+            # The slot is handed over to the first waiter
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self._hand_over, future)
+                    return
+                except RuntimeError:
+                    # The loop of the waiter is closed
+                    continue
+            self._active -= 1
+
+    def _hand_over(self, future):
+        if future.done():
+            # Cancelled while the slot was on its way
+            self._release_slot()
+        else:
+            future.set_result(None)
+
+    def _cancel_wait(self, waiter, granted):
+        """Gives back the slot of an interrupted waiter, or takes it out of the queue."""
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return
+        if granted:
+            self._release_slot()
+
+    def _acquire_slot(self):
+        event = threading.Event()
+        if self._take_slot(event):
+            return
+        try:
+            event.wait()
+        except BaseException:
+            self._cancel_wait(event, event.is_set())
+            raise
+
+    async def _aacquire_slot(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        if self._take_slot(waiter):
+            return
+        try:
+            await future
+        except BaseException:
+            # A cancelled future is given back by `_hand_over`
+            self._cancel_wait(waiter, future.done() and not future.cancelled())
+            raise
+
+    def _enqueue(self):
+        with self._lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def _dequeue(self, waited):
+        with self._lock:
+            self.queue_depth -= 1
+            self.in_flight += 1
+            self.requests_total += 1
+            self.wait_seconds_total += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        if waited > 1:
+            logger.info(f"LLM request to '{self.name}' waited {waited:.2f}s for its quota")
+
+    def _release(self, estimated_tokens, used_tokens):
+        with self._lock:
+            self.in_flight -= 1
+        if self.tokens and used_tokens is not None:
+            self.tokens.adjust(used_tokens - estimated_tokens)
+
+    def _get_quota_delay(self, estimated_tokens):
+        if self.requests:
+            delay = self.requests.try_take(1)
+            if delay:
+                return delay
+        if self.tokens:
+            delay = self.tokens.try_take(estimated_tokens)
+            if delay:
+                # Give the request back, it is taken again after waiting
+                if self.requests:
+                    self.requests.adjust(-1)
+                return delay
+        return 0.0
+
+    def acquire(self, estimated_tokens):
+        start = time.monotonic()
+        self._enqueue()
+        try:
+            self._acquire_slot()
+            try:
+                while delay := self._get_quota_delay(estimated_tokens):
+                    time.sleep(delay)
+            except BaseException:
+                self._release_slot()
+                raise
+        except BaseException:
+            with self._lock:
+                self.queue_depth -= 1
+            raise
+        self._dequeue(time.monotonic() - start)
+
+    def release(self, estimated_tokens, used_tokens=None):
+        self._release(estimated_tokens, used_tokens)
+        self._release_slot()
+
+    async def aacquire(self, estimated_tokens):
+        start = time.monotonic()
+        self._enqueue()
+        try:
+            await self._aacquire_slot()
+            try:
+                while delay := self._get_quota_delay(estimated_tokens):
+                    await asyncio.sleep(delay)
+            except BaseException:
+                self._release_slot()
+                raise
+        except BaseException:
+            with self._lock:
+                self.queue_depth -= 1
+            raise
+        self._dequeue(time.monotonic() - start)
+
+    def arelease(self, estimated_tokens, used_tokens=None):
+        self._release(estimated_tokens, used_tokens)
+        self._release_slot()
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "in_flight": self.in_flight,
+            "requests": self.requests_total,
+            "average_wait_seconds": self.wait_seconds_total / self.requests_total if self.requests_total else 0.0,
+            "max_wait_seconds": self.max_wait_seconds,
+            "requests_per_minute": self.requests.capacity if self.requests else None,
+            "tokens_per_minute": self.tokens.capacity if self.tokens else None,
+            "max_concurrency": self.max_concurrency,
+        }
+
+
+def get_used_tokens(result):
+    usage = getattr(result, "usage_metadata", None)
+    return usage.get("total_tokens") if usage else None
+
+
+class RateLimitedModel(Runnable):
+    """
+    Chat model wrapper that waits for the provider's quota and a concurrency
+    slot before each request and charges the real token usage afterwards.
+    """
+
+    def __init__(self, model, limiter):
+        self.model = model
+        self.limiter = limiter
+
+    def bind_tools(self, tools, **kwargs):
+        return RateLimitedModel(self.model.bind_tools(tools, **kwargs), self.limiter)
+
+    def invoke(self, input, config=None, **kwargs):
+        return self._call_with_config(partial(self._invoke, **kwargs), input, config)
+
+    def _invoke(self, input, run_manager, config, **kwargs):
+        estimated_tokens = estimate_tokens(input)
+        self.limiter.acquire(estimated_tokens)
+        result = None
+        try:
+            result = self.model.invoke(input, patch_config(config, callbacks=run_manager.get_child()), **kwargs)
+            return result
+        finally:
+            self.limiter.release(estimated_tokens, get_used_tokens(result))
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return await self._acall_with_config(partial(self._ainvoke, **kwargs), input, config)
+
+    async def _ainvoke(self, input, run_manager, config, **kwargs):
+        estimated_tokens = estimate_tokens(input)
+        await self.limiter.aacquire(estimated_tokens)
+        result = None
+        try:
+            result = await self.model.ainvoke(
+                input, patch_config(config, callbacks=run_manager.get_child()), **kwargs)
+            return result
+        finally:
+            self.limiter.arelease(estimated_tokens, get_used_tokens(result))
@@ -0,0 +1,480 @@
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal, localcontext
+from bson.decimal128 import Decimal128, create_decimal128_context
+from pymongo import UpdateOne
+from quality_agent.aggregation_cache import aggregation_cache
+from quality_agent.cassette import cassette
+from quality_agent.database import get_sales_db
+from quality_agent.logger import setup_logger
+from quality_agent.metrics import record_rollup_rewrite
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = setup_logger(__name__)
+
+ROLLUPS_ENABLED = os.getenv("ROLLUPS_ENABLED", "false") == "true"
+# "insert" updates the rollups with the sales recorded by the application,
+# "watch" from a change stream on the sales collection (needs a replica set),
+# which also covers the sales written outside the application
+ROLLUP_UPDATE_MODE = os.getenv("ROLLUP_UPDATE_MODE", "insert")
+# Sales written while not running are only counted after a rebuild
+ROLLUP_REBUILD_ON_STARTUP = os.getenv("ROLLUP_REBUILD_ON_STARTUP", "true") == "true"
+ROLLUP_DAILY_COLLECTION = os.getenv("ROLLUP_DAILY_COLLECTION", "sales_rollup_daily")
+ROLLUP_TAGS_COLLECTION = os.getenv("ROLLUP_TAGS_COLLECTION", "sales_rollup_daily_tags")
+
+ROLLUP_UPDATE_MODES = ("insert", "watch")
+SALES_COLLECTION = "sales"
+
+# Rollup documents are keyed by day x storeLocation x purchaseMethod (x tag).
+# Each grain counts its documents and, per measure, the sum and the number of
+# numeric values, so sums, counts and averages can be re-aggregated exactly.
+# The measures are products of the values of their field paths.
+GRAINS = {
+    "sale": {
+        "collection": ROLLUP_DAILY_COLLECTION,
+        "unwind": [],
+        "count": "salesCount",
+        "measures": {"customerAge": ("customer.age",), "customerSatisfaction": ("customer.satisfaction",)},
+    },
+    "item": {
+        "collection": ROLLUP_DAILY_COLLECTION,
+        "unwind": ["items"],
+        "count": "itemsCount",
+        "measures": {"itemQuantity": ("items.quantity",), "itemPrice": ("items.price",),
+                     "itemRevenue": ("items.price", "items.quantity")},
+    },
+    "tag": {
+        "collection": ROLLUP_TAGS_COLLECTION,
+        "unwind": ["items", "items.tags"],
+        "count": "itemsCount",
+        "measures": {"itemQuantity": ("items.quantity",), "itemPrice": ("items.price",),
+                     "itemRevenue": ("items.price", "items.quantity")},
+    },
+}
+
+CATEGORY_FIELDS = {"storeLocation": "storeLocation", "purchaseMethod": "purchaseMethod"}
+CATEGORY_OPERATORS = {"$eq", "$ne", "$in", "$nin"}
+# Other bounds do not fall on day boundaries
+DAY_OPERATORS = {"$gte", "$lt"}
+DATE_OPERATORS = {"$year", "$month", "$dayOfMonth", "$dayOfWeek", "$dayOfYear", "$week", "$isoWeek",
+                  "$isoWeekYear", "$isoDayOfWeek", "$dateToString", "$dateTrunc"}
+DAY_UNITS = {"day", "week", "month", "quarter", "year"}
+TIME_FORMATS = ("%H", "%M", "%S", "%L", "%z", "%Z")
+
+
+class RollupIneligibleError(ValueError):
+    """Raised when a pipeline cannot be answered from the rollups."""
+
+
+def get_measure_expression(paths):
+    if len(paths) == 1:
+        return "$" + paths[0]
+    operands = ["$" + path for path in paths]
+    return {"$cond": [{"$and": [{"$isNumber": operand} for operand in operands]}, {"$multiply": operands}, None]}
+
+
+def get_rollup_pipeline(grain):
+    """Aggregation of the sales collection into the rollup documents of `grain`."""
+    spec = GRAINS[grain]
+    key = {
+        "day": {"$cond": [{"$eq": [{"$type": "$saleDate"}, "date"]},
+                          {"$dateTrunc": {"date": "$saleDate", "unit": "day"}}, None]},
+        # Missing fields are left out of the key, as in the groups of the raw sales
+        "storeLocation": "$storeLocation",
+        "purchaseMethod": "$purchaseMethod",
+    }
+    if grain == "tag":
+        key["tag"] = "$items.tags"
+    group = {"_id": key, spec["count"]: {"$sum": 1}}
+    for name, paths in spec["measures"].items():
+        expression = get_measure_expression(paths)
+        group[f"{name}Sum"] = {"$sum": expression}
+        group[f"{name}Count"] = {"$sum": {"$cond": [{"$isNumber": expression}, 1, 0]}}
+    return [{"$unwind": "$" + path} for path in spec["unwind"]] + [{"$group": group}]
+
+
+def get_path(document, path):
+    for part in path.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
+
+
+def set_path(document, path, value):
+    head, _, rest = path.partition(".")
+    document = dict(document)
+    document[head] = set_path(document.get(head) or {}, rest, value) if rest else value
+    return document
+
+
+def unwind(documents, path):
+    """`$unwind` of `path` without options."""
+    for document in documents:
+        value = get_path(document, path)
+        if value is None or value == []:
+            continue
+        for element in value if isinstance(value, list) else [value]:
+            yield set_path(document, path, element)
+
+
+def is_number(value):
+    return isinstance(value, (int, float, Decimal128)) and not isinstance(value, bool)
+
+
+def combine(values, operation):
+    """Sums or multiplies numbers like the server, Decimal128 when any of them is."""
+    if not any(isinstance(value, Decimal128) for value in values):
+        return operation(values)
+    with localcontext(create_decimal128_context()) as context:
+        result = operation([value.to_decimal() if isinstance(value, Decimal128) else Decimal(str(value))
+                            for value in values])
+        return Decimal128(context.create_decimal(result))
+
+
+def get_day(value):
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return datetime(value.year, value.month, value.day)
+
+
+def get_rollup_updates(sale):
+    """The `$inc` updates of every rollup collection for one inserted sale."""
+    updates = {}
+    for grain, spec in GRAINS.items():
+        documents = [sale]
+        for path in spec["unwind"]:
+            documents = list(unwind(documents, path))
+        for document in documents:
+            key = {"day": get_day(document.get("saleDate"))}
+            key.update((field, document[field]) for field in ("storeLocation", "purchaseMethod") if field in document)
+            if grain == "tag":
+                key["tag"] = get_path(document, "items.tags")
+            _, increments = updates.setdefault((spec["collection"], repr(key)), (key, {}))
+            increments.setdefault(spec["count"], 0)
+            increments[spec["count"]] += 1
+            for name, paths in spec["measures"].items():
+                values = [get_path(document, path) for path in paths]
+                sums = increments.setdefault(f"{name}Sum", [])
+                increments.setdefault(f"{name}Count", 0)
+                if all(is_number(value) for value in values):
+                    sums.append(combine(values, math.prod))
+                    increments[f"{name}Count"] += 1
+    operations = {}
+    for (collection, _), (key, increments) in updates.items():
+        increments = {field: combine(value, sum) if isinstance(value, list) else value
+                      for field, value in increments.items()}
+        operations.setdefault(collection, []).append(UpdateOne({"_id": key}, {"$inc": increments}, upsert=True))
+    return operations
+
+
+def check_category_condition(condition):
+    if isinstance(condition, dict):
+        if not condition or not set(condition) <= CATEGORY_OPERATORS:
+            raise RollupIneligibleError(f"unsupported condition {condition}")
+        for operator, value in condition.items():
+            values = value if operator in ("$in", "$nin") and isinstance(value, list) else [value]
+            if any(isinstance(v, (dict, list)) or hasattr(v, "pattern") for v in values):
+                raise RollupIneligibleError(f"unsupported condition {condition}")
+    elif isinstance(condition, list) or hasattr(condition, "pattern"):
+        raise RollupIneligibleError(f"unsupported condition {condition}")
+
+
+def check_day_condition(condition):
+    if not isinstance(condition, dict) or not condition or not set(condition) <= DAY_OPERATORS:
+        raise RollupIneligibleError(f"saleDate condition {condition} is not a day range")
+    for value in condition.values():
+        if not isinstance(value, datetime) or get_day(value) != value.replace(tzinfo=None):
+            raise RollupIneligibleError(f"saleDate bound {value} is not a day boundary")
+
+
+def translate_match(match, grain):
+    """Translates a `$match` on the sales to the keys of the rollup documents."""
+    translated = {}
+    for field, condition in match.items():
+        if field == "$and" and isinstance(condition, list):
+            translated["$and"] = [translate_match(clause, grain) for clause in condition]
+        elif field in CATEGORY_FIELDS or (field == "items.tags" and grain == "tag"):
+            check_category_condition(condition)
+            translated["_id." + CATEGORY_FIELDS.get(field, "tag")] = condition
+        elif field == "saleDate":
+            check_day_condition(condition)
+            translated["_id.day"] = condition
+        else:
+            raise RollupIneligibleError(f"filter on {field}")
+    return translated
+
+
+def translate_date_operator(operator, argument):
+    if argument in ("$saleDate", ["$saleDate"]) and operator not in ("$dateToString", "$dateTrunc"):
+        return {operator: "$_id.day"}
+    if not isinstance(argument, dict) or argument.get("date") != "$saleDate" or "timezone" in argument:
+        raise RollupIneligibleError(f"{operator} of {argument}")
+    if operator == "$dateToString" and any(code in argument.get("format", "%H") for code in TIME_FORMATS):
+        raise RollupIneligibleError("$dateToString with a time of day")
+    if operator == "$dateTrunc" and argument.get("unit") not in DAY_UNITS:
+        raise RollupIneligibleError("$dateTrunc below a day")
+    return {operator: {**argument, "date": "$_id.day"}}
+
+
+def translate_expression(expression, grain):
+    """Translates a group key expression to the keys of the rollup documents."""
+    if isinstance(expression, str) and expression.startswith("$"):
+        path = expression[1:]
+        if path in CATEGORY_FIELDS:
+            return "$_id." + CATEGORY_FIELDS[path]
+        if path == "items.tags" and grain == "tag":
+            return "$_id.tag"
+        # Variables and the time of day of saleDate are not kept
+        raise RollupIneligibleError(f"group key {expression}")
+    if isinstance(expression, list):
+        return [translate_expression(item, grain) for item in expression]
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            operator, argument = next(iter(expression.items()))
+            if operator == "$literal":
+                return expression
+            if operator in DATE_OPERATORS:
+                return translate_date_operator(operator, argument)
+        return {key: translate_expression(value, grain) for key, value in expression.items()}
+    return expression
+
+
+def find_measure(argument, spec):
+    for name, paths in spec["measures"].items():
+        if len(paths) == 1 and argument == "$" + paths[0]:
+            return name
+        if (len(paths) > 1 and isinstance(argument, dict) and list(argument) == ["$multiply"]
+                and isinstance(argument["$multiply"], list)
+                and all(isinstance(operand, str) for operand in argument["$multiply"])
+                and sorted(argument["$multiply"]) == sorted("$" + path for path in paths)):
+            return name
+    raise RollupIneligibleError(f"no rollup measure for {argument}")
+
+
+def translate_group(group, grain):
+    """Returns the `$group` over the rollup documents and the `$project` computing the averages."""
+    spec = GRAINS[grain]
+    count = "$" + spec["count"]
+    translated = {"_id": translate_expression(group.get("_id"), grain)}
+    projection = {"_id": 1}
+    averages = False
+    for field, accumulator in group.items():
+        if field == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise RollupIneligibleError(f"accumulator {accumulator}")
+        operator, argument = next(iter(accumulator.items()))
+        projection[field] = 1
+        if operator == "$count" and argument == {}:
+            translated[field] = {"$sum": count}
+        elif operator == "$sum" and is_number(argument) and not isinstance(argument, Decimal128):
+            translated[field] = {"$sum": count if argument == 1 else {"$multiply": [count, argument]}}
+        elif operator == "$sum":
+            translated[field] = {"$sum": f"${find_measure(argument, spec)}Sum"}
+        elif operator == "$avg":
+            measure = find_measure(argument, spec)
+            translated[f"__{field}Sum"] = {"$sum": f"${measure}Sum"}
+            translated[f"__{field}Count"] = {"$sum": f"${measure}Count"}
+            projection[field] = {"$cond": [{"$gt": [f"$__{field}Count", 0]},
+                                           {"$divide": [f"$__{field}Sum", f"$__{field}Count"]}, None]}
+            averages = True
+        else:
+            raise RollupIneligibleError(f"accumulator {operator}")
+    return translated, projection if averages else None
+
+
+def rewrite_pipeline(pipeline):
+    """
+    Rewrites a sales pipeline of the form `$match`/`$unwind` stages, then
+    `$group` (or `$count`), then any stages, to the rollup collection of the
+    grain given by its `$unwind` stages. Filters must only use the rollup keys
+    and the accumulators only counts, sums and averages of the rollup measures.
+    Returns (grain, collection name, pipeline), raises RollupIneligibleError.
+    """
+    grain = "sale"
+    matches = []
+    for position, stage in enumerate(pipeline):
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise RollupIneligibleError(f"stage {stage}")
+        name, body = next(iter(stage.items()))
+        if name == "$match" and isinstance(body, dict):
+            matches.append(translate_match(body, grain))
+        elif name == "$unwind":
+            path = body.get("path") if isinstance(body, dict) and len(body) == 1 else body
+            unwinds = GRAINS[grain]["unwind"]
+            grains = [g for g, spec in GRAINS.items()
+                      if spec["unwind"] == unwinds + [str(path)[1:]] and str(path).startswith("$")]
+            if not grains:
+                raise RollupIneligibleError(f"$unwind of {body}")
+            grain = grains[0]
+        elif name in ("$group", "$count"):
+            break
+        else:
+            raise RollupIneligibleError(f"{name} before the $group")
+    else:
+        raise RollupIneligibleError("no $group")
+
+    if name == "$count":
+        if not isinstance(body, str):
+            raise RollupIneligibleError(f"$count {body}")
+        group, projection = translate_group({"_id": None, body: {"$sum": 1}}, grain)
+        projection = {"_id": 0, body: 1}
+    elif isinstance(body, dict) and "_id" in body:
+        group, projection = translate_group(body, grain)
+    else:
+        raise RollupIneligibleError(f"$group {body}")
+
+    if grain == "item":
+        # Sales without items have a daily document but no item groups
+        matches.append({"itemsCount": {"$gt": 0}})
+    rewritten = []
+    if matches:
+        rewritten.append({"$match": matches[0] if len(matches) == 1 else {"$and": matches}})
+    rewritten.append({"$group": group})
+    if projection is not None:
+        rewritten.append({"$project": projection})
+    return grain, GRAINS[grain]["collection"], rewritten + list(pipeline[position + 1:])
+
+
+def invalidate(database, *collections):
+    """Drops the cached aggregation results of the written collections."""
+    aggregation_cache.invalidate(*(f"{database.name}.{collection}" for collection in collections))
+
+
+class RollupManager:
+    """
+    Maintains the daily rollup collections of the sales and routes the
+    eligible generated pipelines to them. The rollups are rebuilt from the
+    sales, then updated incrementally with `$inc` upserts, from the insert
+    path or a change stream. Sales written while a rebuild runs may be
+    missed or counted twice, a failed update leaves the rollups stale, in
+    both cases the pipelines run on the raw sales until the next rebuild.
+    """
+
+    def __init__(self, mode=ROLLUP_UPDATE_MODE):
+        if mode not in ROLLUP_UPDATE_MODES:
+            raise ValueError(f"Unknown rollup update mode '{mode}', expected one of {ROLLUP_UPDATE_MODES}")
+        self.mode = mode
+        self.ready = False
+        self.rebuilds = 0
+        self.updates = 0
+        self.last_rebuild_seconds = None
+        self._stream = None
+        self._stopping = False
+        self._lock = threading.Lock()
+
+    def rebuild(self):
+        """Recomputes the rollup collections from the sales collection."""
+        with self._lock:
+            self.ready = False
+            start = time.perf_counter()
+            database = get_sales_db()
+            sales = database[SALES_COLLECTION]
+            try:
+                logger.info(f"Rebuilding the sales rollups {ROLLUP_DAILY_COLLECTION} and {ROLLUP_TAGS_COLLECTION}")
+                sales.aggregate(get_rollup_pipeline("sale") + [{"$out": ROLLUP_DAILY_COLLECTION}], allowDiskUse=True)
+                sales.aggregate(get_rollup_pipeline("item") + [{"$merge": {
+                    "into": ROLLUP_DAILY_COLLECTION, "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}}],
+                    allowDiskUse=True)
+                sales.aggregate(get_rollup_pipeline("tag") + [{"$out": ROLLUP_TAGS_COLLECTION}], allowDiskUse=True)
+            except Exception as e:
+                logger.error(f"Error rebuilding the sales rollups: {e}")
+                raise
+            invalidate(database, ROLLUP_DAILY_COLLECTION, ROLLUP_TAGS_COLLECTION)
+            self.rebuilds += 1
+            self.last_rebuild_seconds = time.perf_counter() - start
+            self.ready = True
+            logger.info(f"Sales rollups rebuilt in {self.last_rebuild_seconds:.2f}s")
+
+    def apply_sale(self, sale):
+        """Adds one inserted sale to the rollups."""
+        if not self.ready:
+            return
+        try:
+            database = get_sales_db()
+            for collection, operations in get_rollup_updates(sale).items():
+                database[collection].bulk_write(operations, ordered=False)
+                invalidate(database, collection)
+            self.updates += 1
+        except Exception as e:
+            self.ready = False
+            logger.error(f"Error updating the sales rollups, they are stale until the next rebuild: {e}")
+
+    def record_sale(self, sale):
+        """Called by the insert path, updates the rollups unless a change stream does."""
+        if ROLLUPS_ENABLED and self.mode == "insert":
+            self.apply_sale(sale)
+
+    def route(self, database, pipeline):
+        """The collection of `database` and the pipeline to run for a sales pipeline."""
+        sales = database[SALES_COLLECTION]
+        # Recorded cassettes hold the requests on the sales collection
+        if not ROLLUPS_ENABLED or cassette is not None:
+            return sales, pipeline
+        try:
+            grain, collection, rewritten = rewrite_pipeline(pipeline)
+        except RollupIneligibleError as e:
+            record_rollup_rewrite("none", "ineligible")
+            logger.info(f"Pipeline runs on the raw sales: {e}")
+            return sales, pipeline
+        if not self.ready:
+            record_rollup_rewrite(grain, "not_ready")
+            return sales, pipeline
+        record_rollup_rewrite(grain, "rewritten")
+        logger.info(f"Pipeline answered from {collection} ({grain} grain)")
+        return database[collection], rewritten
+
+    def _watch(self, stream):
+        try:
+            with stream:
+                for change in stream:
+                    invalidate(get_sales_db(), SALES_COLLECTION)
+                    if change["operationType"] == "insert":
+                        self.apply_sale(change["fullDocument"])
+                    else:
+                        logger.warning(f"Sales {change['operationType']} seen, rebuilding the rollups")
+                        self.rebuild()
+        except Exception as e:
+            if not self._stopping:
+                self.ready = False
+                logger.error(f"Sales change stream stopped, the rollups are stale: {e}")
+
+    def start(self):
+        """Builds the rollups when needed and, in watch mode, follows the sales changes."""
+        if not ROLLUPS_ENABLED:
+            return
+        # The stream is opened first so no sale is missed during the rebuild
+        stream = get_sales_db()[SALES_COLLECTION].watch() if self.mode == "watch" else None
+        if ROLLUP_REBUILD_ON_STARTUP or not get_sales_db()[ROLLUP_DAILY_COLLECTION].estimated_document_count():
+            self.rebuild()
+        else:
+            self.ready = True
+        if stream is not None:
+            self._stream = stream
+            threading.Thread(target=self._watch, args=(stream,), daemon=True).start()
+
+    def stop(self):
+        self._stopping = True
+        if self._stream is not None:
+            self._stream.close()
+
+    def stats(self):
+        return {
+            "enabled": ROLLUPS_ENABLED,
+            "mode": self.mode,
+            "ready": self.ready,
+            "rebuilds": self.rebuilds,
+            "updates": self.updates,
+            "last_rebuild_seconds": self.last_rebuild_seconds,
+        }
+
+
+rollup_manager = RollupManager()
@@ -0,0 +1,140 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from quality_agent.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+ROUTER_LOCAL_CLASSIFIER_ENABLED = os.getenv("ROUTER_LOCAL_CLASSIFIER_ENABLED", "true") == "true"
+ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.8"))
+ROUTER_EXAMPLES_PATH = os.getenv(
+    "ROUTER_EXAMPLES_PATH", os.path.join(os.path.dirname(__file__), "route_examples.json"))
+# Routing decisions of the LLM are appended here (JSON lines) and used as
+# additional training examples on the next start
+ROUTER_TRAFFIC_LOG_PATH = os.getenv("ROUTER_TRAFFIC_LOG_PATH")
+
+# Routes handled by the workflow graph
+ROUTES = ["Query_Data", "Visualization", "Help", "NoContext"]
+
+# Keyword rules are checked before the nearest-neighbour vote
+KEYWORD_RULES = [
+    ("Visualization", 0.95, re.compile(
+        r"\b(plot|chart|graph|visuali[sz]e|visuali[sz]ation|histogram|pie|scatter|heatmap|diagram)\b")),
+    ("Help", 0.9, re.compile(
+        r"^\s*help\b|\bhow (do|can) i use\b|\bwhat can you do\b|\bwhat (kind of )?questions\b")),
+]
+
+NEIGHBOURS = 5
+# Below this similarity the nearest examples are not considered a real match
+MIN_SIMILARITY = 0.35
+
+
+def tokenize(text):
+    words = []
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    bigrams = [f"{first} {second}" for first, second in zip(words, words[1:])]
+    return words + bigrams
+
+
+class RouteClassifier:
+    """
+    Local router: keyword rules plus TF-IDF nearest neighbours over labelled
+    questions. Returns the route and a confidence in [0, 1].
+    """
+
+    def __init__(self, examples):
+        self._lock = threading.Lock()
+        self.examples = []
+        self.idf = {}
+        self.fit(examples)
+
+    def fit(self, examples):
+        examples = [example for example in examples if example["route"] in ROUTES]
+        document_frequency = Counter()
+        tokenized = []
+        for example in examples:
+            tokens = tokenize(example["question"])
+            tokenized.append(tokens)
+            document_frequency.update(set(tokens))
+
+        number_of_documents = len(examples)
+        idf = {
+            token: math.log((1 + number_of_documents) / (1 + frequency)) + 1
+            for token, frequency in document_frequency.items()
+        }
+        vectors = [self._vectorize(tokens, idf) for tokens in tokenized]
+        with self._lock:
+            self.idf = idf
+            self.examples = [
+                (vector, example["route"]) for vector, example in zip(vectors, examples)
+            ]
+        logger.info(f"Route classifier trained on {len(examples)} examples")
+
+    def predict(self, question):
+        for route, confidence, pattern in KEYWORD_RULES:
+            if pattern.search(question.lower()):
+                return route, confidence
+
+        with self._lock:
+            vector = self._vectorize(tokenize(question), self.idf)
+            scored = sorted(
+                ((self._cosine(vector, example_vector), route)
+                 for example_vector, route in self.examples),
+                reverse=True,
+            )[:NEIGHBOURS]
+
+        votes = defaultdict(float)
+        for similarity, route in scored:
+            votes[route] += similarity
+        total = sum(votes.values())
+        if not total:
+            return "NoContext", 0.0
+
+        route, score = max(votes.items(), key=lambda item: item[1])
+        best_similarity = max(similarity for similarity, candidate in scored if candidate == route)
+        confidence = score / total
+        if best_similarity < MIN_SIMILARITY:
+            confidence *= best_similarity / MIN_SIMILARITY
+        return route, confidence
+
+    @staticmethod
+    def _vectorize(tokens, idf):
+        counts = Counter(token for token in tokens if token in idf)
+        vector = {token: count * idf[token] for token, count in counts.items()}
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        return {token: value / norm for token, value in vector.items()} if norm else {}
+
+    @staticmethod
+    def _cosine(first, second):
+        if len(first) > len(second):
+            first, second = second, first
+        return sum(value * second.get(token, 0.0) for token, value in first.items())
+
+
+def load_route_examples():
+    with open(ROUTER_EXAMPLES_PATH, "r", encoding="utf-8") as file:
+        examples = json.load(file)
+    if ROUTER_TRAFFIC_LOG_PATH and os.path.exists(ROUTER_TRAFFIC_LOG_PATH):
+        with open(ROUTER_TRAFFIC_LOG_PATH, "r", encoding="utf-8") as file:
+            examples += [json.loads(line) for line in file if line.strip()]
+    return examples
+
+
+def log_routing_decision(question, route):
+    """Appends an LLM routing decision to the traffic log used for training."""
+    if not ROUTER_TRAFFIC_LOG_PATH or route not in ROUTES:
+        return
+    try:
+        with open(ROUTER_TRAFFIC_LOG_PATH, "a", encoding="utf-8") as file:
+            file.write(json.dumps({"question": question, "route": route}) + "\n")
+    except OSError as e:
+        logger.warning(f"Unable to log routing decision: {e}")
+
+
+route_classifier = RouteClassifier(load_route_examples())
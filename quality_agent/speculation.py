@@ -0,0 +1,224 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextvars import ContextVar
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables.config import var_child_runnable_config
+from prometheus_client import Counter, Histogram
+from quality_agent.logger import setup_logger
+from quality_agent.metrics import LATENCY_BUCKETS, get_token_usage
+from quality_agent.rate_limiter import estimate_tokens
+
+logger = setup_logger(__name__)
+
+SPECULATION_ENABLED = os.getenv("SPECULATION_ENABLED", "false") == "true"
+# Routes whose first stages may start while the router LLM is still deciding
+SPECULATION_ROUTES = [route.strip() for route in os.getenv(
+    "SPECULATION_ROUTES", "Visualization,Query_Data").split(",") if route.strip()]
+# Minimum confidence of the local classifier to speculate on its route. Above
+# ROUTER_CONFIDENCE_THRESHOLD the local route is used without the LLM router.
+SPECULATION_MIN_CONFIDENCE = float(os.getenv("SPECULATION_MIN_CONFIDENCE", "0.5"))
+# Speculative results not taken by their stage within this time are cancelled
+SPECULATION_TTL_SECONDS = float(os.getenv("SPECULATION_TTL_SECONDS", "120"))
+
+# Id of the speculation kept for the current request, for the stages that do
+# not see the graph state (the sales tool of the inspection agent)
+current_speculation_id = ContextVar("current_speculation_id", default=None)
+
+SPECULATION_OUTCOMES = Counter(
+    "querygenai_speculation_total", "Speculations by route and outcome", ["route", "outcome"])
+SPECULATION_TOKENS = Counter(
+    "querygenai_speculation_tokens_total", "Tokens spent on speculative LLM calls", ["route", "outcome"])
+SPECULATION_SAVED_SECONDS = Histogram(
+    "querygenai_speculation_saved_seconds", "Latency saved by a speculative stage", ["stage"],
+    buckets=LATENCY_BUCKETS)
+
+
+class TokenTally(BaseCallbackHandler):
+    """Counts the tokens of the LLM calls of a speculation, including the cancelled ones."""
+
+    run_inline = True
+
+    def __init__(self):
+        self.tokens = 0
+        self._prompt_tokens = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        prompt_tokens = sum(estimate_tokens(prompt) for prompt in messages)
+        with self._lock:
+            self._prompt_tokens[run_id] = prompt_tokens
+            self.tokens += prompt_tokens
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            estimated_prompt_tokens = self._prompt_tokens.pop(run_id, 0)
+        prompt_tokens, completion_tokens = get_token_usage(response, estimated_prompt_tokens)
+        with self._lock:
+            # The reported prompt tokens replace the estimate
+            self.tokens += prompt_tokens - estimated_prompt_tokens + completion_tokens
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            self._prompt_tokens.pop(run_id, None)
+
+
+class Speculation:
+    """Work started for a predicted route before the router confirmed it."""
+
+    def __init__(self, route):
+        self.id = uuid.uuid4().hex
+        self.route = route
+        self.started = time.monotonic()
+        self.tally = TokenTally()
+        self.keys = set()
+        self.cancelled = False
+        self.charged_tokens = 0
+
+
+class SpeculationManager:
+    """
+    Runs speculative stages as detached tasks and hands their results to the
+    stage that would otherwise compute them. Stages are keyed within their
+    speculation, so concurrent requests never share one. Tasks of a
+    speculation whose route was not confirmed are cancelled, results not
+    taken in time expire. Reports per route how often speculation hit, the
+    tokens it cost and the latency it saved.
+    """
+
+
+    def __init__(self, ttl=SPECULATION_TTL_SECONDS):
+        self.ttl = ttl
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self.outcomes = defaultdict(int)
+        self.tokens = defaultdict(int)
+        self.saved_seconds = 0.0
+        self.used_stages = 0
+        self.expired_stages = 0
+
+    def start(self, route):
+        self._expire()
+        return Speculation(route)
+
+    def spawn(self, speculation, key, coroutine_function):
+        """Runs `coroutine_function()` as the speculative result of `key`."""
+        if speculation.cancelled:
+            return
+
+        async def run():
+            # Detach from the router node's run, the speculative calls are not part of it
+            var_child_runnable_config.set({"callbacks": [speculation.tally]})
+            result = await coroutine_function()
+            return result, time.monotonic()
+
+        task = asyncio.get_running_loop().create_task(run())
+        task.add_done_callback(self._log_failure)
+        key = (speculation.id, key)
+        with self._lock:
+            previous = self._tasks.pop(key, None)
+            self._tasks[key] = (speculation, task, time.monotonic())
+        if previous is not None:
+            previous[1].cancel()
+        speculation.keys.add(key)
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Speculative stage failed: {task.exception()}")
+
+    def resolve(self, speculation, route):
+        """Keeps the speculation if the router confirmed its route, cancels it otherwise."""
+        if speculation.route == route:
+            self._record(speculation, "hit")
+            logger.info(f"Speculation on {route} confirmed")
+            return True
+        speculation.cancelled = True
+        with self._lock:
+            tasks = [self._tasks.pop(key) for key in speculation.keys if key in self._tasks]
+        for _, task, _ in tasks:
+            task.cancel()
+        # Tokens of calls cancelled mid-flight are counted at their estimate
+        self._record(speculation, "miss")
+        logger.info(f"Speculation on {speculation.route} cancelled, routed to {route}")
+        return False
+
+    async def take(self, speculation_id, key):
+        """
+        Result of the speculative stage `key` of the speculation, awaited if
+        still running. Returns None when there is none or it failed, the
+        caller then computes it.
+        """
+        self._expire()
+        if speculation_id is None:
+            return None
+        with self._lock:
+            entry = self._tasks.pop((speculation_id, key), None)
+        if entry is None:
+            return None
+        speculation, task, started = entry
+        # The stage would have started now, the speculative run had this head start
+        head_start = time.monotonic() - started
+        try:
+            result, finished = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            raise
+        except Exception:
+            return None
+        saved = min(head_start, finished - started)
+        SPECULATION_SAVED_SECONDS.labels(key.split(":", 1)[0]).observe(saved)
+        with self._lock:
+            self.saved_seconds += saved
+            self.used_stages += 1
+        self._charge(speculation, "hit")
+        return result
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (_, _, started) in self._tasks.items() if now - started > self.ttl]
+            entries = [self._tasks.pop(key) for key in expired]
+            self.expired_stages += len(entries)
+        for speculation, task, _ in entries:
+            task.cancel()
+            self._charge(speculation, "unused")
+            logger.info(f"Speculative {speculation.route} stage expired unused")
+
+    def _record(self, speculation, outcome):
+        SPECULATION_OUTCOMES.labels(speculation.route, outcome).inc()
+        with self._lock:
+            self.outcomes[(speculation.route, outcome)] += 1
+        self._charge(speculation, outcome)
+
+    def _charge(self, speculation, outcome):
+        """Adds the tokens the speculation spent since it was last charged."""
+        with self._lock:
+            tokens = speculation.tally.tokens - speculation.charged_tokens
+            speculation.charged_tokens += tokens
+            self.tokens[(speculation.route, outcome)] += tokens
+        SPECULATION_TOKENS.labels(speculation.route, outcome).inc(max(tokens, 0))
+
+    def stats(self):
+        self._expire()
+        routes = defaultdict(dict)
+        for route, outcome in set(self.outcomes) | set(self.tokens):
+            routes[route][outcome] = {
+                "count": self.outcomes.get((route, outcome), 0),
+                "tokens": self.tokens.get((route, outcome), 0),
+            }
+        return {
+            "enabled": SPECULATION_ENABLED,
+            "routes": dict(routes),
+            "pending_stages": len(self._tasks),
+            "used_stages": self.used_stages,
+            "expired_stages": self.expired_stages,
+            "saved_seconds": self.saved_seconds,
+        }
+
+
+speculation_manager = SpeculationManager()
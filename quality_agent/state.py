@@ -1,16 +1,21 @@
 from typing import List, Any, Annotated, Dict, Optional, Sequence
 from typing_extensions import TypedDict
-import operator
+from quality_agent.history import add_messages_capped
 from langgraph.prebuilt.chat_agent_executor import AgentState
 
 
 class MultiAgentState(AgentState):
-    messages: Annotated[Sequence[Any], operator.add]
+    messages: Annotated[Sequence[Any], add_messages_capped]
     question: str
     question_type: str
     answer: str
     rephrasedQuestion: Optional[str]
+    visualizationPlan: Optional[Dict[str, Any]]
+    mongoPipeline: Optional[list]
     mongoQueryResult: Optional[list]
+    mongoQueryTruncated: Optional[bool]
+    mongoQueryPartial: Optional[bool]
     chart: Optional[str]
     newSale: Optional[Dict[str, Any]]
+    speculationId: Optional[str]
 
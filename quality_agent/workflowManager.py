@@ -3,14 +3,23 @@ from langgraph.graph import StateGraph, END
 from quality_agent.state import MultiAgentState
 from quality_agent.llmManager import LLMManager
 from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.runnables import RunnableLambda
 from langchain_core.runnables.graph import MermaidDrawMethod
 from tools.inspectionTools import inspectionTools
 from langchain.agents import AgentExecutor, create_tool_calling_agent
-from prompts.routerPrompt import get_router_prompt
-from prompts.inspectionPrompt import get_inspection_prompt
-from prompts.actionsPrompt import get_schedule_prompt
-from langgraph.checkpoint.memory import MemorySaver
-from quality_agent.plot_generator import rephrase_user_query_for_visualization, generate_mongo_query, generate_chart_based_on_query
+from prompts.promptRegistry import get_prompt
+from quality_agent.checkpointer import get_checkpointer
+from quality_agent.cassette import cassette
+from quality_agent.database import get_sales_db
+from quality_agent.batch import deduplicate
+from quality_agent.history import get_history_view
+from quality_agent.metrics import record_mongo_operation, METRICS_ENABLED
+from quality_agent.mongo_data_retriever import agenerate_sales_pipeline
+from quality_agent.rollups import rollup_manager
+from quality_agent.aggregation_cache import aggregation_cache
+from quality_agent.speculation import speculation_manager, current_speculation_id, SPECULATION_ENABLED, SPECULATION_ROUTES, SPECULATION_MIN_CONFIDENCE
+from quality_agent.route_classifier import route_classifier, log_routing_decision, ROUTER_LOCAL_CLASSIFIER_ENABLED, ROUTER_CONFIDENCE_THRESHOLD
+from quality_agent.plot_generator import rephrase_user_query_for_visualization, generate_mongo_query, generate_chart_based_on_query, arephrase_user_query_for_visualization, agenerate_mongo_query, agenerate_chart_based_on_query, plan_visualization, aplan_visualization, VISUALIZATION_MODE
 from langgraph.errors import NodeInterrupt
 from dateutil.parser import isoparse
 from langchain_community.chat_message_histories import ChatMessageHistory
@@ -19,8 +28,9 @@ from quality_agent.logger import setup_logger
 import os
 import ntpath
 import json
-from pymongo import MongoClient
+import time
 import base64
+import bson
 import plotly.io as pio
 from io import BytesIO
 from dotenv import load_dotenv
@@ -32,9 +42,6 @@ logger = setup_logger(__name__)
 
 store = {}
 
-client = MongoClient(os.getenv('MONGODB_CONNECTION_STRING'))
-db = client[os.getenv('MONGODB_DATABASE_NAME')]
-sales_db = client[os.getenv('MONGODB_SALES_DATABASE_NAME')]
 
 class WorkflowManager:
     def __init__(self, llm_manager: LLMManager):
@@ -42,18 +49,71 @@ class WorkflowManager:
             logger.info("Initializing WorkflowManager")
             self.llm_manager = llm_manager
             self.llm = llm_manager.llm
-            self.vision_llm = llm_manager.vision_llm
             self.llm_for_router = llm_manager.llm_for_router
             logger.info("WorkflowManager initialized successfully")
         except Exception as e:
             logger.error(f"Error initializing WorkflowManager: {e}")
             raise
 
+    def local_router(self, state: MultiAgentState):
+        """
+        Routes with the local classifier and returns None when it is not
+        confident enough, in which case the LLM router decides.
+        """
+        if not ROUTER_LOCAL_CLASSIFIER_ENABLED:
+            return None
+        route, confidence = route_classifier.predict(state['question'])
+        if confidence < ROUTER_CONFIDENCE_THRESHOLD:
+            logger.info(f"Local router not confident ({route}: {confidence:.2f}), using LLM")
+            return None
+        logger.info(f"Routing to: {route} (local classifier, confidence {confidence:.2f})")
+        return {"question_type": route, 'messages': [HumanMessage(state['question'])], "speculationId": None}
+
+    def start_speculation(self, state: MultiAgentState, human_msg):
+        """
+        Starts the first stages of the route the local classifier leans to
+        while the LLM router decides, and returns the speculation or None.
+        """
+        if not SPECULATION_ENABLED:
+            return None
+        route, confidence = route_classifier.predict(state['question'])
+        if route not in SPECULATION_ROUTES or confidence < SPECULATION_MIN_CONFIDENCE:
+            return None
+        speculation = speculation_manager.start(route)
+        logger.info(f"Speculating on {route} (confidence {confidence:.2f})")
+
+        if route == "Visualization":
+            messages = list(state['messages']) + [human_msg]
+
+            async def rephrase():
+                if VISUALIZATION_MODE == "single_call":
+                    update = await aplan_visualization({"messages": messages})
+                else:
+                    update = await arephrase_user_query_for_visualization({"messages": messages})
+                # The pipeline of the rephrased question is the next stage, unless it was planned
+                if not update.get('visualizationPlan'):
+                    speculation_manager.spawn(
+                        speculation, f"pipeline:{update['rephrasedQuestion']}",
+                        lambda: agenerate_sales_pipeline(update['rephrasedQuestion']))
+                return update
+
+            speculation_manager.spawn(speculation, "rephrase", rephrase)
+        elif route == "Query_Data":
+            # Used when the inspection agent queries the sales data with the question itself
+            speculation_manager.spawn(
+                speculation, f"pipeline:{state['question']}",
+                lambda: agenerate_sales_pipeline(state['question']))
+        return speculation
+
     def router_agent(self, state: MultiAgentState):
         try:
             logger.info(f"Routing question: {state['question']}")
-            supervisor_chain = get_router_prompt() | self.llm_for_router
-            messages = state['messages']
+            local_route = self.local_router(state)
+            if local_route:
+                return local_route
+
+            supervisor_chain = get_prompt("router") | self.llm_for_router
+            messages = get_history_view(state['messages'], "router")
 
             human_msg = HumanMessage(state['question'])
             # print('human_msg', human_msg, type(human_msg))
@@ -66,10 +126,52 @@ class WorkflowManager:
             if 'content_filter_result' in response:
                 logger.warning(
                     "The response was filtered due to content management policy.")
-                return {"question_type": "Error", 'messages': human_msg }
+                return {"question_type": "Error", 'messages': human_msg, "speculationId": None}
 
             logger.info(f"Routing to: {response.content}")
-            return {"question_type": response.content, 'messages': [human_msg]}
+            log_routing_decision(state['question'], response.content)
+            # A speculation of an earlier turn must not be taken by this one
+            return {"question_type": response.content, 'messages': [human_msg], "speculationId": None}
+        except Exception as e:
+            logger.error(f"Error in router_agent: {e}")
+            raise
+
+    async def arouter_agent(self, state: MultiAgentState):
+        try:
+            logger.info(f"Routing question: {state['question']}")
+            local_route = self.local_router(state)
+            if local_route:
+                return local_route
+
+            supervisor_chain = get_prompt("router") | self.llm_for_router
+            human_msg = HumanMessage(state['question'])
+            messages = get_history_view(state['messages'], "router") + [human_msg]
+            speculation = self.start_speculation(state, human_msg)
+
+            # Identical conversations within a batch share one routing call
+            try:
+                response = await deduplicate(
+                    "router",
+                    repr([message.content for message in messages]),
+                    lambda: supervisor_chain.ainvoke({"question": messages}))
+            except BaseException:
+                if speculation:
+                    speculation_manager.resolve(speculation, None)
+                raise
+
+            # Check if the response was filtered
+            if 'content_filter_result' in response:
+                logger.warning(
+                    "The response was filtered due to content management policy.")
+                if speculation:
+                    speculation_manager.resolve(speculation, "Error")
+                return {"question_type": "Error", 'messages': human_msg, "speculationId": None}
+
+            logger.info(f"Routing to: {response.content}")
+            log_routing_decision(state['question'], response.content)
+            kept = speculation is not None and speculation_manager.resolve(speculation, response.content)
+            return {"question_type": response.content, 'messages': [human_msg],
+                    "speculationId": speculation.id if kept else None}
         except Exception as e:
             logger.error(f"Error in router_agent: {e}")
             raise
@@ -79,27 +181,30 @@ class WorkflowManager:
             store[session_id] = ChatMessageHistory()
         return store[session_id]
 
+    def get_inspection_agent_executor(self):
+        inspectionAgent = create_tool_calling_agent(
+            llm=self.llm,
+            prompt=get_prompt("inspection"),
+            tools=inspectionTools,
+        )
+        return AgentExecutor(
+            agent=inspectionAgent,
+            tools=inspectionTools,
+            verbose=True,
+            handle_parsing_errors=True,
+            max_iterations=10,
+            return_intermediate_steps=False)
+
     def query_data_node(self, state: MultiAgentState):
         try:
             logger.info(
                 f"Processing inspection node for question: {state['question']}")
-            inspectionAgent = create_tool_calling_agent(
-                llm=self.llm,
-                prompt=get_inspection_prompt(inspectionTools),
-                tools=inspectionTools,
-            )
-            inspection_agent_executor = AgentExecutor(
-                agent=inspectionAgent,
-                tools=inspectionTools,
-                verbose=True,
-                handle_parsing_errors=True,
-                max_iterations=10,
-                return_intermediate_steps=False)
+            inspection_agent_executor = self.get_inspection_agent_executor()
             
             logger.info(f"Input to agent executor: {state['question']}")
 
             response = inspection_agent_executor.invoke(
-                {"message_history_with_input": state['messages']})
+                {"message_history_with_input": get_history_view(state['messages'], "inspection")})
             
             ai_msg = AIMessage(response["output"])
 
@@ -108,6 +213,26 @@ class WorkflowManager:
             logger.error(f"Error in inspection_node: {e}")
             raise
 
+    async def aquery_data_node(self, state: MultiAgentState):
+        try:
+            logger.info(
+                f"Processing inspection node for question: {state['question']}")
+            inspection_agent_executor = self.get_inspection_agent_executor()
+
+            logger.info(f"Input to agent executor: {state['question']}")
+
+            # The sales tool takes the pipeline speculated during routing
+            current_speculation_id.set(state.get('speculationId'))
+            response = await inspection_agent_executor.ainvoke(
+                {"message_history_with_input": get_history_view(state['messages'], "inspection")})
+
+            ai_msg = AIMessage(response["output"])
+
+            return {'answer': response["output"], 'messages':[ai_msg]}
+        except Exception as e:
+            logger.error(f"Error in inspection_node: {e}")
+            raise
+
     def record_sales_node(self, state: MultiAgentState):
         try:
             logger.info(
@@ -116,7 +241,7 @@ class WorkflowManager:
                 return {"answer": "Sales Recording process has been cancelled."}
             
 
-            extractor_chain = get_schedule_prompt() | self.vision_llm
+            extractor_chain = get_prompt("schedule") | self.llm_manager.vision_llm
 
             # Path to the PNG image
             image_path = "bill_receipt.png"
@@ -209,7 +334,7 @@ class WorkflowManager:
                     ]
                 )
 
-            messages = state['messages'] +  [human_msg]
+            messages = get_history_view(state['messages'], "analyze_plot") + [human_msg]
 
             logger.info(f"Analyzing the plot image...")
 
@@ -231,9 +356,19 @@ class WorkflowManager:
 
             sale_document = state['newSale']
             sale_document = json.loads(sale_document)
-            document = sales_db["sales"].insert_one(sale_document)
+            sales = get_sales_db()["sales"]
+            start = time.perf_counter()
+            try:
+                document = sales.insert_one(sale_document)
+            except Exception:
+                record_mongo_operation("insert_one", "sales", time.perf_counter() - start, "error")
+                raise
+            record_mongo_operation("insert_one", "sales", time.perf_counter() - start, rows=1,
+                                   payload_bytes=len(bson.encode(sale_document)) if METRICS_ENABLED else None)
+            aggregation_cache.invalidate(sales.full_name)
             if document is None:
                 return {"answer": "Failed to save the sales records. Please try again."}
+            rollup_manager.record_sale(sale_document)
 
 
             return {"answer": f"The sales transactions are recorded successfully with document id", "newSale": None}
@@ -278,13 +413,24 @@ class WorkflowManager:
         try:
             logger.info("Creating workflow graph")
             workflow = StateGraph(MultiAgentState)
-            workflow.add_node("router_node", self.router_agent)
+            # Nodes carry both a sync and an async implementation so the graph
+            # can be driven with `stream` as well as `astream`.
+            workflow.add_node(
+                "router_node",
+                RunnableLambda(self.router_agent, afunc=self.arouter_agent))
             workflow.set_entry_point("router_node")
-            workflow.add_node("query_data_node", self.query_data_node)
-            # workflow.add_node("analyze_plot_node", self.analyze_plot_node)
             workflow.add_node(
-                "visualization_node",
-                rephrase_user_query_for_visualization)
+                "query_data_node",
+                RunnableLambda(self.query_data_node, afunc=self.aquery_data_node))
+            # workflow.add_node("analyze_plot_node", self.analyze_plot_node)
+            # In single-call mode the visualization node plans the pipeline and
+            # the chart too, the next nodes only call the LLM when the plan fails
+            if VISUALIZATION_MODE == "single_call":
+                visualization_node = RunnableLambda(plan_visualization, afunc=aplan_visualization)
+            else:
+                visualization_node = RunnableLambda(rephrase_user_query_for_visualization,
+                                                    afunc=arephrase_user_query_for_visualization)
+            workflow.add_node("visualization_node", visualization_node)
             # workflow.add_node(
             #     "record_sales_node",
             #     self.record_sales_node)
@@ -293,10 +439,11 @@ class WorkflowManager:
             #     self.human_record_sales_confirmation_node)
             workflow.add_node(
                 "generate_mongo_query_node",
-                generate_mongo_query)
+                RunnableLambda(generate_mongo_query, afunc=agenerate_mongo_query))
             workflow.add_node(
                 "generate_chart_node",
-                generate_chart_based_on_query)
+                RunnableLambda(generate_chart_based_on_query,
+                               afunc=agenerate_chart_based_on_query))
            
             workflow.add_node("help_node", self.help_node)
             workflow.add_node("no_context_node", self.no_context_node)
@@ -340,11 +487,28 @@ class WorkflowManager:
     def generate_graph(self):
         try:
             logger.info("Generating workflow graph")
-            memory = MemorySaver()
+            memory = get_checkpointer()
             enableDebugging = os.getenv("ENABLE_DEBUGGING") == "true"
             graph = self.create_workflow().compile(checkpointer=memory, debug=enableDebugging,
                                                    )
             graph.name = "Text to NoSQL Agent Graph"
+            self.draw_graph(graph)
+            logger.info("Workflow graph generated successfully")
+            return graph
+        except Exception as e:
+            logger.error(f"Error generating workflow graph: {e}")
+            raise
+
+    def draw_graph(self, graph):
+        """
+        Saves the graph to workflow_graph.png through the mermaid.ink API.
+        Skipped when replaying a cassette, which runs offline; a failure to draw
+        does not prevent the application from starting.
+        """
+        if cassette is not None and cassette.replaying:
+            logger.info("Replaying a cassette, the workflow graph is not drawn")
+            return
+        try:
             # Draw the graph and get the bytes
             image_bytes = graph.get_graph().draw_mermaid_png(
                 draw_method=MermaidDrawMethod.API,
@@ -353,8 +517,5 @@ class WorkflowManager:
             # Save the bytes to an image file
             with open("workflow_graph.png", "wb") as image_file:
                 image_file.write(image_bytes)
-            logger.info("Workflow graph generated successfully")
-            return graph
         except Exception as e:
-            logger.error(f"Error generating workflow graph: {e}")
-            raise
+            logger.warning(f"Unable to draw the workflow graph: {e}")
@@ -0,0 +1,64 @@
+from datetime import datetime
+
+from quality_agent.aggregation_cache import AggregationResultCache, canonicalize, encode_documents
+
+
+class FakeCollection:
+    full_name = "sales_db.sales"
+
+
+PIPELINE = [{"$match": {"storeLocation": "Denver"}}, {"$group": {"_id": "$purchaseMethod", "count": {"$sum": 1}}}]
+DOCUMENTS = [{"_id": "Online", "count": 3, "since": datetime(2015, 1, 1)}, {"_id": "Phone", "count": 1.5}]
+
+
+def store(cache, pipeline=PIPELINE, documents=DOCUMENTS, truncated=False):
+    key = cache.get_key(FakeCollection(), pipeline, 10)
+    cache.store(key, cache.generation(key), {"documents": documents, "truncated": truncated},
+                encode_documents(documents))
+    return key
+
+
+def test_hit_returns_a_copy():
+    cache = AggregationResultCache()
+    key = store(cache, truncated=True)
+    result = cache.lookup(key)
+    assert result == {"documents": DOCUMENTS, "truncated": True, "max_rows": 10, "partial": False}
+    result["documents"][0]["count"] = 99
+    assert cache.lookup(key)["documents"][0]["count"] == 3
+    assert cache.stats()["bytes"] == sum(len(document) for document in encode_documents(DOCUMENTS))
+
+
+def test_match_field_order_shares_the_key():
+    reordered = [{"$match": {"purchaseMethod": "Online", "storeLocation": "Denver"}}]
+    assert canonicalize(reordered) == canonicalize([{"$match": {"storeLocation": "Denver", "purchaseMethod": "Online"}}])
+    assert canonicalize([{"$match": {"count": 1}}]) != canonicalize([{"$match": {"count": 1.0}}])
+
+
+def test_unencodable_result_not_stored():
+    cache = AggregationResultCache()
+    assert encode_documents([{"value": object()}]) is None
+    store(cache, documents=[{"value": object()}])
+    assert cache.stats()["entries"] == 0
+
+
+def test_write_between_run_and_store_skips_the_result():
+    cache = AggregationResultCache()
+    key = cache.get_key(FakeCollection(), PIPELINE, 10)
+    generation = cache.generation(key)
+    cache.invalidate(FakeCollection.full_name)
+    cache.store(key, generation, {"documents": DOCUMENTS, "truncated": False}, encode_documents(DOCUMENTS))
+    assert cache.lookup(key) is None
+
+
+def test_eviction_by_bytes():
+    size = sum(len(document) for document in encode_documents(DOCUMENTS))
+    cache = AggregationResultCache(max_bytes=2 * size)
+    keys = [store(cache, pipeline=[{"$limit": limit}]) for limit in range(1, 4)]
+    assert cache.lookup(keys[0]) is None
+    assert cache.lookup(keys[2]) is not None
+    assert cache.stats()["bytes"] == 2 * size and cache.stats()["evictions"] == 1
+
+
+def test_nondeterministic_pipeline_not_cached():
+    cache = AggregationResultCache()
+    assert cache.get_key(FakeCollection(), [{"$sample": {"size": 3}}], 10) is None
@@ -0,0 +1,90 @@
+import pytest
+
+from quality_agent.answer_cache import SemanticAnswerCache, get_guard_terms, normalize_question
+
+STORED_QUESTION = "What is the average number of items sold per sale in the Denver store in 2015"
+
+
+def get_cache():
+    return SemanticAnswerCache(get_data_version=lambda: "v1")
+
+
+@pytest.mark.parametrize("question", [
+    "What is the total number of items sold per sale in the Denver store in 2015",
+    "What is the maximum number of items sold per sale in the Denver store in 2015",
+    "What is the minimum number of items sold per sale in the Denver store in 2015",
+    "What is the median number of items sold per sale in the Denver store in 2015",
+    "What is the count of items sold per sale in the Denver store in 2015",
+])
+def test_other_aggregation_misses(question):
+    cache = get_cache()
+    cache.store(STORED_QUESTION, {"answer": "avg"}, "query_data_node")
+    assert cache.lookup(question) is None
+
+
+@pytest.mark.parametrize("question", [
+    "What is the avg number of items sold per sale in the Denver store in 2015",
+    "What is the mean number of items sold per sale in the Denver store in 2015",
+])
+def test_aggregation_synonyms_hit(question):
+    cache = get_cache()
+    cache.store(STORED_QUESTION, {"answer": "avg"}, "query_data_node")
+    assert cache.lookup(question)["response"] == {"answer": "avg"}
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("Plot a bar chart of the sales per store location", "Plot a pie chart of the sales per store location"),
+    ("Plot a line chart of the monthly sales in 2017", "Plot a scatter chart of the monthly sales in 2017"),
+    ("Plot a histogram of the customer age in Denver", "Plot a bar chart of the customer age in Denver"),
+])
+def test_other_chart_type_misses(stored, asked):
+    cache = get_cache()
+    cache.store(stored, {"answer": "chart"}, "visualization_node")
+    assert cache.lookup(asked) is None
+
+
+def test_same_question_hits():
+    cache = get_cache()
+    cache.store(STORED_QUESTION, {"answer": "avg"}, "query_data_node")
+    assert cache.lookup(STORED_QUESTION.lower() + "?") is not None
+    assert cache.stats()["hits"] == 1
+
+
+def test_guard_terms_fold_plurals_and_synonyms():
+    assert get_guard_terms(normalize_question("sums of sales")) == get_guard_terms(normalize_question("total sales"))
+    assert "average" in get_guard_terms(normalize_question("averages per store"))
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("List the sales in Denver sorted by total amount in descending order",
+     "List the sales in Denver sorted by total amount in ascending order"),
+    ("How many sales were made to customers whose customer gender is F",
+     "How many sales were made to customers whose customer gender is M"),
+    ("What is the average satisfaction of customers younger than 40 in Seattle",
+     "What is the average satisfaction of customers older than 40 in Seattle"),
+])
+def test_one_differing_word_misses(stored, asked):
+    cache = get_cache()
+    cache.store(stored, {"answer": "stored"}, "query_data_node")
+    assert cache.lookup(asked) is None
+
+
+@pytest.mark.parametrize("asked", [
+    "Show me the average sales per store in Denver",
+    "Denver: avg sale per store",
+    "mean sales per store in Denver please",
+])
+def test_rewording_without_new_content_hits(asked):
+    cache = get_cache()
+    cache.store("What is the average of the sales per store in Denver?", {"answer": "avg"}, "query_data_node")
+    assert cache.lookup(asked)["response"] == {"answer": "avg"}
+
+
+def test_write_generation_clears_the_cache():
+    generation = [0]
+    cache = SemanticAnswerCache(get_data_version=lambda: "v1", get_write_generation=lambda: generation[0])
+    cache.store(STORED_QUESTION, {"answer": "avg"}, "query_data_node")
+    assert cache.lookup(STORED_QUESTION) is not None
+    generation[0] += 1
+    assert cache.lookup(STORED_QUESTION) is None
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,110 @@
+import asyncio
+import importlib
+
+import pytest
+
+from quality_agent.batch import SingleFlight, current_batch, deduplicate
+
+
+def counted(results, value, seconds=0.01, error=None):
+    async def factory():
+        results.append(value)
+        await asyncio.sleep(seconds)
+        if error is not None:
+            raise error
+        return {"value": value}
+    return factory
+
+
+def in_batch(calls):
+    async def main():
+        batch = SingleFlight()
+        token = current_batch.set(batch)
+        try:
+            return batch, await asyncio.gather(*calls(), return_exceptions=True)
+        finally:
+            current_batch.reset(token)
+    return asyncio.run(main())
+
+
+def test_same_key_shares_one_call():
+    calls = []
+    batch, results = in_batch(lambda: [deduplicate("pipeline", "a", counted(calls, "a")) for _ in range(3)]
+                              + [deduplicate("pipeline", "b", counted(calls, "b"))])
+    assert calls == ["a", "b"]
+    assert results == [{"value": "a"}] * 3 + [{"value": "b"}]
+    assert (batch.hits, batch.misses) == (2, 2)
+    # Every caller gets its own copy
+    results[0]["value"] = "changed"
+    assert results[1] == {"value": "a"}
+
+
+def test_namespaces_do_not_share():
+    calls = []
+    in_batch(lambda: [deduplicate("pipeline", "a", counted(calls, 1)), deduplicate("aggregate", "a", counted(calls, 2))])
+    assert calls == [1, 2]
+
+
+def test_no_batch_runs_directly():
+    calls = []
+
+    async def main():
+        return [await deduplicate("pipeline", "a", counted(calls, "a")) for _ in range(2)]
+
+    assert asyncio.run(main()) == [{"value": "a"}] * 2
+    assert calls == ["a", "a"]
+
+
+def test_failure_is_shared_and_not_memoized():
+    calls = []
+
+    async def retry():
+        await asyncio.sleep(0.05)
+        return await deduplicate("pipeline", "a", counted(calls, "retry"))
+
+    _, results = in_batch(lambda: [deduplicate("pipeline", "a", counted(calls, "a", error=ValueError("boom"))),
+                                   deduplicate("pipeline", "a", counted(calls, "other")), retry()])
+    assert isinstance(results[0], ValueError) and results[1] is results[0]
+    assert results[2] == {"value": "retry"}
+    assert calls == ["a", "retry"]
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_call():
+    calls = []
+
+    async def main():
+        batch = SingleFlight()
+        current_batch.set(batch)
+        first = asyncio.ensure_future(deduplicate("pipeline", "a", counted(calls, "a", seconds=0.05)))
+        second = asyncio.ensure_future(deduplicate("pipeline", "a", counted(calls, "other")))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == {"value": "a"}
+    assert calls == ["a"]
+
+
+def test_sales_pipelines_differing_in_sort_order_are_not_shared(monkeypatch):
+    # The retriever builds its LLM chains on import, no request is sent
+    monkeypatch.setenv("GROQ_API_KEY", "test")
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    retriever = importlib.import_module("quality_agent.mongo_data_retriever")
+    monkeypatch.setattr(retriever, "use_async_client", lambda: False)
+    calls = []
+    monkeypatch.setattr(retriever, "run_sales_pipeline", lambda pipeline: calls.append(pipeline) or pipeline)
+    group = {"$group": {"_id": "$storeLocation", "total": {"$sum": 1}}}
+    pipelines = [
+        [{"$match": {"storeLocation": "Denver", "purchaseMethod": "Online"}}, group,
+         {"$sort": {"total": -1, "storeLocation": 1}}],
+        [{"$match": {"purchaseMethod": "Online", "storeLocation": "Denver"}}, group,
+         {"$sort": {"total": -1, "storeLocation": 1}}],
+        [{"$match": {"storeLocation": "Denver", "purchaseMethod": "Online"}}, group,
+         {"$sort": {"storeLocation": 1, "total": -1}}],
+    ]
+    _, results = in_batch(lambda: [retriever.arun_sales_pipeline(pipeline) for pipeline in pipelines])
+    # Reordered $match fields share the call, a reordered $sort does not
+    assert calls == [pipelines[0], pipelines[2]]
+    assert results == [pipelines[0], pipelines[0], pipelines[2]]
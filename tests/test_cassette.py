@@ -0,0 +1,77 @@
+import asyncio
+
+import mongomock
+import pytest
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from quality_agent.cassette import Cassette, CassetteChatModel, CassetteDatabase, CassetteMissError
+
+
+def get_cassette(path, mode):
+    # Replay without waiting for the recorded latency
+    return Cassette(str(path), mode, llm_latency_ms="0", mongo_latency_ms="0")
+
+
+def get_recording_model(path, responses):
+    # Importing the workflow installs the process-wide LLM cache, the fake model skips it
+    return CassetteChatModel(provider="groq", cassette=get_cassette(path, "record"),
+                             model=FakeListChatModel(responses=responses, cache=False), cache=False)
+
+
+def test_llm_round_trip(tmp_path):
+    path = tmp_path / "cassettes" / "workflow.jsonl"
+    recording = get_recording_model(path, ["Query_Data", "Visualize_Data"])
+    assert recording.invoke("Route: sales in Denver").content == "Query_Data"
+    assert asyncio.run(recording.ainvoke("Route: plot the sales")).content == "Visualize_Data"
+
+    cassette = get_cassette(path, "replay")
+    replaying = CassetteChatModel(provider="groq", cassette=cassette, cache=False)
+    assert asyncio.run(replaying.ainvoke("Route: plot the sales")).content == "Visualize_Data"
+    assert replaying.invoke("Route: sales in Denver").content == "Query_Data"
+    assert cassette.stats()["entries"] == 2 and cassette.stats()["replayed"] == 2
+
+
+def test_replay_fails_on_a_missing_entry(tmp_path):
+    path = tmp_path / "workflow.jsonl"
+    recording = get_recording_model(path, ["Query_Data"])
+    recording.invoke("Route: sales in Denver")
+
+    cassette = get_cassette(path, "replay")
+    with pytest.raises(CassetteMissError):
+        CassetteChatModel(provider="groq", cassette=cassette, cache=False).invoke("Route: sales in Seattle")
+    # Another provider is another request
+    with pytest.raises(CassetteMissError):
+        CassetteChatModel(provider="gemini", cassette=cassette, cache=False).invoke("Route: sales in Denver")
+    assert cassette.stats()["misses"] == 2
+
+
+def test_identical_requests_replay_in_the_recorded_order(tmp_path):
+    path = tmp_path / "workflow.jsonl"
+    recording = get_recording_model(path, ["first", "second"])
+    assert [recording.invoke("Summarize").content for _ in range(2)] == ["first", "second"]
+    replaying = CassetteChatModel(provider="groq", cassette=get_cassette(path, "replay"), cache=False)
+    assert [replaying.invoke("Summarize").content for _ in range(3)] == ["first", "second", "first"]
+
+
+def test_mongo_round_trip(tmp_path):
+    path = tmp_path / "workflow.jsonl"
+    database = mongomock.MongoClient()["sample_supplies"]
+    database["sales"].insert_many([{"storeLocation": "Denver"}, {"storeLocation": "Seattle"}])
+    pipeline = [{"$match": {"storeLocation": "Denver"}}, {"$project": {"_id": 0}}]
+    recording = CassetteDatabase(database, get_cassette(path, "record"))
+    assert list(recording["sales"].aggregate(pipeline)) == [{"storeLocation": "Denver"}]
+    assert recording["sales"].estimated_document_count() == 2
+
+    # Replay needs no documents in the database
+    replaying = CassetteDatabase(mongomock.MongoClient()["sample_supplies"], get_cassette(path, "replay"))
+    assert list(replaying["sales"].aggregate(pipeline)) == [{"storeLocation": "Denver"}]
+    assert replaying["sales"].estimated_document_count() == 2
+    with pytest.raises(CassetteMissError):
+        replaying["sales"].aggregate([{"$match": {"storeLocation": "Seattle"}}])
+
+
+def test_replay_without_a_recording_fails(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        get_cassette(tmp_path / "missing.jsonl", "replay")
+    with pytest.raises(ValueError):
+        get_cassette(tmp_path / "workflow.jsonl", "strict")
@@ -0,0 +1,118 @@
+import asyncio
+import operator
+import time
+from typing import Annotated, TypedDict
+
+import aiosqlite
+from langgraph.graph import END, START, StateGraph
+
+from quality_agent.checkpointer import BoundedMemorySaver, _get_async_sqlite_saver_class
+
+
+class State(TypedDict):
+    messages: Annotated[list, operator.add]
+
+
+def answer(state):
+    return {"messages": [f"answer {len(state['messages'])}"]}
+
+
+def compile_graph(checkpointer):
+    builder = StateGraph(State)
+    builder.add_node("answer", answer)
+    builder.add_edge(START, "answer")
+    builder.add_edge("answer", END)
+    return builder.compile(checkpointer=checkpointer)
+
+
+def config(thread_id):
+    return {"configurable": {"thread_id": thread_id}}
+
+
+def test_memory_ttl_expiry():
+    saver = BoundedMemorySaver(ttl_seconds=0.05)
+    graph = compile_graph(saver)
+    graph.invoke({"messages": ["question"]}, config("old"))
+    time.sleep(0.1)
+    graph.invoke({"messages": ["question"]}, config("new"))
+    assert set(saver.storage) == {"new"}
+    assert not any(key[0] == "old" for key in saver.writes)
+    assert not any(key[0] == "old" for key in saver.blobs)
+
+
+def test_memory_lru_thread_cap():
+    saver = BoundedMemorySaver(max_threads=2)
+    graph = compile_graph(saver)
+    for thread_id in ("a", "b", "c"):
+        graph.invoke({"messages": ["question"]}, config(thread_id))
+    assert set(saver.storage) == {"b", "c"}
+    # Reading a conversation makes it the most recently used
+    graph.get_state(config("b"))
+    graph.invoke({"messages": ["question"]}, config("d"))
+    assert set(saver.storage) == {"b", "d"}
+
+
+def test_memory_trims_checkpoints_writes_and_blobs():
+    saver = BoundedMemorySaver(max_checkpoints_per_thread=3)
+    graph = compile_graph(saver)
+    for _ in range(4):
+        graph.invoke({"messages": ["question"]}, config("thread"))
+    checkpoints = saver.storage["thread"][""]
+    assert len(checkpoints) == 3
+    written = {key[2] for key in saver.writes if key[0] == "thread"}
+    assert written and written <= set(checkpoints)
+    referenced = set()
+    for saved_checkpoint, _, _ in checkpoints.values():
+        referenced.update(saver.serde.loads_typed(saved_checkpoint)["channel_versions"].items())
+    assert {(key[2], key[3]) for key in saver.blobs if key[0] == "thread"} == referenced
+    # The retained checkpoints still resume the whole conversation
+    assert len(graph.get_state(config("thread")).values["messages"]) == 8
+
+
+def get_rows(connection, query):
+    async def fetch():
+        async with connection.execute(query) as cursor:
+            return await cursor.fetchall()
+    return fetch()
+
+
+def run_sqlite(tmp_path, scenario, **kwargs):
+    async def main():
+        saver = _get_async_sqlite_saver_class()(aiosqlite.connect(str(tmp_path / "checkpoints.sqlite")),
+                                                eviction_interval=1, **kwargs)
+        try:
+            return await scenario(saver, compile_graph(saver))
+        finally:
+            await saver.conn.close()
+    return asyncio.run(main())
+
+
+def test_sqlite_lru_thread_cap_and_trimming(tmp_path):
+    async def scenario(saver, graph):
+        for thread_id in ("a", "b", "c", "c"):
+            await graph.ainvoke({"messages": ["question"]}, config(thread_id))
+        counts = dict(await get_rows(saver.conn, "SELECT thread_id, COUNT(*) FROM checkpoints GROUP BY thread_id"))
+        accessed = {row[0] for row in await get_rows(saver.conn, "SELECT thread_id FROM thread_access")}
+        checkpoint_ids = {row[0] for row in await get_rows(saver.conn, "SELECT checkpoint_id FROM checkpoints")}
+        write_rows = await get_rows(saver.conn, "SELECT thread_id, checkpoint_id FROM writes")
+        state = await graph.aget_state(config("c"))
+        return counts, accessed, checkpoint_ids, write_rows, state
+
+    counts, accessed, checkpoint_ids, write_rows, state = run_sqlite(
+        tmp_path, scenario, max_threads=2, max_checkpoints_per_thread=3)
+    assert counts == {"b": 3, "c": 3}
+    assert accessed == {"b", "c"}
+    # Writes of the evicted threads and of the trimmed checkpoints are deleted
+    assert write_rows and {checkpoint_id for _, checkpoint_id in write_rows} <= checkpoint_ids
+    assert len(state.values["messages"]) == 4
+
+
+def test_sqlite_ttl_expiry(tmp_path):
+    async def scenario(saver, graph):
+        await graph.ainvoke({"messages": ["question"]}, config("old"))
+        await asyncio.sleep(0.1)
+        await graph.ainvoke({"messages": ["question"]}, config("new"))
+        return [{row[0] for row in await get_rows(saver.conn, f"SELECT thread_id FROM {table}")}
+                for table in ("checkpoints", "writes", "thread_access")]
+
+    assert run_sqlite(tmp_path, scenario, ttl_seconds=0.05) == [{"new"}] * 3
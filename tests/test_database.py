@@ -0,0 +1,86 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import bson
+import pytest
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from prometheus_client import REGISTRY
+
+import quality_agent.database as database
+from quality_agent.database import PoolMetricsListener, codec_options
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    # Clients connect on the first operation, creating them needs no server
+    monkeypatch.setattr(database, "_clients", {})
+    monkeypatch.setattr(database, "MONGODB_CONNECTION_STRING", "mongodb://localhost:1")
+    monkeypatch.setattr(database, "MONGODB_SALES_DATABASE_NAME", "sample_supplies")
+    yield database._clients
+    asyncio.run(database.close_clients())
+
+
+def test_codec_round_trip():
+    sale_id = ObjectId()
+    document = {"_id": sale_id, "items": [{"name": "pens", "price": Decimal128("12.50"), "quantity": 3}]}
+    decoded = bson.decode(bson.encode(document), codec_options=codec_options)
+    assert decoded == {"_id": str(sale_id), "items": [{"name": "pens", "price": 12.5, "quantity": 3}]}
+
+
+def test_client_is_created_once_on_first_use(clients):
+    assert clients == {}
+    created = []
+    threads = [threading.Thread(target=lambda: created.append(database.get_client())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(client) for client in created}) == 1 and list(clients) == ["sync"]
+
+
+def test_databases_share_the_client_and_codec_options(clients):
+    sales_db = database.get_sales_db()
+    assert sales_db.name == "sample_supplies" and sales_db.client is database.get_client()
+    assert sales_db["sales"].codec_options == codec_options
+
+
+def test_client_options(clients, monkeypatch):
+    monkeypatch.setattr(database, "MONGODB_MAX_POOL_SIZE", 7)
+    monkeypatch.setattr(database, "METRICS_ENABLED", True)
+    options = database.get_client().options
+    assert options.pool_options.max_pool_size == 7
+    assert [type(listener) for listener in options.event_listeners] == [PoolMetricsListener]
+
+
+def test_async_client_is_shared(clients):
+    async def main():
+        client = database.get_async_client()
+        assert database.get_async_client() is client
+        sales_db = database.get_async_sales_db()
+        assert sales_db.client is client and sales_db.codec_options == codec_options
+
+    asyncio.run(main())
+    assert list(clients) == ["async"]
+
+
+def get_sample(name, labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_pool_listener_records_the_pool_usage():
+    listener = PoolMetricsListener("test")
+    waits = get_sample("querygenai_mongo_pool_wait_seconds_count", {"client": "test", "status": "success"})
+    timeouts = get_sample("querygenai_mongo_pool_wait_seconds_count", {"client": "test", "status": "timeout"})
+    listener.connection_created(SimpleNamespace())
+    listener.connection_checked_out(SimpleNamespace(duration=0.01))
+    assert get_sample("querygenai_mongo_pool_checked_out", {"client": "test"}) == 1
+    assert get_sample("querygenai_mongo_pool_connections", {"client": "test"}) == 1
+    listener.connection_checked_in(SimpleNamespace())
+    listener.connection_check_out_failed(SimpleNamespace(duration=0.5, reason="timeout"))
+    listener.connection_closed(SimpleNamespace())
+    assert get_sample("querygenai_mongo_pool_checked_out", {"client": "test"}) == 0
+    assert get_sample("querygenai_mongo_pool_connections", {"client": "test"}) == 0
+    assert get_sample("querygenai_mongo_pool_wait_seconds_count", {"client": "test", "status": "success"}) == waits + 1
+    assert get_sample("querygenai_mongo_pool_wait_seconds_count", {"client": "test", "status": "timeout"}) == timeouts + 1
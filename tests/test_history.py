@@ -0,0 +1,90 @@
+import threading
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from quality_agent.history import HistoryManager, HISTORY_SUMMARY_MAX_TOKENS, count_message_tokens
+
+# 10 tokens of text plus the per-message overhead
+MESSAGE_TOKENS = 14
+# Room for the summary and five messages
+BUDGET = HISTORY_SUMMARY_MAX_TOKENS + 5 * MESSAGE_TOKENS
+
+
+def get_messages(count):
+    return [(HumanMessage if index % 2 == 0 else AIMessage)(f"message {index:02d} " + "x" * 29)
+            for index in range(count)]
+
+
+class GatedSummarizer:
+    """Summarizes once `gate` is set, recording the prefixes it was asked for."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.calls = []
+
+    def __call__(self, previous_summary, messages):
+        self.gate.wait(timeout=5)
+        self.calls.append((previous_summary, len(messages)))
+        return f"summary of {len(messages)} after [{previous_summary}]"
+
+
+def get_manager(summarize=True):
+    summarizer = GatedSummarizer()
+    manager = HistoryManager(budgets={"node": (BUDGET, summarize)}, summarizer=summarizer, block=6)
+    return manager, summarizer
+
+
+def test_within_budget_unchanged():
+    manager, summarizer = get_manager()
+    messages = get_messages(4)
+    assert manager.get_view(messages, "node") == messages
+    assert not summarizer.calls
+
+
+def test_without_summary_keeps_the_budget_window():
+    manager, summarizer = get_manager()
+    messages = get_messages(32)
+    assert count_message_tokens(messages[0]) == MESSAGE_TOKENS
+    # The summary of messages[:30] is still being computed
+    assert manager.get_view(messages, "node") == messages[27:]
+    summarizer.gate.set()
+
+
+def test_summary_precedes_the_block_window():
+    manager, summarizer = get_manager()
+    messages = get_messages(32)
+    manager.get_view(messages, "node")
+    summarizer.gate.set()
+    manager.wait_for_summaries(timeout=5)
+    view = manager.get_view(messages, "node")
+    assert isinstance(view[0], SystemMessage) and "summary of 30" in view[0].content
+    assert view[1:] == messages[30:]
+    assert summarizer.calls == [("", 30)]
+
+
+def test_fallback_summary_keeps_the_messages_after_it():
+    manager, summarizer = get_manager()
+    messages = get_messages(38)
+    summarizer.gate.set()
+    manager.get_view(messages[:32], "node")
+    manager.wait_for_summaries(timeout=5)
+    summarizer.gate.clear()
+
+    # The summary of messages[:36] is pending, the one of messages[:30] is used
+    view = manager.get_view(messages, "node")
+    assert "summary of 30" in view[0].content
+    assert view[1:] == messages[33:]
+    assert sum(count_message_tokens(message) for message in view[1:]) <= BUDGET - HISTORY_SUMMARY_MAX_TOKENS
+
+    summarizer.gate.set()
+    manager.wait_for_summaries(timeout=5)
+    # The new summary extends the previous one with the messages after it
+    assert summarizer.calls[-1] == ("summary of 30 after []", 6)
+
+
+def test_without_summarization_keeps_the_budget_window():
+    manager, summarizer = get_manager(summarize=False)
+    messages = get_messages(30)
+    view = manager.get_view(messages, "node")
+    assert view == messages[-(BUDGET // MESSAGE_TOKENS):]
+    assert not summarizer.calls
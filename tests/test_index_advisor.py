@@ -0,0 +1,46 @@
+import mongomock
+
+from quality_agent.index_advisor import IndexAdvisor, get_candidate_index, get_pipeline_keys
+
+DENVER_ONLINE = [{"$match": {"storeLocation": "Denver", "purchaseMethod": "Online"}}, {"$sort": {"saleDate": -1}}]
+
+
+def get_advisor():
+    client = mongomock.MongoClient()
+    sales = client["sales_db"]["sales"]
+    sales.insert_one({"storeLocation": "Denver"})
+    return IndexAdvisor(min_occurrences=2, client=client), sales
+
+
+def test_candidate_index_in_equality_sort_range_order():
+    pipeline = [{"$match": {"storeLocation": "Denver", "customer.age": {"$lt": 25}}}, {"$sort": {"saleDate": -1}},
+                {"$group": {"_id": "$purchaseMethod"}}]
+    equality, sort, ranges, group = get_pipeline_keys(pipeline)
+    assert group == ["purchaseMethod"]
+    assert get_candidate_index(equality, sort, ranges) == (("storeLocation", 1), ("saleDate", -1), ("customer.age", 1))
+
+
+def test_special_index_types_are_kept():
+    advisor, sales = get_advisor()
+    sales.create_index([("items.name", "text")])
+    sales.create_index([("storeLocation", "hashed")])
+    sales.create_index([("location", "2dsphere")])
+    sales.create_index([("storeLocation", 1), ("saleDate", -1)])
+    assert set(advisor.get_existing_indexes(sales.full_name)) == {
+        (("_id", 1),), (("items.name", "text"),), (("location", "2dsphere"),),
+        (("storeLocation", 1), ("saleDate", -1)), (("storeLocation", "hashed"),)}
+
+
+def test_special_index_does_not_serve_the_recommendation():
+    advisor, sales = get_advisor()
+    sales.create_index([("purchaseMethod", "hashed")])
+    sales.create_index([("storeLocation", "text")])
+    sales.create_index([("customer.age", 1)])
+    for _ in range(2):
+        advisor.record(sales.full_name, DENVER_ONLINE, 0.01)
+        # Served by the existing index on customer.age
+        advisor.record(sales.full_name, [{"$match": {"customer.age": {"$lt": 25}}}], 0.01)
+    keys = (("purchaseMethod", 1), ("storeLocation", 1), ("saleDate", -1))
+    assert [stats.keys for stats in advisor.recommend(sales.full_name)] == [keys]
+    assert advisor.create_recommended(sales.full_name) == ["advisor_purchaseMethod_1_storeLocation_1_saleDate_-1"]
+    assert advisor.recommend(sales.full_name) == []
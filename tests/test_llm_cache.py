@@ -0,0 +1,111 @@
+import time
+
+import pytest
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.outputs import Generation
+
+import quality_agent.llm_cache as llm_cache_module
+from quality_agent.llm_cache import LLMResponseCache, get_cache_key, get_prompt_type
+
+ROUTER_PROMPT = "You are an AI router agent responsible for classifying the question: how many sales in Denver"
+PIPELINE_PROMPT = "You are converting into nosql mongodb aggregation pipeline the question: sales in Denver"
+
+
+def get_model(cache, responses=("first", "second"), **kwargs):
+    # The cache is passed to the model, not installed process-wide with set_llm_cache
+    return FakeListChatModel(responses=list(responses), cache=cache, **kwargs)
+
+
+def test_same_prompt_and_model_hits():
+    cache = LLMResponseCache()
+    model = get_model(cache)
+    assert model.invoke(ROUTER_PROMPT).content == "first"
+    assert model.invoke(ROUTER_PROMPT).content == "first"
+    assert model.invoke(PIPELINE_PROMPT).content == "second"
+    assert cache.stats()["hits"] == {"router": 1}
+    assert cache.stats()["misses"] == {"router": 1, "sales_pipeline": 1}
+
+
+def test_other_model_settings_miss():
+    cache = LLMResponseCache()
+    assert get_model(cache).invoke(ROUTER_PROMPT).content == "first"
+    assert get_model(cache).invoke(ROUTER_PROMPT).content == "first"
+    assert get_model(cache, responses=["other"]).invoke(ROUTER_PROMPT).content == "other"
+    assert cache.stats()["hits"] == {"router": 1} and cache.stats()["misses"] == {"router": 2}
+    assert get_cache_key(ROUTER_PROMPT, "model a") != get_cache_key(ROUTER_PROMPT, "model b")
+
+
+def test_prompt_types():
+    assert get_prompt_type(ROUTER_PROMPT) == "router"
+    assert get_prompt_type(PIPELINE_PROMPT) == "sales_pipeline"
+    assert get_prompt_type("Summarize the conversation") == "default"
+
+
+def test_entries_expire_after_the_ttl_of_their_prompt_type(monkeypatch):
+    monkeypatch.setitem(llm_cache_module.PROMPT_TYPE_TTLS, "router", 0.05)
+    cache = LLMResponseCache()
+    cache.update(ROUTER_PROMPT, "model", [Generation(text="Query_Data")])
+    cache.update(PIPELINE_PROMPT, "model", [Generation(text="[]")])
+    assert cache.lookup(ROUTER_PROMPT, "model")[0].text == "Query_Data"
+    time.sleep(0.1)
+    assert cache.lookup(ROUTER_PROMPT, "model") is None
+    assert cache.lookup(PIPELINE_PROMPT, "model")[0].text == "[]"
+    assert cache.stats()["memory_entries"] == 1
+
+
+def test_prompt_type_with_zero_ttl_is_not_cached(monkeypatch):
+    monkeypatch.setitem(llm_cache_module.PROMPT_TYPE_TTLS, "sales_pipeline", 0)
+    cache = LLMResponseCache()
+    model = get_model(cache)
+    assert [model.invoke(PIPELINE_PROMPT).content for _ in range(2)] == ["first", "second"]
+    assert cache.stats()["memory_entries"] == 0
+
+
+def test_memory_tier_is_byte_bounded():
+    size = len(llm_cache_module.dumps([Generation(text="x" * 100)]))
+    cache = LLMResponseCache(memory_max_bytes=2 * size)
+    for index in range(3):
+        cache.update(f"{ROUTER_PROMPT} {index}", "model", [Generation(text="x" * 100)])
+    assert cache.lookup(f"{ROUTER_PROMPT} 0", "model") is None
+    assert cache.lookup(f"{ROUTER_PROMPT} 2", "model") is not None
+    assert cache.stats()["memory_bytes"] == 2 * size
+    # Larger than the whole tier
+    cache.update(PIPELINE_PROMPT, "model", [Generation(text="x" * 1000)])
+    assert cache.lookup(PIPELINE_PROMPT, "model") is None
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    path = str(tmp_path / "cache" / "llm_cache.sqlite")
+    LLMResponseCache(path=path).update(ROUTER_PROMPT, "model", [Generation(text="Query_Data")])
+    restarted = LLMResponseCache(path=path)
+    assert restarted.lookup(ROUTER_PROMPT, "model")[0].text == "Query_Data"
+    assert restarted.stats()["disk_hits"] == {"router": 1}
+    # Served from memory afterwards
+    restarted.lookup(ROUTER_PROMPT, "model")
+    assert restarted.stats()["disk_hits"] == {"router": 1} and restarted.stats()["hits"] == {"router": 2}
+
+
+def test_disk_tier_drops_expired_entries(tmp_path, monkeypatch):
+    monkeypatch.setitem(llm_cache_module.PROMPT_TYPE_TTLS, "router", 0.05)
+    path = str(tmp_path / "llm_cache.sqlite")
+    LLMResponseCache(path=path).update(ROUTER_PROMPT, "model", [Generation(text="Query_Data")])
+    time.sleep(0.1)
+    restarted = LLMResponseCache(path=path)
+    assert restarted.lookup(ROUTER_PROMPT, "model") is None
+    assert restarted.stats()["disk_bytes"] == 0
+
+
+def test_disk_tier_evicts_the_least_recently_used(tmp_path):
+    size = len(llm_cache_module.dumps([Generation(text="x" * 100)]))
+    cache = LLMResponseCache(path=str(tmp_path / "llm_cache.sqlite"), disk_max_bytes=2 * size)
+    for index in range(3):
+        cache.update(f"{ROUTER_PROMPT} {index}", "model", [Generation(text="x" * 100)])
+    restarted = LLMResponseCache(path=str(tmp_path / "llm_cache.sqlite"), disk_max_bytes=2 * size)
+    assert restarted.lookup(f"{ROUTER_PROMPT} 0", "model") is None
+    assert restarted.lookup(f"{ROUTER_PROMPT} 2", "model") is not None
+    assert restarted.stats()["disk_bytes"] == 2 * size
+
+
+@pytest.mark.parametrize("path", ["", None])
+def test_disk_tier_is_opt_in(path):
+    assert LLMResponseCache(path=path).disk is None
@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.runnables import Runnable
+
+from quality_agent.llm_router import LLMRouter, ProviderHealth, LLM_HEDGE_MIN_SAMPLES
+
+
+class FakeProvider(Runnable):
+    """Answers its name after `delay` seconds, or raises when `fail` is set."""
+
+    def __init__(self, name, delay=0.0, fail=False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError(f"{self.name} is unavailable")
+        return self.name
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ConnectionError(f"{self.name} is unavailable")
+        return self.name
+
+
+def get_router(providers, hedge=False, latencies=None, **health_options):
+    health = {name: ProviderHealth(name, **health_options) for name in providers}
+    # Rolling latencies fix the provider order and enable the hedge delay
+    for name, seconds in (latencies or {}).items():
+        health[name].latencies.extend([seconds] * LLM_HEDGE_MIN_SAMPLES)
+    return LLMRouter(providers, health=health, hedge=hedge)
+
+
+def run(router, mode):
+    if mode == "async":
+        return asyncio.run(router.ainvoke("question"))
+    return router.invoke("question")
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_failover_in_order(mode):
+    providers = {"a": FakeProvider("a", fail=True), "b": FakeProvider("b", fail=True), "c": FakeProvider("c")}
+    router = get_router(providers)
+    assert run(router, mode) == "c"
+    assert [provider.calls for provider in providers.values()] == [1, 1, 1]
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_fastest_provider_first(mode):
+    providers = {"a": FakeProvider("a"), "b": FakeProvider("b")}
+    router = get_router(providers, latencies={"a": 0.5, "b": 0.1})
+    assert run(router, mode) == "b"
+    assert providers["a"].calls == 0
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_last_error_raised_when_all_fail(mode):
+    providers = {"a": FakeProvider("a", fail=True), "b": FakeProvider("b", fail=True)}
+    with pytest.raises(ConnectionError, match="b is unavailable"):
+        run(get_router(providers), mode)
+
+
+def test_circuit_opens_and_resets():
+    providers = {"a": FakeProvider("a", fail=True), "b": FakeProvider("b")}
+    router = get_router(providers, failure_threshold=2, reset_seconds=0.1)
+    for _ in range(2):
+        assert router.invoke("question") == "b"
+    assert router.health["a"].is_open()
+    assert router.get_ordered_providers() == ["b", "a"]
+
+    # Open circuits are tried last
+    assert router.invoke("question") == "b"
+    assert providers["a"].calls == 2
+
+    # After the reset period a single failed trial reopens the circuit
+    time.sleep(0.15)
+    assert not router.health["a"].is_open()
+    providers["b"].fail = True
+    with pytest.raises(ConnectionError):
+        router.invoke("question")
+    assert router.health["a"].is_open()
+
+    # A successful trial closes it
+    time.sleep(0.15)
+    providers["a"].fail = False
+    assert router.invoke("question") == "a"
+    assert not router.health["a"].is_open()
+    assert router.health["a"].consecutive_failures == 0
+
+
+def test_every_circuit_open_tries_closest_reset_first():
+    router = get_router({"a": FakeProvider("a"), "b": FakeProvider("b")})
+    router.health["a"].open_until = time.monotonic() + 10
+    router.health["b"].open_until = time.monotonic() + 5
+    assert router.get_ordered_providers() == ["b", "a"]
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_hedge_winner(mode):
+    providers = {"slow": FakeProvider("slow", delay=0.5), "fast": FakeProvider("fast")}
+    router = get_router(providers, hedge=True, latencies={"slow": 0.01, "fast": 0.02})
+    start = time.perf_counter()
+    assert run(router, mode) == "fast"
+    assert time.perf_counter() - start < 0.4
+    assert providers["slow"].calls == 1 and providers["fast"].calls == 1
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_first_request_wins_before_hedge_delay(mode):
+    providers = {"a": FakeProvider("a"), "b": FakeProvider("b")}
+    router = get_router(providers, hedge=True, latencies={"a": 0.2, "b": 0.3})
+    assert run(router, mode) == "a"
+    assert providers["b"].calls == 0
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_hedge_backup_not_retried(mode):
+    providers = {
+        "a": FakeProvider("a", delay=0.1, fail=True),
+        "b": FakeProvider("b", fail=True),
+        "c": FakeProvider("c"),
+    }
+    router = get_router(providers, hedge=True, latencies={"a": 0.01, "b": 0.02, "c": 0.03})
+    assert run(router, mode) == "c"
+    assert [provider.calls for provider in providers.values()] == [1, 1, 1]
@@ -0,0 +1,61 @@
+import importlib
+import json
+
+import mongomock
+import pytest
+
+from quality_agent.pipeline_guard import PipelineRejectedError
+
+
+class FakeChain:
+    def __init__(self, text):
+        self.text = text
+
+    def invoke(self, inputs):
+        return {"text": self.text}
+
+
+@pytest.fixture
+def retriever(monkeypatch):
+    # The retriever builds its LLM chains on import, no request is sent
+    monkeypatch.setenv("GROQ_API_KEY", "test")
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    module = importlib.import_module("quality_agent.mongo_data_retriever")
+    monkeypatch.setattr(module, "fetch_collections_llm_chain", FakeChain('["transactions"]'))
+    monkeypatch.setattr(module, "nosql_llm_chain", FakeChain(json.dumps(
+        {"base_collection": "transactions", "pipeline": [{"$match": {"transaction_count": 3}}]})))
+    monkeypatch.setattr(module, "get_app_db", lambda: mongomock.MongoClient()["analytics"])
+    return module
+
+
+def test_analytics_data_keeps_the_truncation(retriever, monkeypatch):
+    monkeypatch.setattr(retriever, "collect_pipeline_results", lambda collection, pipeline: {
+        "documents": [{"transaction_count": 3}], "truncated": True, "max_rows": 1, "partial": False})
+    assert retriever.get_analytics_data("accounts with three transactions") == {
+        "records": [{"transaction_count": 3}], "truncated": True, "row_limit": 1, "partial": False}
+
+
+def test_analytics_data_reports_a_rejected_pipeline(retriever, monkeypatch):
+    def reject(collection, pipeline):
+        raise PipelineRejectedError("Query rejected because the pipeline scans the whole transactions collection")
+
+    monkeypatch.setattr(retriever.pipeline_guard, "check", reject)
+    output = retriever.get_analytics_data("accounts with three transactions")
+    assert output["records"] == [] and "scans the whole transactions collection" in output["rejected"]
+    assert output["partial"] is False
+
+
+def test_rewritten_pipeline_result_is_partial_and_not_cached(retriever, monkeypatch):
+    def rewrite(collection, pipeline):
+        return [{"$sort": {"_id": -1}}, {"$limit": 2}] + pipeline, True
+
+    monkeypatch.setattr(retriever.pipeline_guard, "check", rewrite)
+    transactions = mongomock.MongoClient()["analytics"]["transactions"]
+    transactions.insert_many([{"transaction_count": 3} for _ in range(5)])
+    pipeline = [{"$match": {"transaction_count": 3}}, {"$project": {"_id": 0}}]
+    result = retriever.collect_pipeline_results(transactions, pipeline)
+    assert result == {"documents": [{"transaction_count": 3}] * 2, "truncated": False,
+                      "max_rows": retriever.MONGO_MAX_ROWS, "partial": True}
+    assert retriever.get_sales_tool_output(result)["partial"] is True
+    assert retriever.aggregation_cache.lookup(
+        retriever.aggregation_cache.get_key(transactions, pipeline, retriever.MONGO_MAX_ROWS)) is None
@@ -0,0 +1,96 @@
+from datetime import datetime
+
+import pytest
+
+import quality_agent.pipeline_cache as pipeline_cache_module
+from quality_agent.pipeline_cache import PipelineTemplateCache, extract_slots
+
+QUESTION = "How many online sales were made in Denver in 2015?"
+
+
+def year_pipeline(store, method, year):
+    return [
+        {"$match": {"storeLocation": store, "purchaseMethod": method,
+                    "saleDate": {"$gte": datetime(year, 1, 1), "$lt": datetime(year + 1, 1, 1)}}},
+        {"$count": "sales"},
+    ]
+
+
+def get_cache(question=QUESTION, pipeline=None):
+    cache = PipelineTemplateCache()
+    cache.store(question, pipeline if pipeline is not None else year_pipeline("Denver", "Online", 2015))
+    return cache
+
+
+def test_extract_slots():
+    assert extract_slots("Sales in new york by phone in 2016, top 5?") == (
+        "sales in {store} by {method} in {year}, top {number}",
+        [("store", "New York"), ("method", "Phone"), ("year", "2016"), ("number", "5")])
+
+
+def test_literals_are_substituted():
+    cache = get_cache()
+    assert cache.lookup("How many phone sales were made in Seattle in 2017?") == year_pipeline("Seattle", "Phone", 2017)
+    assert cache.stats()["hits"] == 1
+
+
+def test_number_is_substituted():
+    question = "Show the 5 largest sales in Austin"
+    cache = get_cache(question, [{"$match": {"storeLocation": "Austin"}}, {"$sort": {"saleDate": -1}},
+                                 {"$limit": 5}])
+    assert cache.lookup("Show the 12 largest sales in London") == [
+        {"$match": {"storeLocation": "London"}}, {"$sort": {"saleDate": -1}}, {"$limit": 12}]
+
+
+def test_filled_pipelines_are_copies():
+    cache = get_cache()
+    cache.lookup(QUESTION)[0]["$match"]["storeLocation"] = "changed"
+    assert cache.lookup(QUESTION) == year_pipeline("Denver", "Online", 2015)
+
+
+@pytest.mark.parametrize("question, pipeline", [
+    # The year is not in the pipeline
+    (QUESTION, [{"$match": {"storeLocation": "Denver", "purchaseMethod": "Online"}}, {"$count": "sales"}]),
+    # The number appears twice, its places cannot be told apart
+    ("Top 5 sales in Denver", [{"$match": {"storeLocation": "Denver", "items.quantity": 5}}, {"$limit": 5}]),
+    # The same literal twice in the question
+    ("Sales in Denver compared to Denver in 2015", year_pipeline("Denver", "Online", 2015)),
+    # Unknown field of the sales collection
+    ("Sales in Denver", [{"$match": {"storeLocation": "Denver", "store": "Denver"}}]),
+])
+def test_ambiguous_templates_are_rejected(question, pipeline):
+    cache = get_cache(question, pipeline)
+    assert cache.stats()["rejected"] == 1 and cache.stats()["entries"] == 0
+
+
+def test_relative_dates_are_not_cached():
+    cache = get_cache("How many online sales were made in Denver this year?",
+                      year_pipeline("Denver", "Online", 2015))
+    assert cache.stats()["entries"] == 0
+
+
+@pytest.mark.parametrize("question", [
+    # Other wording
+    "How many online sales were made in Denver during 2015?",
+    # Another literal kind in the same place
+    "How many online sales were made in Denver in 5?",
+    # Literal missing
+    "How many online sales were made in Denver?",
+])
+def test_other_question_shapes_miss(question):
+    cache = get_cache()
+    assert cache.lookup(question) is None
+
+
+def test_schema_change_misses(monkeypatch):
+    cache = get_cache()
+    monkeypatch.setattr(pipeline_cache_module, "SCHEMA_VERSION", "changed")
+    assert cache.lookup(QUESTION) is None
+
+
+def test_impossible_date_misses():
+    question = "Sales in Denver on leap day 2016"
+    cache = get_cache(question, [{"$match": {"storeLocation": "Denver", "saleDate": datetime(2016, 2, 29)}}])
+    assert cache.lookup("Sales in Denver on leap day 2017") is None
+    assert cache.lookup("Sales in Seattle on leap day 2020") == [
+        {"$match": {"storeLocation": "Seattle", "saleDate": datetime(2020, 2, 29)}}]
@@ -0,0 +1,207 @@
+import asyncio
+
+import mongomock
+import pytest
+
+from quality_agent.pipeline_guard import (
+    PipelineGuard, PipelineRejectedError, find_docs_examined, find_foreign_docs_examined, find_plan_stages,
+    get_foreign_reads,
+)
+from quality_agent.pipeline_parser import parse_pipeline
+
+# Stand-in explain outputs, shaped like the ones of MongoDB 7
+COLLSCAN_EXPLAIN = {"stages": [
+    {"$cursor": {"queryPlanner": {"winningPlan": {"stage": "PROJECTION_SIMPLE",
+                                                  "inputStage": {"stage": "COLLSCAN"}}}}},
+    {"$group": {"_id": "$storeLocation"}},
+]}
+IXSCAN_EXPLAIN = {"queryPlanner": {"winningPlan": {"queryPlan": {
+    "stage": "GROUP", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}}}}
+EXECUTION_STATS_EXPLAIN = {"shards": {
+    "a": {"stages": [{"$cursor": {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}},
+                                  "executionStats": {"totalDocsExamined": 700}}}]},
+    "b": {"stages": [{"$cursor": {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}},
+                                  "executionStats": {"totalDocsExamined": 500}}}]},
+}}
+LOOKUP_EXECUTION_STATS_EXPLAIN = {"stages": [
+    {"$cursor": {"queryPlanner": {"winningPlan": {"stage": "IXSCAN"}}, "executionStats": {"totalDocsExamined": 10}}},
+    {"$lookup": {"from": "customers", "as": "customer"}, "totalDocsExamined": 5000,
+     "totalKeysExamined": 0, "collectionScans": 10, "indexesUsed": []},
+]}
+
+JOIN = {"$lookup": {"from": "customers", "localField": "customer.email", "foreignField": "email", "as": "customer"}}
+
+
+def get_sales(customers=0, indexed=True):
+    database = mongomock.MongoClient()["sales_db"]
+    if customers:
+        database["customers"].insert_many([{"email": f"customer{index}@example.com"} for index in range(customers)])
+    if indexed:
+        database["customers"].create_index("email")
+    return database["sales"]
+
+
+def explain_with(collection, explain):
+    """Answers the explain command with a stand-in output, mongomock has none."""
+    collection.database.command = lambda command: explain
+    return collection
+
+
+def test_find_plan_stages():
+    assert set(find_plan_stages(COLLSCAN_EXPLAIN)) == {"PROJECTION_SIMPLE", "COLLSCAN"}
+    assert set(find_plan_stages(IXSCAN_EXPLAIN)) == {"GROUP", "FETCH", "IXSCAN"}
+
+
+def test_find_docs_examined():
+    assert find_docs_examined(COLLSCAN_EXPLAIN) is None
+    assert find_docs_examined(EXECUTION_STATS_EXPLAIN) == 1200
+    assert find_foreign_docs_examined(LOOKUP_EXECUTION_STATS_EXPLAIN) == 5000
+    assert find_foreign_docs_examined(EXECUTION_STATS_EXPLAIN) is None
+
+
+@pytest.mark.parametrize("action, decision", [("reject", "rejected"), ("rewrite", "rewritten"), ("log", "logged")])
+def test_collection_scan(action, decision):
+    guard = PipelineGuard(max_scan_docs=1000, action=action)
+    pipeline = [{"$group": {"_id": "$storeLocation"}}]
+    sales = get_sales()
+    if action == "reject":
+        with pytest.raises(PipelineRejectedError):
+            guard.decide(sales, pipeline, COLLSCAN_EXPLAIN, 5000)
+    else:
+        result = guard.decide(sales, pipeline, COLLSCAN_EXPLAIN, 5000)
+        assert result == ((pipeline, False) if action == "log"
+                          else ([{"$sort": {"_id": -1}}, {"$limit": 1000}] + pipeline, True))
+    assert guard.decisions == {decision: 1}
+
+
+def test_small_or_indexed_scans_allowed():
+    guard = PipelineGuard(max_scan_docs=1000)
+    pipeline = [{"$group": {"_id": "$storeLocation"}}]
+    assert guard.decide(get_sales(), pipeline, COLLSCAN_EXPLAIN, 800) == (pipeline, False)
+    assert guard.decide(get_sales(), pipeline, IXSCAN_EXPLAIN, 10 ** 6) == (pipeline, False)
+    # Measured documents examined take precedence over the collection size
+    assert PipelineGuard(max_scan_docs=2000).decide(get_sales(), pipeline, EXECUTION_STATS_EXPLAIN, 10 ** 6) == (pipeline, False)
+    with pytest.raises(PipelineRejectedError):
+        guard.decide(get_sales(), pipeline, EXECUTION_STATS_EXPLAIN, 500)
+    assert guard.decisions == {"allowed": 2, "rejected": 1}
+
+
+def test_get_foreign_reads():
+    pipeline = [
+        JOIN,
+        {"$graphLookup": {"from": "stores", "startWith": "$storeLocation", "connectFromField": "parent",
+                          "connectToField": "name", "as": "hierarchy"}},
+        {"$unionWith": "archive"},
+        {"$facet": {"recent": [{"$lookup": {"from": "items", "let": {"name": "$items.name"}, "as": "item",
+                                            "pipeline": [{"$match": {"$expr": {"$eq": ["$name", "$$name"]}}}]}}]}},
+        {"$lookup": {"from": "stores", "as": "stores", "pipeline": [{"$match": {"open": True}}]}},
+    ]
+    reads = [(read["position"], read["stage"], read["collection"], read["fields"], read["per_document"])
+             for read in get_foreign_reads(pipeline)]
+    assert reads == [
+        (0, "$lookup", "customers", ("email",), True),
+        (1, "$graphLookup", "stores", ("name",), True),
+        (2, "$unionWith", "archive", (), False),
+        (None, "$lookup", "items", ("name",), True),
+        (4, "$lookup", "stores", ("open",), False),
+    ]
+
+
+def test_join_on_indexed_field_allowed():
+    guard = PipelineGuard(max_scan_docs=1000, max_lookup_scan_docs=10)
+    sales = explain_with(get_sales(customers=50, indexed=True), IXSCAN_EXPLAIN)
+    pipeline = [{"$match": {"storeLocation": "Denver"}}, JOIN]
+    assert guard.check(sales, pipeline) == (pipeline, False)
+    assert guard.decisions == {"allowed": 1}
+
+
+def test_join_of_small_collection_allowed():
+    guard = PipelineGuard(max_scan_docs=1000, max_lookup_scan_docs=100)
+    sales = explain_with(get_sales(customers=50, indexed=False), IXSCAN_EXPLAIN)
+    assert guard.check(sales, [JOIN]) == ([JOIN], False)
+
+
+def test_join_on_unindexed_field_rejected():
+    guard = PipelineGuard(max_scan_docs=1000, max_lookup_scan_docs=10)
+    sales = explain_with(get_sales(customers=50, indexed=False), IXSCAN_EXPLAIN)
+    with pytest.raises(PipelineRejectedError, match="no index on email"):
+        guard.check(sales, [{"$match": {"storeLocation": "Denver"}}, JOIN])
+    assert guard.decisions == {"rejected": 1}
+
+
+def test_join_on_unindexed_field_capped():
+    guard = PipelineGuard(max_scan_docs=1000, max_lookup_scan_docs=10, action="rewrite")
+    sales = explain_with(get_sales(customers=50, indexed=False), IXSCAN_EXPLAIN)
+    pipeline = [{"$match": {"storeLocation": "Denver"}}, JOIN, {"$limit": 101}]
+    # 50 foreign documents per input document, at most 1000 read in total
+    assert guard.check(sales, pipeline) == ([pipeline[0], {"$limit": 20}, JOIN, {"$limit": 101}], True)
+    assert guard.decisions == {"rewritten": 1}
+
+
+def test_nested_join_cannot_be_capped():
+    guard = PipelineGuard(max_scan_docs=1000, max_lookup_scan_docs=10, action="rewrite")
+    sales = explain_with(get_sales(customers=50, indexed=False), IXSCAN_EXPLAIN)
+    with pytest.raises(PipelineRejectedError):
+        guard.check(sales, [{"$facet": {"joined": [JOIN]}}])
+
+
+def test_union_of_large_collection_capped():
+    guard = PipelineGuard(max_scan_docs=20, action="rewrite")
+    sales = explain_with(get_sales(customers=50, indexed=False), IXSCAN_EXPLAIN)
+    pipeline = [{"$unionWith": "customers"}]
+    assert guard.check(sales, pipeline) == (
+        [{"$unionWith": {"coll": "customers", "pipeline": [{"$sort": {"_id": -1}}, {"$limit": 20}]}}], True)
+
+
+def test_generated_graph_lookup_is_guarded():
+    # The parser lets the stage through, the guard bounds its reads
+    pipeline = parse_pipeline(
+        '[{"$graphLookup": {"from": "customers", "startWith": "$customer.email", '
+        '"connectFromField": "referrer", "connectToField": "referrer", "as": "referrals"}}]')
+    sales = explain_with(get_sales(customers=50, indexed=True), IXSCAN_EXPLAIN)
+    with pytest.raises(PipelineRejectedError, match=r"\$graphLookup scans the customers collection"):
+        PipelineGuard(max_scan_docs=1000, max_lookup_scan_docs=10).check(sales, pipeline)
+    rewritten, partial = PipelineGuard(max_scan_docs=1000, max_lookup_scan_docs=10, action="rewrite").check(
+        sales, pipeline)
+    assert rewritten == [{"$limit": 20}] + pipeline and partial
+
+
+def test_measured_foreign_docs_examined():
+    guard = PipelineGuard(max_scan_docs=1000, max_lookup_scan_docs=10 ** 6)
+    sales = explain_with(get_sales(customers=50, indexed=False), LOOKUP_EXECUTION_STATS_EXPLAIN)
+    with pytest.raises(PipelineRejectedError):
+        guard.check(sales, [JOIN])
+
+
+def test_unexplainable_pipeline_runs_unchecked():
+    guard = PipelineGuard(max_scan_docs=10)
+    sales = get_sales(customers=50)
+    # mongomock does not implement the explain command
+    assert guard.check(sales, [JOIN]) == ([JOIN], False)
+    assert guard.decisions == {"unchecked": 1}
+
+
+def test_async_check():
+    class AsyncCollection:
+        def __init__(self, collection):
+            self.collection = collection
+            self.name = collection.name
+            self.full_name = collection.full_name
+            self.database = self
+
+        def __getitem__(self, name):
+            return AsyncCollection(self.collection.database[name])
+
+        async def command(self, command):
+            return IXSCAN_EXPLAIN
+
+        async def estimated_document_count(self):
+            return self.collection.estimated_document_count()
+
+        async def index_information(self):
+            return self.collection.index_information()
+
+    guard = PipelineGuard(max_scan_docs=1000, max_lookup_scan_docs=10)
+    sales = AsyncCollection(get_sales(customers=50, indexed=False))
+    with pytest.raises(PipelineRejectedError):
+        asyncio.run(guard.acheck(sales, [JOIN]))
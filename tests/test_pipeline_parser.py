@@ -0,0 +1,120 @@
+import json
+import random
+from datetime import datetime
+
+import pytest
+
+from prompts.inspectionPrompt import (
+    example_query1_output, example_query2_output, example_query3_output,
+    example_query4_output, sale_example_query_output1, sale_example_query_output2,
+)
+from quality_agent.pipeline_parser import parse_document, parse_pipeline, PipelineParseError
+
+SAMPLES = [
+    sale_example_query_output1,
+    sale_example_query_output2,
+    example_query1_output,
+    example_query2_output,
+    example_query3_output,
+    example_query4_output,
+    '```json\n[{"$match": {"saleDate": {"$gte": ISODate("2017-01-01T00:00:00Z"), '
+    '"$lt": ISODate("2018-01-01T00:00:00Z")}, "couponUsed": true}}, '
+    '{"$group": {"_id": "$storeLocation", "total": {"$sum": 1}}}]\n```',
+]
+
+MUTATION_CHARACTERS = list('{}[]:,"\'$()/\\ 0123456789aeEtfnulTFNIS.-\n')
+
+
+def mutate(text, rng):
+    characters = list(text)
+    for _ in range(rng.randint(1, 4)):
+        operation = rng.random()
+        position = rng.randrange(len(characters) + 1)
+        if operation < 0.4 and characters:
+            del characters[min(position, len(characters) - 1)]
+        elif operation < 0.8:
+            characters.insert(position, rng.choice(MUTATION_CHARACTERS))
+        elif position < len(characters):
+            characters[position] = rng.choice(MUTATION_CHARACTERS)
+    return "".join(characters)
+
+
+@pytest.mark.parametrize("sample", SAMPLES)
+def test_prompt_examples_parse(sample):
+    pipeline = parse_pipeline(sample)
+    assert isinstance(pipeline, list) and pipeline
+
+
+def test_isodate_becomes_datetime():
+    pipeline = parse_pipeline(SAMPLES[-1])
+    assert pipeline[0]["$match"]["saleDate"] == {"$gte": datetime(2017, 1, 1), "$lt": datetime(2018, 1, 1)}
+
+
+@pytest.mark.parametrize("text", [
+    '[{"$match": {"note": "ISODate(\\"2017-01-01T00:00:00Z\\")"}}]',
+    '[{"$match": {"note": "see ISODate(\\"2017-01-01\\") here", "saleDate": ISODate("2017-01-01T00:00:00Z")}}]',
+    "[{$match: {note: 'ISODate(\"2017-01-01\")'}}]",
+])
+def test_isodate_inside_string_stays_string(text):
+    match = parse_pipeline(text)[0]["$match"]
+    assert isinstance(match["note"], str) and "ISODate(" in match["note"]
+    if "saleDate" in match:
+        assert match["saleDate"] == datetime(2017, 1, 1)
+
+
+def test_shell_syntax():
+    document = parse_document("db.sales.aggregate([{$match: {couponUsed: true, age: null,}}, // comment\n])")
+    assert document == [{"$match": {"couponUsed": True, "age": None}}]
+
+
+@pytest.mark.parametrize("text", [
+    '[{"$unionWith": "archive"}]',
+    '[{"$unionWith": {"coll": "archive", "pipeline": [{"$match": {"storeLocation": "Denver"}}]}}]',
+    '[{"$graphLookup": {"from": "stores", "startWith": "$storeLocation", "connectFromField": "parent", '
+    '"connectToField": "name", "as": "hierarchy", "restrictSearchWithMatch": {"open": true}}}]',
+])
+def test_foreign_reads_allowed(text):
+    """The pipeline guard bounds the collections these stages read."""
+    assert parse_pipeline(text) == json.loads(text)
+
+
+@pytest.mark.parametrize("text", [
+    '[{"$out": "sales_copy"}]',
+    '[{"$merge": {"into": "sales_copy"}}]',
+    '[{"$match": {"$where": "this.items.length > 3"}}]',
+    '[{"$project": {"x": {"$function": {"body": "function() { return 1 }", "args": [], "lang": "js"}}}}]',
+    '[{"$group": {"_id": null, "x": {"$accumulator": {"init": "function() {}"}}}}]',
+    '[{"$facet": {"copy": [{"$out": "sales_copy"}]}}]',
+    '[{"$lookup": {"from": "items", "as": "x", "pipeline": [{"$merge": {"into": "items_copy"}}]}}]',
+    '[{"$unionWith": {"coll": "archive", "pipeline": [{"$out": "archive_copy"}]}}]',
+    '[{"$graphLookup": {"from": "stores", "startWith": "$storeLocation", "connectFromField": "parent", '
+    '"connectToField": "name", "as": "x", "restrictSearchWithMatch": {"$where": "true"}}}]',
+])
+def test_disallowed_stages_and_operators(text):
+    with pytest.raises(PipelineParseError):
+        parse_pipeline(text)
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "not a pipeline",
+    '{"$match": {}}',
+    '[{"$match": {}, "$limit": 1}]',
+    '[{"$match": {"x": NaN}}]',
+    '[{"$match": {"x": 1}}',
+])
+def test_malformed_input(text):
+    with pytest.raises(PipelineParseError):
+        parse_pipeline(text)
+
+
+def test_fuzz_only_raises_parse_error():
+    """Mutated prompt examples either parse deterministically or raise PipelineParseError."""
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = mutate(rng.choice(SAMPLES), rng)
+        try:
+            first = parse_pipeline(text)
+        except PipelineParseError:
+            continue
+        assert parse_pipeline(text) == first, text
@@ -0,0 +1,86 @@
+import asyncio
+import importlib
+import json
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+PLAN = {
+    "rephrased_question": "What is the number of sales per store location?",
+    "pipeline": [{"$group": {"_id": "$storeLocation", "sales": {"$sum": 1}}},
+                 {"$project": {"_id": 0, "storeLocation": "$_id", "sales": 1}}],
+    "chart": {"chart_type": "bar", "x": "storeLocation", "y": "sales", "title": "Sales per store"},
+}
+STATE = {"messages": [HumanMessage("Plot the sales per store")]}
+
+
+class FakeChain:
+    def __init__(self, content):
+        self.content = content
+        self.calls = 0
+
+    def invoke(self, inputs):
+        self.calls += 1
+        return AIMessage(self.content)
+
+    async def ainvoke(self, inputs):
+        return self.invoke(inputs)
+
+
+@pytest.fixture
+def plot_generator(monkeypatch):
+    # The plot generator builds its LLM chains on import, no request is sent
+    monkeypatch.setenv("GROQ_API_KEY", "test")
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+    module = importlib.import_module("quality_agent.plot_generator")
+    monkeypatch.setattr(module, "query_generation_chain", FakeChain("Number of sales per store location"))
+    return module
+
+
+def test_visualization_plan_is_parsed(plot_generator):
+    assert plot_generator.get_visualization_plan("```json\n" + json.dumps(PLAN) + "\n```") == {
+        "rephrasedQuestion": PLAN["rephrased_question"],
+        "visualizationPlan": {"pipeline": PLAN["pipeline"], "chart": {**PLAN["chart"], "color": None}},
+    }
+
+
+@pytest.mark.parametrize("content", [
+    # Not a document
+    "I cannot plan this chart",
+    # Unknown chart type
+    json.dumps({**PLAN, "chart": {**PLAN["chart"], "chart_type": "radar"}}),
+    # Stage the parser does not allow
+    json.dumps({**PLAN, "pipeline": [{"$out": "sales_copy"}]}),
+])
+def test_invalid_plan_falls_back_to_rephrasing(plot_generator, monkeypatch, content):
+    monkeypatch.setattr(plot_generator, "visualization_plan_chain", FakeChain(content))
+    expected = {"rephrasedQuestion": "Number of sales per store location", "visualizationPlan": None}
+    assert plot_generator.plan_visualization(STATE) == expected
+    assert asyncio.run(plot_generator.aplan_visualization(STATE)) == expected
+    assert plot_generator.query_generation_chain.calls == 2
+
+
+def test_valid_plan_skips_rephrasing(plot_generator, monkeypatch):
+    monkeypatch.setattr(plot_generator, "visualization_plan_chain", FakeChain(json.dumps(PLAN)))
+    update = asyncio.run(plot_generator.aplan_visualization(STATE))
+    assert update["visualizationPlan"]["pipeline"] == PLAN["pipeline"]
+    assert plot_generator.query_generation_chain.calls == 0
+
+
+def test_planned_chart_is_drawn(plot_generator):
+    rows = [{"storeLocation": "Denver", "sales": 3}, {"storeLocation": "Seattle", "sales": 5}]
+    update = plot_generator.render_planned_chart(PLAN["chart"], rows)
+    assert json.loads(update["chart"])["data"][0]["type"] == "bar"
+    # Field missing from the data, the plotting code is generated instead
+    assert plot_generator.render_planned_chart({**PLAN["chart"], "y": "amount"}, rows) is None
+
+
+def test_no_data_skips_code_generation(plot_generator, monkeypatch):
+    code_generation_chain = FakeChain("fig = None")
+    monkeypatch.setattr(plot_generator, "code_generation_chain", code_generation_chain)
+    state = {"mongoQueryResult": [], "rephrasedQuestion": "Sales per store", "visualizationPlan": None}
+    assert plot_generator.get_code_generation_inputs(state) is None
+    assert plot_generator.generate_chart_based_on_query(state)["chart"] is None
+    update = asyncio.run(plot_generator.agenerate_chart_based_on_query(state))
+    assert update["chart"] is None and update["answer"] == "No data was found for the requested plot."
+    assert code_generation_chain.calls == 0
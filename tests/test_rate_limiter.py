@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from quality_agent.rate_limiter import ProviderLimiter
+
+
+class ConcurrencyProbe:
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def exit(self):
+        with self._lock:
+            self.current -= 1
+
+
+def run_sync(limiter, probe, seconds):
+    limiter.acquire(1)
+    probe.enter()
+    time.sleep(seconds)
+    probe.exit()
+    limiter.release(1)
+
+
+async def run_async(limiter, probe, seconds):
+    await limiter.aacquire(1)
+    probe.enter()
+    await asyncio.sleep(seconds)
+    probe.exit()
+    limiter.arelease(1)
+
+
+def run_loop(limiter, probe, requests):
+    async def main():
+        await asyncio.gather(*(run_async(limiter, probe, 0.01) for _ in range(requests)))
+    asyncio.run(main())
+
+
+def test_bound_shared_by_threads_and_event_loops():
+    limiter = ProviderLimiter("test", max_concurrency=3)
+    probe = ConcurrencyProbe()
+    threads = [threading.Thread(target=run_sync, args=(limiter, probe, 0.01)) for _ in range(10)]
+    threads += [threading.Thread(target=run_loop, args=(limiter, probe, 10)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert probe.peak == 3
+    assert limiter.stats()["requests"] == 30
+    assert limiter.stats()["in_flight"] == 0
+    assert limiter._active == 0 and not limiter._waiters
+
+
+def test_cancelled_waiter_gives_back_its_slot():
+    limiter = ProviderLimiter("test", max_concurrency=1)
+
+    async def main():
+        await limiter.aacquire(1)
+        waiting = asyncio.ensure_future(limiter.aacquire(1))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        limiter.arelease(1)
+        await asyncio.wait_for(limiter.aacquire(1), timeout=1)
+        limiter.arelease(1)
+
+    asyncio.run(main())
+    assert limiter._active == 0 and not limiter._waiters
+    assert limiter.stats()["queue_depth"] == 0
+
+
+def test_waiter_cancelled_after_hand_over():
+    limiter = ProviderLimiter("test", max_concurrency=1)
+
+    async def main():
+        await limiter.aacquire(1)
+        waiting = asyncio.ensure_future(limiter.aacquire(1))
+        await asyncio.sleep(0.01)
+        # The slot is handed over, then the waiter is cancelled before it runs
+        limiter.arelease(1)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        await asyncio.wait_for(limiter.aacquire(1), timeout=1)
+        limiter.arelease(1)
+
+    asyncio.run(main())
+    assert limiter._active == 0 and not limiter._waiters
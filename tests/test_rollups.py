@@ -0,0 +1,188 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+import pytest
+from bson.decimal128 import Decimal128
+
+from quality_agent.rollups import (
+    ROLLUP_DAILY_COLLECTION, ROLLUP_TAGS_COLLECTION, RollupIneligibleError, get_rollup_updates, rewrite_pipeline,
+    translate_group, translate_match,
+)
+
+DAY_RANGE = {"$gte": datetime(2015, 3, 1), "$lt": datetime(2015, 6, 1)}
+
+
+def get_sales(count=200, seed=0):
+    generator = random.Random(seed)
+    sales = []
+    for index in range(count):
+        sale = {
+            "saleDate": datetime(2015, 1, 1) + timedelta(minutes=generator.randrange(365 * 24 * 60)),
+            "storeLocation": generator.choice(["Denver", "Seattle", "London"]),
+            "purchaseMethod": generator.choice(["Online", "Phone", "In store"]),
+            "customer": {"age": generator.randrange(16, 80), "satisfaction": generator.randrange(1, 6)},
+            "items": [{"name": generator.choice(["pens", "binder", "laptop"]),
+                       "price": generator.randrange(1, 400) / 4,
+                       "quantity": generator.randrange(1, 10),
+                       "tags": generator.sample(["office", "school", "general"], generator.randrange(0, 3))}
+                      for _ in range(generator.randrange(0, 4))],
+        }
+        # Missing values are left out of the sums and averages
+        if index % 17 == 0:
+            del sale["customer"]["age"]
+        if index % 23 == 0:
+            sale["items"].append({"name": "gift card", "quantity": 1, "tags": ["general"]})
+        sales.append(sale)
+    return sales
+
+
+def get_database(sales):
+    """Raw sales and rollups built by the incremental updates, in mongomock."""
+    database = mongomock.MongoClient()["sales_db"]
+    database["sales"].insert_many([dict(sale) for sale in sales])
+    for sale in sales:
+        for collection, operations in get_rollup_updates(sale).items():
+            # mongomock does not take UpdateOne in bulk_write
+            for operation in operations:
+                database[collection].update_one(operation._filter, operation._doc, upsert=operation._upsert)
+    return database
+
+
+def test_translate_match():
+    match = {"storeLocation": {"$in": ["Denver", "Seattle"]}, "purchaseMethod": "Online", "saleDate": DAY_RANGE}
+    assert translate_match(match, "sale") == {
+        "_id.storeLocation": {"$in": ["Denver", "Seattle"]}, "_id.purchaseMethod": "Online", "_id.day": DAY_RANGE}
+    assert translate_match({"$and": [{"items.tags": "office"}]}, "tag") == {"$and": [{"_id.tag": "office"}]}
+    aware = {"$gte": datetime(2015, 3, 1, tzinfo=timezone.utc)}
+    assert translate_match({"saleDate": aware}, "sale") == {"_id.day": aware}
+
+
+@pytest.mark.parametrize("match, grain", [
+    ({"saleDate": {"$gte": datetime(2015, 3, 1, 12)}}, "sale"),
+    ({"saleDate": {"$lte": datetime(2015, 3, 1)}}, "sale"),
+    ({"saleDate": datetime(2015, 3, 1)}, "sale"),
+    ({"storeLocation": {"$regex": "^Den"}}, "sale"),
+    ({"customer.age": {"$lt": 30}}, "sale"),
+    ({"items.tags": "office"}, "item"),
+])
+def test_translate_match_ineligible(match, grain):
+    with pytest.raises(RollupIneligibleError):
+        translate_match(match, grain)
+
+
+def test_translate_group_with_averages():
+    group = {"_id": {"store": "$storeLocation", "month": {"$month": "$saleDate"}},
+             "sales": {"$count": {}}, "doubled": {"$sum": 2}, "age": {"$avg": "$customer.age"}}
+    translated, projection = translate_group(group, "sale")
+    assert translated == {
+        "_id": {"store": "$_id.storeLocation", "month": {"$month": "$_id.day"}},
+        "sales": {"$sum": "$salesCount"},
+        "doubled": {"$sum": {"$multiply": ["$salesCount", 2]}},
+        "__ageSum": {"$sum": "$customerAgeSum"},
+        "__ageCount": {"$sum": "$customerAgeCount"},
+    }
+    assert projection == {"_id": 1, "sales": 1, "doubled": 1,
+                          "age": {"$cond": [{"$gt": ["$__ageCount", 0]}, {"$divide": ["$__ageSum", "$__ageCount"]}, None]}}
+
+
+def test_translate_group_without_averages():
+    group = {"_id": "$purchaseMethod", "revenue": {"$sum": {"$multiply": ["$items.quantity", "$items.price"]}}}
+    assert translate_group(group, "item") == ({"_id": "$_id.purchaseMethod", "revenue": {"$sum": "$itemRevenueSum"}},
+                                              None)
+
+
+def test_rewrite_pipeline():
+    pipeline = [{"$match": {"saleDate": DAY_RANGE}}, {"$unwind": "$items"}, {"$unwind": {"path": "$items.tags"}},
+                {"$match": {"items.tags": "office"}},
+                {"$group": {"_id": "$items.tags", "quantity": {"$sum": "$items.quantity"}}}, {"$sort": {"quantity": -1}}]
+    assert rewrite_pipeline(pipeline) == ("tag", ROLLUP_TAGS_COLLECTION, [
+        {"$match": {"$and": [{"_id.day": DAY_RANGE}, {"_id.tag": "office"}]}},
+        {"$group": {"_id": "$_id.tag", "quantity": {"$sum": "$itemQuantitySum"}}},
+        {"$sort": {"quantity": -1}},
+    ])
+
+
+def test_rewrite_item_grain_skips_sales_without_items():
+    pipeline = [{"$unwind": "$items"}, {"$group": {"_id": None, "items": {"$sum": 1}}}]
+    assert rewrite_pipeline(pipeline) == ("item", ROLLUP_DAILY_COLLECTION, [
+        {"$match": {"itemsCount": {"$gt": 0}}}, {"$group": {"_id": None, "items": {"$sum": "$itemsCount"}}}])
+
+
+def test_rewrite_count_stage():
+    pipeline = [{"$match": {"storeLocation": "Denver"}}, {"$count": "total"}]
+    assert rewrite_pipeline(pipeline) == ("sale", ROLLUP_DAILY_COLLECTION, [
+        {"$match": {"_id.storeLocation": "Denver"}},
+        {"$group": {"_id": None, "total": {"$sum": "$salesCount"}}},
+        {"$project": {"_id": 0, "total": 1}},
+    ])
+
+
+@pytest.mark.parametrize("pipeline", [
+    [{"$match": {"saleDate": {"$gte": datetime(2015, 3, 1, 8)}}}, {"$group": {"_id": None, "n": {"$sum": 1}}}],
+    [{"$project": {"storeLocation": 1}}, {"$group": {"_id": "$storeLocation", "n": {"$sum": 1}}}],
+    [{"$group": {"_id": "$saleDate", "n": {"$sum": 1}}}],
+    [{"$group": {"_id": {"$hour": "$saleDate"}, "n": {"$sum": 1}}}],
+    [{"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d %H", "date": "$saleDate"}}, "n": {"$sum": 1}}}],
+    [{"$group": {"_id": "$storeLocation", "oldest": {"$max": "$customer.age"}}}],
+    [{"$unwind": "$items"}, {"$group": {"_id": None, "age": {"$avg": "$customer.age"}}}],
+    [{"$unwind": "$items.tags"}, {"$group": {"_id": None, "n": {"$sum": 1}}}],
+    [{"$group": {"_id": None, "n": {"$sum": Decimal128("1")}}}],
+    [{"$match": {"storeLocation": "Denver"}}, {"$sort": {"saleDate": -1}}],
+])
+def test_rewrite_pipeline_ineligible(pipeline):
+    with pytest.raises(RollupIneligibleError):
+        rewrite_pipeline(pipeline)
+
+
+def test_rollup_updates():
+    sale = {"saleDate": datetime(2015, 3, 1, 14, 30), "storeLocation": "Denver", "purchaseMethod": "Online",
+            "customer": {"age": 40},
+            "items": [{"price": 2.5, "quantity": 4, "tags": ["office", "school"]},
+                      {"price": "n/a", "quantity": 1, "tags": []}]}
+    operations = get_rollup_updates(sale)
+    [daily] = operations[ROLLUP_DAILY_COLLECTION]
+    key = {"day": datetime(2015, 3, 1), "storeLocation": "Denver", "purchaseMethod": "Online"}
+    assert daily._filter == {"_id": key} and daily._upsert
+    assert daily._doc == {"$inc": {
+        "salesCount": 1, "customerAgeSum": 40, "customerAgeCount": 1,
+        "customerSatisfactionSum": 0, "customerSatisfactionCount": 0,
+        "itemsCount": 2, "itemQuantitySum": 5, "itemQuantityCount": 2, "itemPriceSum": 2.5, "itemPriceCount": 1,
+        "itemRevenueSum": 10.0, "itemRevenueCount": 1,
+    }}
+    tags = {operation._filter["_id"]["tag"]: operation._doc["$inc"] for operation in operations[ROLLUP_TAGS_COLLECTION]}
+    assert set(tags) == {"office", "school"}
+    assert tags["office"]["itemsCount"] == 1 and tags["office"]["itemRevenueSum"] == 10.0
+
+
+def test_rollup_updates_decimal128():
+    sale = {"saleDate": datetime(2015, 3, 1), "items": [{"price": Decimal128("1.10"), "quantity": 3},
+                                                        {"price": 0.25, "quantity": 2}]}
+    [daily] = get_rollup_updates(sale)[ROLLUP_DAILY_COLLECTION]
+    increments = daily._doc["$inc"]
+    assert increments["itemPriceSum"] == Decimal128("1.35")
+    assert increments["itemRevenueSum"] == Decimal128("3.80")
+    assert increments["itemQuantitySum"] == 5
+    # No storeLocation or purchaseMethod in the key, as in the raw groups
+    assert daily._filter == {"_id": {"day": datetime(2015, 3, 1)}}
+
+
+@pytest.mark.parametrize("pipeline", [
+    [{"$match": {"storeLocation": "Denver"}},
+     {"$group": {"_id": "$purchaseMethod", "sales": {"$sum": 1}, "age": {"$avg": "$customer.age"}}}],
+    [{"$match": {"saleDate": DAY_RANGE}}, {"$unwind": "$items"},
+     {"$group": {"_id": {"store": "$storeLocation"}, "quantity": {"$sum": "$items.quantity"},
+                 "revenue": {"$sum": {"$multiply": ["$items.price", "$items.quantity"]}},
+                 "price": {"$avg": "$items.price"}}}],
+    [{"$unwind": "$items"}, {"$unwind": "$items.tags"}, {"$match": {"items.tags": {"$in": ["office", "school"]}}},
+     {"$group": {"_id": {"tag": "$items.tags", "method": "$purchaseMethod"}, "items": {"$sum": 1}}}],
+    [{"$group": {"_id": {"$month": "$saleDate"}, "sales": {"$sum": 1}, "satisfaction": {"$avg": "$customer.satisfaction"}}}],
+    [{"$match": {"purchaseMethod": {"$ne": "Phone"}, "saleDate": {"$lt": datetime(2015, 7, 1)}}}, {"$count": "total"}],
+])
+def test_rewritten_pipeline_matches_raw_sales(pipeline):
+    database = get_database(get_sales())
+    _, collection, rewritten = rewrite_pipeline(pipeline)
+    order = [{"$sort": {"_id": 1}}]
+    raw = list(database["sales"].aggregate(pipeline + order))
+    assert raw
+    assert list(database[collection].aggregate(rewritten + order)) == raw
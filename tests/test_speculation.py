@@ -0,0 +1,83 @@
+import asyncio
+
+from quality_agent.speculation import SpeculationManager, current_speculation_id
+
+
+def answer(value, seconds=0.0):
+    async def run():
+        await asyncio.sleep(seconds)
+        return value
+    return run
+
+
+def test_same_stage_of_concurrent_requests_is_not_shared():
+    async def main():
+        manager = SpeculationManager()
+        first, second = manager.start("Query_Data"), manager.start("Query_Data")
+        manager.spawn(first, "pipeline:how many sales", answer("first", 0.01))
+        manager.spawn(second, "pipeline:how many sales", answer("second", 0.01))
+        assert manager.stats()["pending_stages"] == 2
+        assert await manager.take(second.id, "pipeline:how many sales") == "second"
+        assert await manager.take(first.id, "pipeline:how many sales") == "first"
+        assert await manager.take(first.id, "pipeline:how many sales") is None
+
+    asyncio.run(main())
+
+
+def test_take_without_speculation():
+    async def main():
+        manager = SpeculationManager()
+        speculation = manager.start("Visualization")
+        manager.spawn(speculation, "rephrase", answer("rephrased"))
+        assert await manager.take(None, "rephrase") is None
+        assert await manager.take(speculation.id, "rephrase") == "rephrased"
+
+    asyncio.run(main())
+
+
+def test_miss_cancels_only_its_own_stages():
+    async def main():
+        manager = SpeculationManager()
+        missed, kept = manager.start("Visualization"), manager.start("Visualization")
+        manager.spawn(missed, "rephrase", answer("missed", 1))
+        manager.spawn(kept, "rephrase", answer("kept", 0.01))
+        assert not manager.resolve(missed, "Query_Data")
+        assert manager.resolve(kept, "Visualization")
+        assert await manager.take(missed.id, "rephrase") is None
+        assert await manager.take(kept.id, "rephrase") == "kept"
+        stats = manager.stats()
+        assert stats["routes"]["Visualization"]["miss"]["count"] == 1
+        assert stats["routes"]["Visualization"]["hit"]["count"] == 1
+
+    asyncio.run(main())
+
+
+def test_unused_stages_expire_on_take_and_stats():
+    async def main():
+        manager = SpeculationManager(ttl=0.01)
+        speculation = manager.start("Query_Data")
+        manager.spawn(speculation, "pipeline:a", answer("a", 1))
+        manager.spawn(speculation, "pipeline:b", answer("b", 1))
+        await asyncio.sleep(0.05)
+        assert manager.stats()["pending_stages"] == 0
+        assert manager.stats()["expired_stages"] == 2
+
+        manager.spawn(speculation, "pipeline:c", answer("c", 1))
+        await asyncio.sleep(0.05)
+        # Expired when another stage is taken
+        assert await manager.take(speculation.id, "pipeline:c") is None
+        assert manager.expired_stages == 3
+
+    asyncio.run(main())
+
+
+def test_current_speculation_reaches_the_tools():
+    async def tool():
+        return current_speculation_id.get()
+
+    async def node():
+        current_speculation_id.set("abc")
+        return await asyncio.gather(tool(), asyncio.ensure_future(tool()))
+
+    assert asyncio.run(node()) == ["abc", "abc"]
+    assert current_speculation_id.get() is None
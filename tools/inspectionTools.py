@@ -1,6 +1,6 @@
 from datetime import date
 from langchain.agents import Tool
-from quality_agent.mongo_data_retriever import get_analytics_data, get_sales_data
+from quality_agent.mongo_data_retriever import get_analytics_data, get_sales_data, aget_sales_data
 from quality_agent.logger import setup_logger
 
 logger = setup_logger(__name__)
@@ -32,12 +32,15 @@ inspectionTools = [
         Tool(
         name="GetSalesData",
         func=get_sales_data,
+        coroutine=aget_sales_data,
         description="""
         Get details about sales related data like transaction data, including items purchased, customer information, store location, and purchase details. Call this tool if it's about the sales and supplies.
         Args:
             query (str): The user input to send. Accepts user input directly without modification.
         Returns:
-            list: List of records
+            dict: 'records' with the list of records, 'truncated' set to true when only the first 'row_limit' records are returned,
+            'partial' set to true when the records were computed on part of the data only, as the full query would scan too much data,
+            'rejected' with the reason when the query would scan too much data and must be narrowed
         """
     ),
    